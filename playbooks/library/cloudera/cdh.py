@@ -8,79 +8,869 @@
 # All the services are handled based on what is provided in the configuration.
 # Note: For any new service a `Service` class will need to be implemented.
 
+import collections
+from contextlib import contextmanager
 from functools import wraps
+from StringIO import StringIO
+import hashlib
+import httplib
+import math
+import multiprocessing
+import random
+import re
+import socket
+import ssl
+import threading
+import urllib2
+import urlparse
 import yaml
 
 from ansible.module_utils.basic import *
 
 from cm_api.api_client import ApiResource, ApiException
+from cm_api.endpoints.roles import ApiRole
 from cm_api.endpoints.services import ApiServiceSetupInfo, ApiBulkCommandList
+from cm_api.http_client import HttpClient
+from cm_api.endpoints.types import ApiList, config_to_api_list, config_to_json, json_to_config
 
 
 REMOTE_PARCEL_REPO_URLS = 'REMOTE_PARCEL_REPO_URLS'
 
-# List of services to configure in the specified order. The names
-# need to match with the names of the respective `Service` subclasses.
-# BASE_SERVICES contains a list of services that will be started first, before the
-# rest of the services are configured, since some of them depend on for example creating
-# directories on HDFS.
+# List of services to configure. The names need to match with the names of the respective
+# `Service` subclasses. The actual start order is driven by the `dependencies` declared on each
+# `Service` subclass, the order here is only used to break ties between services that are ready
+# to be started at the same time.
+# BASE_SERVICES contains a list of services that most of the other services depend on, for
+# example for creating directories on HDFS.
 BASE_SERVICES = ['Zookeeper', 'Hdfs', 'Yarn']
 ADDITIONAL_SERVICES = ['Spark_On_Yarn', 'Hbase', 'Hive', 'Impala', 'Flume', 'Oozie', 'Sqoop',
                        'Solr', 'Kafka', 'Sentry', 'Hue']
 
+# Default number of services that are brought up concurrently
+MAX_WORKERS = 4
+
+# Parcel stages, the action required to move a parcel on from a stage and the stages that
+# count as having completed each of those actions
+PARCEL_ACTIONS = {
+    'AVAILABLE_REMOTELY': ('Downloading', 'start_download'),
+    'DOWNLOADED': ('Distributing', 'start_distribution'),
+    'DISTRIBUTED': ('Activating', 'activate'),
+}
+PARCEL_DOWNLOADED = ['DOWNLOADED', 'DISTRIBUTED', 'ACTIVATED', 'INUSE']
+PARCEL_DISTRIBUTED = ['DISTRIBUTED', 'ACTIVATED', 'INUSE']
+PARCEL_ACTIVATED = ['ACTIVATED', 'INUSE']
+
+# Maximum time in seconds allowed for staging a single parcel
+PARCEL_TIMEOUT = 1800
+
+# CM settings limiting parcel distribution, the total rate in KB/s and the number of hosts the
+# parcels are uploaded to at once
+PARCEL_RATE_LIMIT = 'PARCEL_DISTRIBUTE_RATE_LIMIT_KBS_PER_SECOND'
+PARCEL_CONCURRENT_UPLOADS = 'PARCEL_NUM_CONCURRENT_UPLOADS'
+PARCEL_DISTRIBUTION_SETTINGS = [PARCEL_RATE_LIMIT, PARCEL_CONCURRENT_UPLOADS]
+
+# Default bandwidth in Mbit/s of the CM node's NIC, overridden by `cm.nic_mbps`, and the share of
+# it parcel distribution may take
+PARCEL_NIC_MBPS = 1000
+PARCEL_NIC_SHARE = 0.8
+
+# Rate in KB/s a single host is assumed to take a parcel at until a rate was measured, and the
+# lowest rate per host the uploads are spread down to, below which agents start timing out
+PARCEL_HOST_RATE = 10 * 1024
+PARCEL_MIN_HOST_RATE = 1024
+
+# Minimum time in seconds between two adjustments of the distribution settings
+PARCEL_TUNE_INTERVAL = 15
+
+# Default directory for the checkpoint journals, next to the default cluster.yaml location
+JOURNAL_DIR = '/opt/cdh-journal'
+
+# Default location of the Chrome trace-event file with the timings of the run
+TRACE_FILE = '/opt/cdh-trace.json'
+
+# Maximum number of keep-alive connections to CM, shared by all the threads
+HTTP_POOL_SIZE = 8
+
+# Methods which are safe to send again once CM may have received them
+HTTP_IDEMPOTENT = ['GET', 'HEAD', 'DELETE']
+
+# Timeout in seconds of the requests to CM, so that a CM which hangs doesn't block a thread forever
+HTTP_TIMEOUT = 30
+
+# Time in seconds GET responses are served from the cache, unless the resource is written to
+HTTP_CACHE_TTL = 1
+
+# Default target of the live progress events, either a file or unix:<path of a socket>
+PROGRESS_FILE = '/opt/cdh-progress.ndjson'
+
+# Time in seconds over which rates of progress are estimated, and after which progress that
+# didn't move is reported as stalled
+PROGRESS_WINDOW = 60
+PROGRESS_STALL = 30
+
+# Default number of clusters provisioned concurrently when several cluster configs are given
+MAX_CLUSTERS = 4
+
+# Default cap on the number of requests per second to a single CM, shared by all the clusters
+# provisioned against it when several clusters are provisioned. 0 disables the cap.
+CM_RATE = 20
+
+# Default location of the ledger of the CM API calls of a run. A ledger of a reference run can be
+# used as the call budget of later runs.
+LEDGER_FILE = '/opt/cdh-calls.json'
+
+# Upper bounds in milliseconds of the latency histogram buckets of the call ledger
+LEDGER_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+# Time in seconds within which a GET getting the same response as the previous identical GET is
+# counted as redundant, except for the endpoints that are polled for changes
+LEDGER_WINDOW = 5
+LEDGER_POLLED = ['GET /commands/{id}',
+                 'GET /clusters/{cluster}/parcels/products/{product}/versions/{version}']
+
+# Share by which the calls may exceed a call budget, unless the budget sets its own tolerance
+LEDGER_TOLERANCE = 0.1
+
+# The C loader of libyaml is much faster on large cluster.yaml files than the pure python one,
+# it's used whenever PyYAML was built with it
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Structure of the cluster.yaml, validated as a whole before anything is set up. Keys starting
+# with '?' are optional and '*' stands for any other key, which is skipped with a warning. A list
+# holds the schema of its items and a tuple the accepted types.
+SCALAR = (basestring, int, float)
+ROLE_SCHEMA = {'group': basestring, 'hosts': [basestring], '?config': dict}
+SERVICE_SCHEMA = {'?config': dict, 'roles': [ROLE_SCHEMA]}
+CONFIG_SCHEMA = {
+    'cm': {'host': basestring, 'username': basestring, 'password': basestring,
+           '?port': int, '?tls': bool, '?parcel_mirror': basestring, '?nic_mbps': (int, float)},
+    'cluster': {'name': SCALAR, 'version': SCALAR, 'fullVersion': SCALAR,
+                'hosts': [basestring]},
+    'parcels': [{'?repo': (basestring, type(None)), '?product': basestring,
+                 'version': SCALAR}],
+    'services': dict([('MGMT', SERVICE_SCHEMA)] +
+                     [('?' + svc.upper(), SERVICE_SCHEMA)
+                      for svc in BASE_SERVICES + ADDITIONAL_SERVICES] +
+                     [('*', None)]),
+}
+
+# Services are brought up from multiple threads, so serialize the json output
+_print_lock = threading.Lock()
+
+# Fields added to all the json output, e.g. the cluster name when provisioning several clusters
+_print_fields = {}
 
-def retry(attempts=3, delay=5):
-    """Function which reruns/retries other functions.
 
-    'attempts' - the number of attempted retries (defaults to 3)
-    'delay' - time in seconds between each retry (defaults to 5)
+class Backoff(object):
+    """
+    Polling policy
+
+    Polls start with a short `initial` interval which grows by `factor` on every attempt up
+    to `maximum`, with each interval randomly spread by +/- `jitter` so concurrent pollers
+    don't line up. Polling gives up once `deadline` seconds have passed in total.
+    """
+    def __init__(self, initial=1, maximum=30, deadline=300, factor=2.0, jitter=0.2):
+        self.initial = initial
+        self.maximum = maximum
+        self.deadline = deadline
+        self.factor = factor
+        self.jitter = jitter
+
+    def interval(self, attempt):
+        """
+        :param attempt: Number of polls done so far
+        :return: Time in seconds to sleep before the next poll
+        """
+        interval = min(self.maximum, self.initial * self.factor ** attempt)
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+# Polling policies for each call site
+POLL_POLICIES = {
+    'default': Backoff(initial=1, maximum=5, deadline=30),
+    'command': Backoff(initial=2, maximum=30, deadline=300),
+    'command_status': Backoff(initial=1, maximum=10, deadline=300),
+    'service_start': Backoff(initial=5, maximum=60, deadline=600),
+    'parcel': Backoff(initial=2, maximum=30, deadline=PARCEL_TIMEOUT),
+    'inspect_hosts': Backoff(initial=2, maximum=15, deadline=600),
+}
+
+
+class PollStats(object):
+    """
+    Keep track of the time spent sleeping between polls versus the time spent doing the
+    actual work, per polling policy
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, policy, polls=0, work=0, sleep=0):
+        with self._lock:
+            stats = self.stats.setdefault(policy, {'polls': 0, 'work': 0.0, 'sleep': 0.0})
+            stats['polls'] += polls
+            stats['work'] += work
+            stats['sleep'] += sleep
+
+    def report(self):
+        with self._lock:
+            for policy, stats in sorted(self.stats.items()):
+                print_json(type="POLLING",
+                           msg="{}: {} polls, {:.1f}s working, {:.1f}s sleeping".format(
+                               policy, stats['polls'], stats['work'], stats['sleep']))
+
+
+POLL_STATS = PollStats()
+
+
+class Poll(object):
+    """
+    A single polling run against a `Backoff` policy
+    """
+    def __init__(self, policy='default', deadline=None):
+        self.name = policy
+        self.policy = POLL_POLICIES[policy]
+        self.deadline = time.time() + (deadline or self.policy.deadline)
+        self.attempt = 0
+
+    @property
+    def remaining(self):
+        return self.deadline - time.time()
+
+    def work(self, func, *args, **kwargs):
+        """
+        Run a single poll, keeping track of the time spent doing it
+        """
+        started = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            POLL_STATS.record(self.name, polls=1, work=time.time() - started)
+
+    def sleep(self):
+        """
+        Sleep until the next poll is due
+
+        :return: False if the deadline has passed and polling should stop
+        """
+        remaining = self.remaining
+        if remaining <= 0:
+            return False
+        interval = min(self.policy.interval(self.attempt), remaining)
+        time.sleep(interval)
+        POLL_STATS.record(self.name, sleep=interval)
+        self.attempt += 1
+        return True
+
+    def reset(self):
+        """
+        Go back to polling at the initial interval, for example after progress was made
+        """
+        self.attempt = 0
+
+
+def retry(policy='default'):
+    """Function which reruns/retries other functions, as long as they raise an `ApiException`.
+
+    'policy' - name of the polling policy in POLL_POLICIES (defaults to 'default')
     """
     def deco_retry(func):
         """Main decorator function."""
         @wraps(func)
         def retry_loop(*args, **kwargs):
-            """Main num_tries loop."""
-            attempt_counter = 1
-            while attempt_counter <= attempts:
+            """Main polling loop."""
+            poll = Poll(policy)
+            while True:
                 try:
-                    return func(*args, **kwargs)
-                except ApiException as apie:  # pylint: disable=broad-except,catching-non-exception
-                    if attempt_counter == attempts:
+                    return poll.work(func, *args, **kwargs)
+                except ApiException:  # pylint: disable=catching-non-exception
+                    if not poll.sleep():
                         # pylint: disable=raising-bad-type
                         raise
-                    time.sleep(delay)
-                    attempt_counter += 1
         return retry_loop
     return deco_retry
 
 
-@retry(attempts=3, delay=30)
-def execute_cmd(func, service_name, timeout, fail_msg, *args, **kwargs):
+class Span(object):
+    """
+    A timed section of the run, with any number of nested spans
+    """
+    def __init__(self, name, cat, parent=None, track=None, **args):
+        self.name = name
+        self.cat = cat
+        self.parent = parent
+        self.track = track or threading.current_thread().name
+        self.args = args
+        self.children = []
+        self.start = time.time()
+        self.end = None
+        if parent is not None:
+            parent.children.append(self)
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def finish(self, outcome='ok', **args):
+        """
+        Close the span, unless it was already closed
+
+        :param outcome: Result of the section, for example 'ok', 'failed' or 'skipped'
+        """
+        if self.end is None:
+            self.end = time.time()
+            self.args.setdefault('outcome', outcome)
+            self.args.update(args)
+
+
+class Tracer(object):
+    """
+    Collect nested spans for all the phases of the run
+
+    Spans nest per thread. Work handed off to other threads can be attached to a span of the
+    thread handing it off thru `adopt`. The spans are exported as a Chrome trace-event file,
+    which can be loaded in chrome://tracing, and summarized as the critical path of the run.
+    """
+    def __init__(self):
+        self.spans = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @property
+    def current(self):
+        """
+        :return: Innermost open span of the current thread
+        """
+        return self._stack[-1] if self._stack else None
+
+    def begin(self, name, cat='setup', parent=None, track=None, **args):
+        """
+        Open a span which isn't tied to the current thread's stack, it needs to be closed thru
+        `Span.finish`
+
+        :return: `Span` instance
+        """
+        span = Span(name, cat, parent or self.current, track, **args)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name, cat='setup', **args):
+        """
+        Open a span nested under the current span of the thread for the duration of the block
+        """
+        span = self.begin(name, cat, **args)
+        self._stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.finish('failed', error=str(e))
+            raise
+        finally:
+            self._stack.pop()
+            span.finish()
+
+    @contextmanager
+    def adopt(self, parent):
+        """
+        Nest the spans of the current thread under a span of another thread
+        """
+        stack, self._local.stack = self._stack, [parent] if parent else []
+        try:
+            yield
+        finally:
+            self._local.stack = stack
+
+    def annotate(self, **args):
+        """
+        Add arguments, for example a CM command id, to the current span
+        """
+        if self.current is not None:
+            self.current.args.update(args)
+
+    def critical_path(self, span):
+        """
+        Walk back from the child span finishing last to work out the chain of spans which
+        determined how long a span took
+
+        :param span: `Span` instance
+        :return: List of the leaf spans on the critical path, in order
+        """
+        children = [child for child in span.children if child.end is not None]
+        if not children:
+            return [span]
+        path = []
+        candidates = children
+        while candidates:
+            last = max(candidates, key=lambda child: child.end)
+            path = self.critical_path(last) + path
+            candidates = [child for child in children if child.end <= last.start]
+        return path
+
+    def report(self, threshold=0.01):
+        """
+        Print the critical path of every top level span, leaving out the spans taking less
+        than `threshold` of the total time
+        """
+        for root in [span for span in self.spans if span.parent is None]:
+            print_json(type="TRACE", msg="{} took {:.1f}s, critical path:".format(
+                root.name, root.duration))
+            for span in self.critical_path(root):
+                if span.duration < threshold * root.duration:
+                    continue
+                print_json(type="TRACE", msg="{:8.1f}s {:5.1f}% {} ({})".format(
+                    span.duration, 100.0 * span.duration / max(root.duration, 0.001),
+                    span.name, span.args.get('outcome', 'open')))
+
+    def export(self, path):
+        """
+        Write all the spans to a Chrome trace-event JSON file
+
+        :param path: Location of the trace file
+        """
+        pid = os.getpid()
+        tracks = {}
+        events = []
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            if span.track not in tracks:
+                tracks[span.track] = len(tracks) + 1
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                               'tid': tracks[span.track], 'args': {'name': span.track}})
+            events.append({'name': span.name, 'cat': span.cat, 'ph': 'X', 'pid': pid,
+                           'tid': tracks[span.track],
+                           'ts': int(span.start * 1e6),
+                           'dur': int(span.duration * 1e6),
+                           'args': span.args})
+        with open(path, 'w') as trace:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace, default=str)
+        print_json(type="TRACE", msg="Trace written to {}".format(path))
+
+
+TRACER = Tracer()
+
+
+class RateEstimator(object):
+    """
+    Rolling estimate of the rate of progress over the last `window` seconds
+    """
+    def __init__(self, window=PROGRESS_WINDOW):
+        self.window = window
+        self.samples = []
+        self.changed = time.time()
+
+    def update(self, progress):
+        now = time.time()
+        if self.samples and progress < self.samples[-1][1]:
+            # Progress went back, e.g. the work started over, so start estimating again
+            self.samples = []
+        if not self.samples or progress != self.samples[-1][1]:
+            self.changed = now
+        self.samples.append((now, progress))
+        while len(self.samples) > 2 and self.samples[0][0] < now - self.window:
+            self.samples.pop(0)
+
+    @property
+    def rate(self):
+        """
+        :return: Progress per second, or None until there are enough samples
+        """
+        if len(self.samples) < 2:
+            return None
+        (start, first), (end, last) = self.samples[0], self.samples[-1]
+        return (last - first) / (end - start) if end > start else None
+
+    def eta(self, total):
+        """
+        :return: Estimated time in seconds until `total` is reached, or None if unknown
+        """
+        rate = self.rate
+        if not rate or not self.samples:
+            return None
+        return max(0, (total - self.samples[-1][1]) / rate)
+
+    @property
+    def stalled(self):
+        """
+        :return: Time in seconds since the progress last moved
+        """
+        return time.time() - self.changed
+
+
+class ProgressStream(object):
     """
-    Wrap retry checks for pre and post start commands that sometimes are not available to
-    execute immediately after configuring or starting a service
+    Stream of structured progress events, written as newline delimited json while the run goes
+    on. Ansible only shows the output of the module once it exits, the stream can be followed
+    with tools/cdh_watch.py in the meantime.
+
+    Every event carries a timestamp and, when known, the setup phase and the service it
+    belongs to. Progress events add the percentage complete, the rate and an ETA from a
+    rolling estimate, and whether the progress stalled.
     """
-    def check(cmd, name, fail_msg, timeout, retry=True):
-        if not cmd.wait(timeout).success:
-            if retry:
-                if (cmd.resultMessage is not None and
-                        "is not currently available for execution" in cmd.resultMessage):
+    def __init__(self):
+        self._write = None
+        self._close = None
+        self._estimators = {}
+        self._lock = threading.Lock()
+
+    def open(self, target):
+        """
+        :param target: Path of a file to append the events to, or unix:<path> of a socket to
+                       send them to
+        """
+        if not target:
+            return
+        try:
+            if target.startswith('unix:'):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(target[len('unix:'):])
+                self._write, self._close = sock.sendall, sock.close
+            else:
+                directory = os.path.dirname(target)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                stream = open(target, 'a', 1)
+                self._write, self._close = stream.write, stream.close
+        except (IOError, OSError, socket.error) as e:
+            print_json(type="PROGRESS", msg="Not streaming progress to {}: {}".format(target, e))
+
+    def close(self):
+        with self._lock:
+            if self._close is not None:
+                self._close()
+            self._write = self._close = None
+
+    @staticmethod
+    def context():
+        """
+        :return: Tuple of the setup phase and the service the current thread is working on
+        """
+        chain = []
+        span = TRACER.current
+        while span is not None:
+            chain.insert(0, span)
+            span = span.parent
+        phase = chain[1].name if len(chain) > 1 else None
+        services = [span.name for span in chain if span.cat == 'service']
+        return phase, services[0] if services else None
+
+    def emit(self, event, **fields):
+        """
+        Write a single event
+
+        :param event: Kind of event, for example log, step or progress
+        """
+        if self._write is None:
+            return
+        phase, service = self.context()
+        record = {'ts': round(time.time(), 3), 'event': event, 'phase': phase,
+                  'service': service}
+        record.update(fields)
+        line = json.dumps(dict((key, value) for key, value in record.items()
+                               if value is not None), default=str)
+        with self._lock:
+            try:
+                if self._write is not None:
+                    self._write(line + '\n')
+            except (IOError, socket.error):
+                # Nobody is listening anymore, the run goes on without the stream
+                self._write = None
+
+    def progress(self, item, progress, total, unit=None, **fields):
+        """
+        Write a progress event
+
+        :param item: What is progressing, for example a parcel
+        :param progress: Amount done so far
+        :param total: Total amount
+        :param unit: Unit of the amounts, for example bytes
+        """
+        with self._lock:
+            estimator = self._estimators.setdefault((item, fields.get('stage')), RateEstimator())
+            estimator.update(progress)
+        rate = estimator.rate
+        eta = estimator.eta(total)
+        self.emit('progress', item=item, progress=progress, total=total, unit=unit,
+                  percent=round(100.0 * progress / total, 1) if total else None,
+                  rate=round(rate, 1) if rate is not None else None,
+                  eta=round(eta) if eta is not None else None,
+                  stalled=round(estimator.stalled) if estimator.stalled >= PROGRESS_STALL else None,
+                  **fields)
+
+
+PROGRESS = ProgressStream()
+
+
+class CommandFuture(object):
+    """
+    Outcome of a CM command, or of the commands of a bulk command, tracked by a
+    `CommandTracker`
+    """
+    def __init__(self, func, name, timeout, fail_msg, args, kwargs):
+        self.func = func
+        self.name = name
+        self.timeout = timeout
+        self.fail_msg = fail_msg
+        self.args = args
+        self.kwargs = kwargs
+        command = getattr(func, '__name__', 'command')
+        if command == '_cmd' and args:
+            # Generic service command, named by its first argument
+            command = args[0]
+        span_name = '{}:{}'.format(name, command)
+        # Commands overlap, so give each of them its own track in the trace
+        self.span = TRACER.begin(span_name, cat='command', track=span_name)
+        # The commands are issued by the tracker, None until then
+        self.commands = None
+        self.bulk = False
+        self.due = 0
+        self.deadline = None
+        self.attempt = 0
+        self.retries = Poll('command')
+        self.exc_info = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def add_done_callback(self, func):
+        """
+        Call `func` with the future once it's done, right away if it's already done
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def result(self):
+        """
+        Wait for the commands to finish
+
+        :return: The final `ApiCommand`, or the list of final `ApiCommand` for a bulk command
+        """
+        # Wait in steps, a wait without a timeout can't be interrupted
+        while not self._done.wait(1):
+            pass
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.commands if self.bulk else self.commands[0]
+
+    def resolve(self, exc_info=None):
+        self.exc_info = exc_info
+        if exc_info is None:
+            self.span.finish()
+        else:
+            self.span.finish('failed', error=str(exc_info[1]))
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception as e:
+                print_json(type=self.name, msg="Command callback failed. {}".format(e))
+
+
+class CommandTracker(object):
+    """
+    Track any number of outstanding CM commands from a single polling thread
+
+    All the commands due for a status check are fetched in one pass, after which the thread
+    sleeps until the next command is due. Commands that are not available for execution yet, or
+    that found another command pending on the same entity, are issued again, following the
+    'command' polling policy.
+    """
+    RETRY_MESSAGES = ['is not currently available for execution',
+                      'There is already a pending command on this entity']
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._futures = []
+        self._thread = None
+
+    def submit(self, func, name, timeout, fail_msg, *args, **kwargs):
+        """
+        Issue a command without waiting for it to finish
+
+        :param func: Function issuing the command, returning an `ApiCommand` or an
+                     `ApiBulkCommandList`
+        :param name: Service name, used in messages
+        :param timeout: Time in seconds to wait for the command to finish
+        :param fail_msg: Message printed when the command fails
+        :return: `CommandFuture` instance
+        """
+        future = CommandFuture(func, name, timeout, fail_msg, args, kwargs)
+        with self._cond:
+            self._futures.append(future)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='commands')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._futures = [future for future in self._futures if not future.done()]
+                if not self._futures:
+                    self._thread = None
+                    return
+                now = time.time()
+                due = [future for future in self._futures if future.due <= now]
+                if not due:
+                    interval = min(future.due for future in self._futures) - now
+                    self._cond.wait(interval)
+                    POLL_STATS.record('command_status', sleep=time.time() - now)
+                    continue
+
+            for future in due:
+                try:
+                    if future.commands is None:
+                        self._issue(future)
+                    else:
+                        self._check(future)
+                except Exception:
+                    future.resolve(sys.exc_info())
+            POLL_STATS.record('command_status', polls=len(due), work=time.time() - now)
+
+    def _reissue(self, future, exc_info):
+        """
+        Schedule issuing the command again, unless the retries ran out
+        """
+        if future.retries.remaining <= 0:
+            future.resolve(exc_info)
+            return
+        future.commands = None
+        future.due = time.time() + future.retries.policy.interval(future.retries.attempt)
+        future.retries.attempt += 1
+
+    def _schedule(self, future):
+        policy = POLL_POLICIES['command_status']
+        future.due = time.time() + min(policy.interval(future.attempt),
+                                       max(0, future.deadline - time.time()))
+        future.attempt += 1
+
+    def _issue(self, future):
+        try:
+            cmd = future.func(*future.args, **future.kwargs)
+        except ApiException:
+            self._reissue(future, sys.exc_info())
+            return
+        if isinstance(cmd, ApiBulkCommandList):
+            future.bulk = True
+            future.commands = list(cmd)
+            future.span.args['command_ids'] = [cmdi.id for cmdi in cmd]
+        else:
+            future.commands = [cmd]
+            future.span.args['command_id'] = cmd.id
+        future.deadline = time.time() + future.timeout
+        future.attempt = 0
+        self._check(future)
+
+    def _check(self, future):
+        commands = []
+        for cmd in future.commands:
+            if cmd.active:
+                try:
+                    cmd = cmd.fetch()
+                except ApiException:
+                    # Check again on the next pass
+                    pass
+            commands.append(cmd)
+        future.commands = commands
+
+        if any(cmd.active for cmd in commands):
+            if time.time() < future.deadline:
+                self._schedule(future)
+                return
+        elif not future.bulk and not commands[0].success:
+            message = commands[0].resultMessage
+            if message is not None and any(retry in message for retry in self.RETRY_MESSAGES):
+                try:
                     raise ApiException('Retry command')
-            print_json(type=name, msg="{}. {}".format(fail_msg, cmd.resultMessage))
+                except ApiException:
+                    self._reissue(future, sys.exc_info())
+                return
 
-    cmd = func(*args, **kwargs)
-    if isinstance(cmd, ApiBulkCommandList):
-        for cmdi in cmd:
-            check(cmdi, service_name, fail_msg, timeout, retry=False)
-    else:
-        check(cmd, service_name, fail_msg, timeout)
+        for cmd in commands:
+            if not cmd.success:
+                print_json(type=future.name,
+                           msg="{}. {}".format(future.fail_msg, cmd.resultMessage))
+        future.resolve()
+
+
+COMMANDS = CommandTracker()
+
+
+def wait_all(futures):
+    """
+    Wait for all the given `CommandFuture` to finish, raising the first error once all of them
+    are done
+    """
+    exc_info = None
+    for future in futures:
+        try:
+            future.result()
+        except Exception:
+            exc_info = exc_info or sys.exc_info()
+    if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+
+def config_value(value):
+    """
+    Normalize a config value the way CM reports it back, so that values from the yaml can be
+    compared with the current values
+
+    :param value: Config value, as read from the yaml or the CM API
+    :return: The value as a string, or None if the value is unset
+    """
+    if value is None or isinstance(value, basestring):
+        return value
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def full_config(config_json):
+    """
+    :param config_json: Configs as returned by CM with view=full
+    :return: Config dictionary with every config at its value, or at its default when it's unset
+    """
+    return dict((item['name'], item['value'] if 'value' in item else item.get('default'))
+                for item in config_json.get(ApiList.LIST_KEY, []))
+
+
+def config_changes(desired, current):
+    """
+    :param desired: Config dictionary from the yaml
+    :param current: Config dictionary as returned by CM
+    :return: Config dictionary with only the entries whose value differs from the current one
+    """
+    return dict((key, value) for key, value in desired.items()
+                if config_value(value) != config_value(current.get(key)))
 
 
 def print_json(**kwargs):
     """
     Print json output based on the passed in arguments
     """
-    print json.dumps(kwargs)
+    kwargs = dict(_print_fields, **kwargs)
+    with _print_lock:
+        print json.dumps(kwargs)
+    PROGRESS.emit('log', type=kwargs.get('type'), msg=kwargs.get('msg'))
 
 
 def fail(module, msg):
@@ -101,13 +891,20 @@ class Parcels(object):
     This class handles all the required operations on Parcels from downloading, distributing
     to activating it.
     """
-    def __init__(self, module, manager, cluster, version, repo, product='CDH'):
+    def __init__(self, module, manager, cluster, version, repo, product='CDH', lock=None,
+                 mirror=None, tuner=None):
         self.module = module
+        self.lock = lock or threading.Lock()
+        self.mirror = mirror
+        self.tuner = tuner
         self.manager = manager
         self.cluster = cluster
         self.version = version
         self.repo = repo
         self.product = product
+        self.stage = None
+        self._requested = None
+        self._span = None
         self.validate()
 
     @property
@@ -134,62 +931,830 @@ class Parcels(object):
         def wait_parcel():
             return self.parcel
 
+        # With a parcel mirror, all the repos go thru the mirror before anything is downloaded
+        if self.mirror and self.update_repos(self.repo):
+            self.check_error(wait_parcel())
+            return
+
         try:
             self.check_error(self.parcel)
         except ApiException:
             if self.repo is None:
                 raise Exception("None of the existing repos contain the requested "
                                 "parcel version. Please specify a parcel repo.")
+            self.update_repos(self.repo)
+            self.check_error(wait_parcel())
+
+    def mirror_url(self, url):
+        """
+        :param url: Parcel repo url
+        :return: Url of the repo thru the parcel mirror, see tools/parcel_mirror.py
+        """
+        mirror = self.mirror.rstrip('/')
+        if url.startswith(mirror + '/') or '://' not in url:
+            return url
+        scheme, path = url.split('://', 1)
+        return '{}/{}/{}'.format(mirror, scheme, path)
+
+    def update_repos(self, repo=None):
+        """
+        Add a repo to the parcel repos of CM, with all the repos going thru the parcel mirror
+        when there is one
+
+        :param repo: Parcel repo url
+        :return: True if the repos changed
+        """
+        # The repos are a setting of CM itself, shared with any other cluster being set up
+        with self.lock:
             cm_config = self.manager.get_config(view='full')
             repo_config = cm_config[REMOTE_PARCEL_REPO_URLS]
-            value = ','.join([repo_config.value or repo_config.default, self.repo])
+            current = [url for url in (repo_config.value or repo_config.default).split(',')
+                       if url]
+            repos = current + ([repo] if repo else [])
+            if self.mirror:
+                repos = [self.mirror_url(url) for url in repos]
+            repos = [url for i, url in enumerate(repos) if url not in repos[:i]]
+            if repos == current:
+                return False
+            self.manager.update_config({REMOTE_PARCEL_REPO_URLS: ','.join(repos)})
+            return True
 
-            self.manager.update_config({REMOTE_PARCEL_REPO_URLS: value})
-            self.check_error(wait_parcel())
+    def check_state(self, states, parcel=None):
+        """
+        Check parcel progress state
+
+        :param states: List of possible states to test for
+        :param parcel: Parcel object from the CM API, fetched if not provided
+        :return: True if the parcel is in one of the states
+        """
+        parcel = parcel or self.parcel
+        self.check_error(parcel)
+        if parcel.stage in states:
+            return True
+        if parcel.stage == 'DISTRIBUTING' and self.tuner is not None:
+            self.tuner.observe('{}-{}'.format(self.product, self.version),
+                               parcel.state.progress, parcel.state.totalProgress)
+        PROGRESS.progress('{}-{}'.format(self.product, self.version), parcel.state.progress,
+                          parcel.state.totalProgress, unit='bytes', stage=parcel.stage)
+        print_json(type=self.__class__.__name__.upper(),
+                   msg="{}-{} {} progress: {} / {}".format(self.product, self.version, states[0],
+                                                          parcel.state.progress,
+                                                          parcel.state.totalProgress))
+        return False
+
+    @retry('parcel')
+    def wait_state(self, states):
+        """
+        Wait for the parcel to get to one of the states
+
+        :param states: List of possible states to test for
+        """
+        if not self.check_state(states):
+            raise ApiException("Waiting on parcel to get to state {}".format(states[0]))
+
+    def advance(self):
+        """
+        Move the parcel on to its next stage as soon as the current stage has completed. This
+        doesn't block, so it can be called repeatedly for a set of parcels to stage them all
+        side by side.
+
+        :return: True once the parcel is activated
+        """
+        parcel = self.parcel
+        self.check_error(parcel)
+        self.stage = parcel.stage
+        if parcel.stage in PARCEL_ACTIVATED:
+            if self._span is not None:
+                self._span.finish()
+            return True
+
+        if parcel.stage in PARCEL_ACTIONS and self._requested != parcel.stage:
+            action, func = PARCEL_ACTIONS[parcel.stage]
+            print_json(type=self.__class__.__name__.upper(),
+                       msg="{}: {}-{}".format(action, self.product, self.version))
+            if self._span is not None:
+                self._span.finish()
+            name = '{}-{}'.format(self.product, self.version)
+            self._span = TRACER.begin('{} {}'.format(action, name), cat='parcel', track=name)
+            if func == 'start_distribution' and self.tuner is not None:
+                self.tuner.start()
+            getattr(parcel, func)()
+            self._requested = parcel.stage
+        elif parcel.stage in ('DOWNLOADING', 'AVAILABLE_REMOTELY'):
+            self.check_state(PARCEL_DOWNLOADED, parcel)
+        elif parcel.stage in ('DISTRIBUTING', 'DOWNLOADED'):
+            self.check_state(PARCEL_DISTRIBUTED, parcel)
+        else:
+            self.check_state(PARCEL_ACTIVATED, parcel)
+        return False
+
+    def download(self):
+        """
+        Download the specified parcel to the Cloudera Manager server
+        """
+        print_json(type=self.__class__.__name__.upper(),
+                   msg="Downloading: {}-{}".format(self.product, self.version))
+        self.parcel.start_download()
+        self.wait_state(PARCEL_DOWNLOADED)
+
+    def distribute(self):
+        """
+        Distribute the parcel to all the nodes
+        """
+        print_json(type=self.__class__.__name__.upper(),
+                   msg="Distributing: {}-{}".format(self.product, self.version))
+        if self.tuner is not None:
+            self.tuner.start()
+        self.parcel.start_distribution()
+        self.wait_state(PARCEL_DISTRIBUTED)
+
+    def activate(self):
+        """
+        Activate the parcel for use in the cluster installation step
+        """
+        print_json(type=self.__class__.__name__.upper(),
+                   msg="Activating: {}-{}".format(self.product, self.version))
+        self.parcel.activate()
+        self.wait_state(PARCEL_ACTIVATED)
+
+
+class DistributionTuner(object):
+    """
+    Tune the parcel distribution settings of CM to the size of the cluster and the bandwidth of
+    the CM node, and adjust them between polls to the rate the hosts actually take the parcels
+    at.
+
+    The total rate is capped at the share of the NIC set aside for distribution, and enough
+    hosts are uploaded to at once to fill it. When the progress stalls, e.g. because agents time
+    out, the number of uploads is halved. The rate per host reached is recorded next to the
+    journals so the next run starts from it.
+
+    The settings CM had before are recorded along with it and put back once distribution is
+    done. Clusters set up side by side against the same CM share the recorded settings, the
+    last one to change the settings puts them back.
+    """
+    def __init__(self, manager, hosts, nic_mbps=None, path=None, key=None, lock=None):
+        self.manager = manager
+        self.hosts = max(1, hosts)
+        self.budget = int((nic_mbps or PARCEL_NIC_MBPS) * 1000 / 8 * PARCEL_NIC_SHARE)
+        self.path = path
+        self.key = key
+        self.lock = lock or threading.Lock()
+        self.learned = self.load()
+        self.host_rate = self.learned.get('host_rate') or PARCEL_HOST_RATE
+        # Number of uploads above which distribution stalled
+        self.ceiling = min(self.hosts, self.learned.get('ceiling') or self.hosts)
+        self.uploads = None
+        self.peak = 0
+        self.estimators = {}
+        self.adjusted = 0
+        # Settings of CM before the distribution was tuned
+        self.previous = None
+
+    def read(self):
+        """
+        :return: Learned settings of all the CMs
+        """
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as learned:
+                return json.load(learned)
+        except (IOError, ValueError):
+            return {}
+
+    def write(self, data):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as learned:
+            json.dump(data, learned, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def load(self):
+        """
+        :return: Settings learned by previous runs against the same CM
+        """
+        return self.read().get(self.key) or {}
+
+    def save(self):
+        """
+        Record the rate per host and the throughput reached
+        """
+        if not self.path or not self.peak:
+            return
+        with self.lock:
+            data = self.read()
+            entry = data.setdefault(self.key, {})
+            entry.update(host_rate=int(self.host_rate), throughput=int(self.peak),
+                         uploads=self.uploads, hosts=self.hosts,
+                         ceiling=self.ceiling if self.ceiling < self.hosts else None)
+            self.write(data)
+        print_json(type="PARCELS", msg="Distribution reached {} KB/s, {} KB/s per host".format(
+            int(self.peak), int(self.host_rate)))
+
+    def target_uploads(self):
+        """
+        :return: Number of concurrent uploads filling the rate limit at the rate per host
+        """
+        host_rate = max(self.host_rate, PARCEL_MIN_HOST_RATE)
+        return max(1, min(self.ceiling, int(math.ceil(float(self.budget) / host_rate))))
+
+    def current(self):
+        """
+        :return: Distribution settings of CM, None for a setting left at its default
+        """
+        config = self.manager.get_config()
+        return dict((name, config.get(name)) for name in PARCEL_DISTRIBUTION_SETTINGS)
+
+    def applied(self):
+        return {PARCEL_RATE_LIMIT: self.budget, PARCEL_CONCURRENT_UPLOADS: self.uploads}
+
+    def apply(self, uploads, reason):
+        if uploads == self.uploads:
+            return
+        self.uploads = uploads
+        self.adjusted = time.time()
+        # The settings belong to CM, shared with any other cluster being set up
+        with self.lock:
+            if self.previous is None:
+                # Another cluster may be distributing with tuned settings already, the settings
+                # from before it tuned them are recorded in the shared file
+                data = self.read()
+                self.previous = data.get(self.key, {}).get('previous') or self.current()
+                data.setdefault(self.key, {})['previous'] = self.previous
+                self.write(data)
+            self.manager.update_config(self.applied())
+        print_json(type="PARCELS", msg="Distributing at up to {} KB/s to {} of {} hosts at once, "
+                                       "{}".format(self.budget, uploads, self.hosts, reason))
+        TRACER.annotate(parcel_uploads=uploads, parcel_rate_limit=self.budget)
+
+    def start(self):
+        """
+        Set the distribution settings before a parcel is distributed
+        """
+        if self.uploads is None:
+            self.apply(self.target_uploads(), 'from the learned rate per host'
+                       if self.learned.get('host_rate') else 'for the size of the cluster')
+
+    def restore(self):
+        """
+        Put back the distribution settings CM had before, unless another cluster has changed the
+        settings since, which then puts them back once it's done
+        """
+        if self.previous is None:
+            return
+        with self.lock:
+            current = self.current()
+            if all(str(current[name]) == str(value) for name, value in self.applied().items()):
+                self.manager.update_config(self.previous)
+                data = self.read()
+                entry = data.get(self.key, {})
+                if entry.pop('previous', None) is not None:
+                    if not entry:
+                        del data[self.key]
+                    self.write(data)
+                print_json(type="PARCELS", msg="Restored the parcel distribution settings")
+        self.previous = None
+
+    def observe(self, name, progress, total):
+        """
+        Adjust the distribution settings to the progress of a distributing parcel
+
+        :param name: Parcel name
+        :param progress: Bytes distributed so far, summed over all the hosts
+        :param total: Total bytes to distribute
+        """
+        if self.uploads is None:
+            return
+        estimator = self.estimators.setdefault(name, RateEstimator(PARCEL_TUNE_INTERVAL * 2))
+        estimator.update(progress)
+        if progress >= total:
+            self.estimators.pop(name)
+        rates = [e.rate for e in self.estimators.values() if e.rate is not None]
+        if not rates:
+            return
+        rate = sum(rates) / 1024
+        self.peak = max(self.peak, rate)
+        if time.time() - self.adjusted < PARCEL_TUNE_INTERVAL:
+            return
+
+        stalled = min(time.time() - self.adjusted,
+                      max(e.stalled for e in self.estimators.values()))
+        # Give the previous adjustment the time to take effect before going lower again
+        if stalled > PROGRESS_STALL:
+            self.ceiling = max(1, self.uploads // 2)
+            self.apply(self.ceiling, 'halved as distribution stalled')
+        elif 0 < rate < self.budget * 0.9:
+            # Below the rate limit, the hosts are what limits the throughput
+            self.host_rate = rate / self.uploads
+            if self.target_uploads() > self.uploads:
+                self.apply(self.target_uploads(),
+                           'hosts take {} KB/s each'.format(int(self.host_rate)))
+
+
+class RateLimiter(object):
+    """
+    Token bucket capping the rate of requests to CM
+
+    The bucket lives in shared memory, so a limiter created before forking caps the requests of
+    all the processes provisioning clusters against the same CM together.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1.0, self.rate)
+        self._tokens = multiprocessing.Value('d', self.burst, lock=False)
+        self._updated = multiprocessing.Value('d', time.time(), lock=False)
+        self._lock = multiprocessing.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting for one to become available
+
+        :return: Time in seconds spent waiting
+        """
+        waited = 0
+        while True:
+            with self._lock:
+                now = time.time()
+                tokens = min(self.burst,
+                             self._tokens.value + (now - self._updated.value) * self.rate)
+                self._updated.value = now
+                if tokens >= 1:
+                    self._tokens.value = tokens - 1
+                    return waited
+                self._tokens.value = tokens
+                interval = (1 - tokens) / self.rate
+            time.sleep(interval)
+            waited += interval
+
+
+class CallLedger(object):
+    """
+    Per endpoint record of the CM API calls of a run, with the number of calls, errors, bytes
+    received, a latency histogram, the setup phases making the calls and the GETs that were
+    redundant because the same request got the same response shortly before
+    """
+    # Path segments followed by the name or id of an entity, replaced to get the endpoint
+    ENTITIES = {'clusters': '{cluster}', 'services': '{service}', 'roles': '{role}',
+                'roleConfigGroups': '{group}', 'hosts': '{host}', 'products': '{product}',
+                'versions': '{version}', 'commands': '{id}'}
+
+    def __init__(self):
+        self.endpoints = {}
+        self._last = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def endpoint(cls, method, path):
+        """
+        :param path: Request path relative to the API root, e.g. /clusters/c1/services/hdfs
+        :return: Endpoint of a request, e.g. GET /clusters/{cluster}/services/{service}
+        """
+        parts = path.strip('/').split('/')
+        for i in range(1, len(parts)):
+            previous = parts[i - 1]
+            # Commands are also issued by name, e.g. /commands/inspectHosts
+            if previous in cls.ENTITIES and (previous != 'commands' or parts[i].isdigit()):
+                parts[i] = cls.ENTITIES[previous]
+        return '{} /{}'.format(method, '/'.join(parts))
+
+    def record(self, method, path, url, status, latency, body):
+        """
+        :param path: Request path relative to the API root
+        :param url: Request url, with the query
+        :param status: HTTP status, None if no response was received
+        :param latency: Time in seconds until the whole response was received
+        :param body: Response body
+        """
+        endpoint = self.endpoint(method, path)
+        phase, service = ProgressStream.context()
+        now = time.time()
+        with self._lock:
+            stats = self.endpoints.setdefault(endpoint, {
+                'calls': 0, 'errors': 0, 'bytes': 0, 'redundant': 0, 'latencies': [],
+                'histogram': [0] * (len(LEDGER_BUCKETS) + 1), 'phases': {}})
+            stats['calls'] += 1
+            stats['bytes'] += len(body)
+            if status is None or status >= 400:
+                stats['errors'] += 1
+            stats['latencies'].append(latency)
+            milliseconds = latency * 1000
+            stats['histogram'][len([bound for bound in LEDGER_BUCKETS
+                                    if bound < milliseconds])] += 1
+            label = service or phase or '-'
+            stats['phases'][label] = stats['phases'].get(label, 0) + 1
+
+            if method == 'GET' and status == 200 and endpoint not in LEDGER_POLLED:
+                digest = hashlib.sha1(body).hexdigest()
+                last = self._last.get(url)
+                if last is not None and last[0] > now - LEDGER_WINDOW and last[1] == digest:
+                    stats['redundant'] += 1
+                self._last[url] = (now, digest)
+
+    @staticmethod
+    def percentile(values, fraction):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+    def summary(self):
+        """
+        :return: Ledger as written to the ledger file
+        """
+        with self._lock:
+            endpoints = {}
+            for endpoint, stats in self.endpoints.items():
+                latencies = stats['latencies']
+                endpoints[endpoint] = {
+                    'calls': stats['calls'], 'errors': stats['errors'], 'bytes': stats['bytes'],
+                    'redundant': stats['redundant'], 'phases': dict(stats['phases']),
+                    'latency_ms': dict((name, round(self.percentile(latencies, fraction) * 1000,
+                                                    1))
+                                       for name, fraction in (('p50', 0.5), ('p95', 0.95),
+                                                              ('max', 1))),
+                    'histogram': dict((label, count) for label, count in zip(
+                        ['<={}ms'.format(bound) for bound in LEDGER_BUCKETS] +
+                        ['>{}ms'.format(LEDGER_BUCKETS[-1])], stats['histogram']) if count),
+                }
+        return {'total': sum(stats['calls'] for stats in endpoints.values()),
+                'endpoints': endpoints}
+
+    def report(self, path=None):
+        """
+        Print a table of the calls per endpoint, the slowest endpoints first, and write the
+        ledger to `path`
+        """
+        summary = self.summary()
+        endpoints = sorted(summary['endpoints'].items(),
+                           key=lambda item: -sum(self.endpoints[item[0]]['latencies']))
+        print_json(type="CALLS", msg="{:>6} {:>6} {:>8} {:>8} {:>10} {:>9}  {}".format(
+            'calls', 'errors', 'p50 ms', 'p95 ms', 'bytes', 'redundant', 'endpoint'))
+        for endpoint, stats in endpoints:
+            print_json(type="CALLS", msg="{:>6} {:>6} {:>8} {:>8} {:>10} {:>9}  {}".format(
+                stats['calls'], stats['errors'], stats['latency_ms']['p50'],
+                stats['latency_ms']['p95'], stats['bytes'], stats['redundant'], endpoint))
+        print_json(type="CALLS", msg="{} CM API calls to {} endpoints, {} redundant".format(
+            summary['total'], len(endpoints),
+            sum(stats['redundant'] for _, stats in endpoints)))
+        if path:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(path, 'w') as ledger:
+                json.dump(summary, ledger, indent=2, sort_keys=True)
+
+    def over_budget(self, path):
+        """
+        Compare the calls with a call budget, which has the same format as the ledger file with
+        the calls per endpoint and in total. Endpoints left out of the budget are not limited.
+
+        :param path: Location of the call budget
+        :return: List of the endpoints, or 'total', with more calls than the budget allows
+        """
+        with open(path, 'r') as budget_file:
+            budget = json.load(budget_file)
+        tolerance = budget.get('tolerance', LEDGER_TOLERANCE)
+        summary = self.summary()
+        calls = dict((endpoint, stats['calls'])
+                     for endpoint, stats in summary['endpoints'].items())
+        calls['total'] = summary['total']
+        limits = dict((endpoint, limit['calls'] if isinstance(limit, dict) else limit)
+                      for endpoint, limit in budget.get('endpoints', {}).items())
+        if 'total' in budget:
+            limits['total'] = budget['total']
+        return ['{}: {} calls, budget {}'.format(endpoint, calls.get(endpoint, 0), limit)
+                for endpoint, limit in sorted(limits.items())
+                if calls.get(endpoint, 0) > limit * (1 + tolerance)]
+
+
+class HttpResponse(object):
+    """
+    Response of a `PooledHttpClient`, with the subset of the urllib2 response interface the
+    cm_api `Resource` uses
+    """
+    def __init__(self, body, content_type):
+        self.body = body
+        self.content_type = (content_type or 'text/plain').split(';')[0].strip().lower()
+
+    def read(self):
+        return self.body
+
+    def info(self):
+        return self
+
+    def getmaintype(self):
+        return self.content_type.split('/')[0]
+
+    def getsubtype(self):
+        return self.content_type.split('/')[-1]
+
+
+class PooledHttpClient(HttpClient):
+    """
+    cm_api `HttpClient` keeping a bounded pool of keep-alive connections to CM, which is shared
+    by all the threads, so that requests don't pay for a new connection and TLS handshake
+    every time
+
+    GET responses are cached for `cache_ttl` seconds. A write drops the cached responses of the
+    resource written to, of the resources it's nested under and of those nested under it.
+    Command status is never cached and, since a finished command can change anything, the whole
+    cache is dropped whenever a command is seen finishing.
+    """
+    def __init__(self, base_url, headers, pool_size=HTTP_POOL_SIZE, cache_ttl=HTTP_CACHE_TTL,
+                 ssl_context=None, timeout=None, limiter=None):
+        HttpClient.__init__(self, base_url, exc_class=ApiException, ssl_context=ssl_context,
+                            timeout=timeout)
+        self.set_headers(headers)
+        url = urlparse.urlparse(self.base_url)
+        self._tls = url.scheme == 'https'
+        self._netloc = url.netloc
+        self._ssl_context = ssl_context
+        self._pool_size = pool_size
+        self._idle = []
+        self._open = 0
+        self._pool = threading.Condition()
+        self._cache_ttl = cache_ttl
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+        self._cookies = {}
+        self._limiter = limiter
+        self.stats = {'requests': 0, 'connections': 0, 'cache_hits': 0, 'throttled': 0.0}
+        self.ledger = CallLedger()
+
+    def _connect(self):
+        if self._tls:
+            return httplib.HTTPSConnection(self._netloc, timeout=self._timeout,
+                                           context=self._ssl_context)
+        return httplib.HTTPConnection(self._netloc, timeout=self._timeout)
+
+    def _acquire(self):
+        """
+        :return: Tuple of a connection and whether it was used before
+        """
+        with self._pool:
+            while not self._idle and self._open >= self._pool_size:
+                self._pool.wait()
+            if self._idle:
+                return self._idle.pop(), True
+            self._open += 1
+            self.stats['connections'] += 1
+        return self._connect(), False
+
+    def _release(self, conn, reuse=True):
+        with self._pool:
+            if reuse:
+                self._idle.append(conn)
+            else:
+                conn.close()
+                self._open -= 1
+            self._pool.notify()
+
+    def _request(self, method, path, data, headers):
+        """
+        Send a request over a pooled connection. A connection which was idle may have been closed
+        by CM in the meantime, in which case the request is sent again over a new connection.
+        Only idempotent requests are sent again once they may have reached CM, any other request
+        only when it couldn't be sent at all.
+
+        :return: Tuple of the response and its body
+        """
+        while True:
+            conn, reused = self._acquire()
+            sent = False
+            try:
+                conn.request(method, path, data, headers)
+                sent = True
+                resp = conn.getresponse()
+                body = resp.read()
+            except (httplib.HTTPException, socket.error):
+                self._release(conn, reuse=False)
+                if reused and (not sent or method.upper() in HTTP_IDEMPOTENT):
+                    continue
+                raise
+            self._release(conn, reuse=not resp.will_close)
+            return resp, body
+
+    def _key(self, path):
+        return '/' + path.strip('/')
+
+    def invalidate(self, path=None):
+        """
+        Drop the cached GET responses related to a resource, or all of them
+        """
+        with self._cache_lock:
+            if path is None:
+                self._cache.clear()
+                return
+            resource = self._key(re.split(r'/(?:commands|roleCommands|config)(?:/|$)', path)[0])
+            if resource.startswith('/cm/'):
+                resource = '/cm'
+            for key in self._cache.keys():
+                if (key[0] == resource or key[0].startswith(resource + '/') or
+                        resource.startswith(key[0] + '/')):
+                    del self._cache[key]
+
+    def execute(self, http_method, path, params=None, data=None, headers=None):
+        """
+        Submit an HTTP request
+
+        :return: `HttpResponse` instance
+        """
+        url = self._make_url(path, params)
+        key = (self._key(path), url)
+        if http_method in ('GET', 'DELETE'):
+            data = None
+        if http_method == 'GET':
+            with self._cache_lock:
+                cached = self._cache.get(key)
+                if cached is not None and cached[0] > time.time():
+                    self.stats['cache_hits'] += 1
+                    return cached[1]
+        else:
+            self.invalidate(path)
+
+        waited = self._limiter.acquire() if self._limiter is not None else 0
+        headers = self._get_headers(headers)
+        with self._cache_lock:
+            self.stats['requests'] += 1
+            self.stats['throttled'] += waited
+            if self._cookies:
+                headers['Cookie'] = '; '.join('{}={}'.format(*cookie)
+                                              for cookie in self._cookies.items())
+        parsed = urlparse.urlparse(url)
+        request_path = parsed.path + ('?' + parsed.query if parsed.query else '')
+        self.logger.debug("%s %s" % (http_method, url))
+        started = time.time()
+        try:
+            resp, body = self._request(http_method, request_path, data, headers)
+        except (httplib.HTTPException, socket.error):
+            self.ledger.record(http_method, key[0], url, None, time.time() - started, '')
+            raise
+        self.ledger.record(http_method, key[0], url, resp.status, time.time() - started, body)
+        with self._cache_lock:
+            for cookie in resp.msg.getheaders('set-cookie'):
+                name, _, value = cookie.split(';')[0].partition('=')
+                self._cookies[name.strip()] = value.strip()
+        if not 200 <= resp.status < 300:
+            raise self._exc_class(urllib2.HTTPError(url, resp.status, resp.reason, resp.msg,
+                                                    StringIO(body)))
+
+        response = HttpResponse(body, resp.getheader('content-type'))
+        if http_method == 'GET':
+            if key[0].startswith('/commands/'):
+                if response.getsubtype() == 'json' and not json.loads(body).get('active', True):
+                    self.invalidate()
+            elif self._cache_ttl:
+                with self._cache_lock:
+                    self._cache[key] = (time.time() + self._cache_ttl, response)
+        return response
+
+    def report(self):
+        print_json(type="HTTP", msg="{} requests over {} connections, {} served from cache, "
+                                    "{:.1f}s throttled".format(
+                                        self.stats['requests'], self.stats['connections'],
+                                        self.stats['cache_hits'], self.stats['throttled']))
+
+
+class HostIndex(object):
+    """
+    Index of all the hosts registered with Cloudera Manager
+
+    All the hosts are loaded with a single request the first time the index is used and can
+    then be looked up by hostname, hostId or IP address without any further requests. A single
+    index is shared across the whole run.
+    """
+    def __init__(self, api):
+        self.api = api
+        self._hosts = None
+        self._lock = threading.Lock()
+
+    @property
+    def hosts(self):
+        """
+        :return: Dictionary of hostname, hostId and IP address to `ApiHost` instance
+        """
+        with self._lock:
+            if self._hosts is None:
+                hosts = {}
+                for host in self.api.get_all_hosts():
+                    for key in (host.hostId, host.hostname, host.ipAddress):
+                        if key:
+                            hosts[key] = host
+                self._hosts = hosts
+            return self._hosts
+
+    def refresh(self):
+        """
+        Drop the loaded hosts, for example after new hosts were registered
+        """
+        with self._lock:
+            self._hosts = None
+
+    def get(self, host):
+        """
+        :param host: Hostname, hostId or IP address
+        :return: `ApiHost` instance or None if the host isn't known
+        """
+        return self.hosts.get(host)
+
+    def host_id(self, host):
+        """
+        :param host: Hostname, hostId or IP address
+        :return: hostId of the host, or the host as is if the host isn't known
+        """
+        found = self.get(host)
+        return found.hostId if found else host
+
+    def hostname(self, host):
+        """
+        :param host: Hostname, hostId or IP address
+        :return: Hostname of the host, or the host as is if the host isn't known
+        """
+        found = self.get(host)
+        return found.hostname if found else host
+
+
+class ClusterState(object):
+    """
+    Snapshot of the state of the services within a cluster and of their roles
+
+    The services are all fetched with a single request and the roles of a service with one
+    request per service. Everything is read from the snapshot until the service is
+    invalidated, which happens whenever a command changing the service completes.
+    """
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self._services = None
+        self._roles = {}
+        self._stale = set()
+        self._lock = threading.RLock()
 
-    @retry(attempts=20, delay=30)
-    def check_state(self, states):
+    def service(self, name):
         """
-        Check parcel progress state
-
-        :param states: List of possible states to test for
+        :param name: Service name
+        :return: `ApiService` instance or None if the service doesn't exist
         """
-        parcel = self.parcel
-        self.check_error(parcel)
-        if parcel.stage in states:
-            return
-        else:
-            print_json(type=self.__class__.__name__.upper(),
-                       msg="{} progress: {} / {}".format(states[0], parcel.state.progress,
-                                                         parcel.state.totalProgress))
-            raise ApiException("Waiting on parcel to get to state {}".format(states[0]))
+        with self._lock:
+            if self._services is None:
+                self._services = dict((svc.name, svc) for svc in self.cluster.get_all_services())
+                self._stale.clear()
+            if name in self._stale:
+                try:
+                    self._services[name] = self.cluster.get_service(name)
+                except ApiException:
+                    self._services.pop(name, None)
+                self._stale.discard(name)
+            return self._services.get(name)
 
-    def download(self):
+    def roles(self, name):
         """
-        Download the specified parcel to the Cloudera Manager server
+        :param name: Service name
+        :return: List of `ApiRole` instances of the service
         """
-        print_json(type=self.__class__.__name__.upper(),
-                   msg="Downloading: {}-{}".format(self.product, self.version))
-        self.parcel.start_download()
-        self.check_state(['DOWNLOADED', 'DISTRIBUTED', 'ACTIVATED', 'INUSE'])
+        with self._lock:
+            svc = self.service(name)
+            if svc is None:
+                return []
+            if name not in self._roles:
+                self._roles[name] = svc.get_all_roles()
+            return self._roles[name]
+
+    def roles_by_type(self, name, role_type):
+        """
+        :param name: Service name
+        :param role_type: Role type, for example DATANODE
+        :return: List of `ApiRole` instances of the service with the given type
+        """
+        return [role for role in self.roles(name) if role.type == role_type]
 
-    def distribute(self):
+    def add(self, svc):
         """
-        Distribute the parcel to all the nodes
+        Add a newly created service to the snapshot
+
+        :param svc: `ApiService` instance
         """
-        print_json(type=self.__class__.__name__.upper(),
-                   msg="Distributing: {}-{}".format(self.product, self.version))
-        self.parcel.start_distribution()
-        self.check_state(['DISTRIBUTED', 'ACTIVATED', 'INUSE'])
+        with self._lock:
+            self.service(svc.name)
+            self._services[svc.name] = svc
+            self._roles.pop(svc.name, None)
 
-    def activate(self):
+    def invalidate(self, name=None):
         """
-        Activate the parcel for use in the cluster installation step
+        Drop the state of a service, or of all the services, so that it's fetched again the
+        next time it's read
+
+        :param name: Service name
         """
-        print_json(type=self.__class__.__name__.upper(),
-                   msg="Activating: {}-{}".format(self.product, self.version))
-        self.parcel.activate()
-        self.check_state(['ACTIVATED', 'INUSE'])
+        with self._lock:
+            if name is None:
+                self._services = None
+                self._roles = {}
+            else:
+                self._stale.add(name)
+                self._roles.pop(name, None)
 
 
 class Service(object):
@@ -198,12 +1763,16 @@ class Service(object):
 
     Note: All subclass names should match an existing service name within CDH
     """
+    # Names of the `Service` subclasses that need to be started before this service can be
+    # deployed. Dependencies that are not part of the cluster configuration are ignored.
+    dependencies = []
 
-    def __init__(self, cluster, config, type=None):
+    def __init__(self, cluster, config, type=None, hosts=None, state=None):
         self.cluster = cluster
         self.config = config
         self.type = type or self.name
-        self._service = None
+        self.hosts = hosts
+        self.state = state or ClusterState(cluster)
 
     @property
     def name(self):
@@ -219,14 +1788,18 @@ class Service(object):
         Create a service entity within the cluster context if one doesn't already exist
         :return: `ApiService` instance
         """
-        if self._service is not None:
-            return self._service
+        svc = self.state.service(self.name)
+        if svc is None:
+            svc = self.cluster.create_service(self.name, self.type)
+            self.state.add(svc)
+        return svc
 
-        try:
-            self._service = self.cluster.get_service(self.name)
-        except ApiException:
-            self._service = self.cluster.create_service(self.name, self.type)
-        return self._service
+    @property
+    def roles(self):
+        """
+        :return: List of `ApiRole` instances of the service, from the cluster state snapshot
+        """
+        return self.state.roles(self.name)
 
     @property
     def started(self):
@@ -234,19 +1807,46 @@ class Service(object):
         Check if a service is already started and running.
         :return: service state Boolean
         """
-        if self.service.serviceState == 'STARTED':
-            for role in self.service.get_all_roles():
+        svc = self.state.service(self.name)
+        if svc is not None and svc.serviceState == 'STARTED':
+            for role in self.roles:
                 if role.type != 'GATEWAY' and role.roleState != 'STARTED':
                     return False
             return True
         return False
 
+    def submit_cmd(self, func, timeout, fail_msg, *args, **kwargs):
+        """
+        Issue a pre or post start command without waiting for it, the state of the service is
+        refreshed once the command is done
+
+        :return: `CommandFuture` instance
+        """
+        future = COMMANDS.submit(func, self.name, timeout, fail_msg, *args, **kwargs)
+        future.add_done_callback(lambda done: self.state.invalidate(self.name))
+        return future
+
     def run_cmd(self, func, timeout, fail_msg, *args, **kwargs):
         """
         Wrap retry checks for pre and post start commands that sometimes are not available to
         execute immediately after configuring or starting a service
         """
-        execute_cmd(func, self.name, timeout, fail_msg, *args, **kwargs)
+        return self.submit_cmd(func, timeout, fail_msg, *args, **kwargs).result()
+
+    def deploy_client_config(self, roles=None):
+        """
+        Deploy the client configs for all the roles of this service, since some of the services
+        depend on other services and is essential that the client configs are in place
+
+        :param roles: Names of the roles to deploy the client configs to, all the roles if None
+        """
+        roles = roles or [role.name for role in self.roles]
+        try:
+            self.run_cmd(self.service.deploy_client_config, 30, "Failed deploying client configs",
+                         *roles)
+        except ApiException:
+            # Sometimes the deploy client configs cannot be run, but we can safely ignore them
+            pass
 
     def deploy(self):
         """
@@ -254,56 +1854,210 @@ class Service(object):
         """
         print_json(type=self.name, msg="Deploying service")
 
-        # Service creation and config updates
-        self.service.update_config(self.config.get('config', {}))
-
-        # Retrieve base role config groups, update configs for those and create individual roles
-        # per host
         if not self.config.get('roles'):
             raise Exception("[{}] Atleast one role should be specified per service".format(self.name))
         for role in self.config['roles']:
             if not role.get('group') and role.get('hosts'):
                 raise Exception("[{}] group and hosts should be specified per role".format(self.name))
-            group = role['group']
-            role_group = self.service.get_role_config_group('{}-{}-BASE'.format(self.name, group))
-            role_group.update_config(role.get('config', {}))
-            self.create_roles(role, group)
 
-    def create_roles(self, role, group):
+        # Service creation and config updates, only pushing the configs that changed
+        self.push_config()
+
+        # Create individual roles per host
+        self.create_roles(self.missing_roles_all())
+
+    def scale_out(self):
+        """
+        Create the roles that don't exist yet, e.g. the roles of hosts that were just added to
+        the cluster, then deploy the client configs to and start only those roles. Neither the
+        configs nor the existing roles of the service are touched.
+
+        :return: Names of the new roles
+        """
+        roles = [role.name for role in self.create_roles(self.missing_roles_all())]
+        if not roles:
+            print_json(type=self.name, msg="No new roles")
+            return roles
+        self.deploy_client_config(roles)
+        # Gateways only carry client configs and can't be started
+        startable = [role.name for role in self.roles
+                     if role.name in roles and role.type != 'GATEWAY']
+        if startable:
+            print_json(type=self.name, msg="Starting {} new roles".format(len(startable)))
+            self.run_cmd(self.service.start_roles, 300, "Failed starting new roles", *startable)
+        return roles
+
+    def missing_roles_all(self):
+        """
+        :return: List of role definitions for all the roles of the yaml which don't exist yet
+        """
+        existing = set((role.type, role.hostRef.hostId) for role in self.roles)
+        missing = []
+        for role in self.config['roles']:
+            missing.extend(self.missing_roles(role, role['group'], existing))
+        return missing
+
+    def config_diff(self):
+        """
+        Compare the service config and the configs of the base role config groups from the yaml
+        with the current configs in CM, which are fetched with one request for the service and
+        one for all of its role config groups. The summary view CM returns by default leaves out
+        the configs at their default value, so the full view with the defaults is read for the
+        service, and for the role config groups that look changed in the summary.
+
+        :return: Tuple of the changed service configs and a dictionary of the changed configs
+                 per base role config group name
+        """
+        resource_root = self.service._get_resource_root()
+        current = full_config(resource_root.get(self.service._path() + '/config',
+                                                params={'view': 'full'}))
+        service_changes = config_changes(self.config.get('config', {}), current)
+
+        groups = resource_root.get(self.service._path() + '/roleConfigGroups')
+        group_configs = dict((group['name'], json_to_config(group.get('config', {'items': []})))
+                             for group in groups.get(ApiList.LIST_KEY, []))
+        desired = {}
+        for role in self.config['roles']:
+            name = '{}-{}-BASE'.format(self.name, role['group'])
+            desired.setdefault(name, {}).update(role.get('config', {}))
+        group_changes = {}
+        for name, config in desired.items():
+            changes = config_changes(config, group_configs.get(name, {}))
+            if changes and name in group_configs:
+                changes = config_changes(changes, full_config(resource_root.get(
+                    '{}/roleConfigGroups/{}/config'.format(self.service._path(), name),
+                    params={'view': 'full'})))
+            if changes:
+                group_changes[name] = changes
+        return service_changes, group_changes
+
+    def push_config(self):
+        """
+        Update only the service and base role config group configs that differ from the current
+        configs in CM. Every update is persisted as a new config revision and can mark the roles
+        as having a stale configuration, so a rerun without config changes doesn't write at all.
+        """
+        service_changes, group_changes = self.config_diff()
+        if service_changes:
+            self.service.update_config(service_changes)
+        resource_root = self.service._get_resource_root()
+        for name, changes in sorted(group_changes.items()):
+            resource_root.put('{}/roleConfigGroups/{}/config'.format(self.service._path(), name),
+                              data=config_to_json(changes))
+
+        changed = sum(len(changes) for changes in group_changes.values()) + len(service_changes)
+        TRACER.annotate(config_changes=changed)
+        if not changed:
+            print_json(type=self.name, msg="Configs are up to date")
+            return
+        summary = []
+        if service_changes:
+            summary.append('service: {}'.format(', '.join(sorted(service_changes))))
+        summary.extend('{}: {}'.format(name, ', '.join(sorted(changes)))
+                       for name, changes in sorted(group_changes.items()))
+        print_json(type=self.name, msg="Updated {} configs. {}".format(changed, '; '.join(summary)))
+
+    def role_config(self, group, role_id):
+        """
+        Role specific configs that have to be set on an individual role, on top of the configs
+        of its role group
+
+        :param group: Role group name
+        :param role_id: Position of the role's host within the role group
+        :return: Config dictionary
+        """
+        return {}
+
+    def role_at(self, group, position):
+        """
+        :param group: Role group name
+        :param position: Position of the role's host within the role group, starting at 1
+        :return: Name of the role of the group on that host
+        """
+        hosts = [host for role in self.config['roles'] if role['group'] == group
+                 for host in role.get('hosts', [])]
+        host = hosts[position - 1]
+        if self.hosts is not None:
+            host = self.hosts.host_id(host)
+        for role in self.state.roles_by_type(self.name, group):
+            if role.hostRef.hostId == host:
+                return role.name
+        return self.role_name(group, host)
+
+    def role_name(self, group, host, first=False):
+        """
+        Name of a role derived from its host, like CM does, so that the names don't change when
+        the hosts are listed in a different order or hosts are added. Roles created with names
+        by position, e.g. HDFS-DATANODE-3, keep their names.
+
+        :param group: Role group name
+        :param host: hostId of the role's host
+        :param first: Whether it's the first role of the group, which keeps the name by position
+                      since the yaml refers to it, e.g. hue_webhdfs: HDFS-NAMENODE-1
+        :return: Role name
+        """
+        if first:
+            return '{}-{}-1'.format(self.name, group)
+        return '{}-{}-{}'.format(self.name, group, hashlib.sha1(host).hexdigest()[:12])
+
+    def missing_roles(self, role, group, existing):
         """
-        Create individual roles for all the hosts under a specific role group
+        Work out the individual roles for all the hosts under a specific role group which
+        don't exist yet
 
         :param role: Role configuration from yaml
         :param group: Role group name
+        :param existing: Set of the (role type, hostId) of the roles which already exist for the
+                         service
+        :return: List of role definitions for the CM roles endpoint
         """
-        role_id = 0
-        for host in role.get('hosts', []):
-            role_id += 1
-            role_name = '{}-{}-{}'.format(self.name, group, role_id)
-            try:
-                self.service.get_role(role_name)
-            except ApiException:
-                self.service.create_role(role_name, group, host)
+        roles = []
+        first = not any(role_type == group for role_type, _ in existing)
+        for role_id, host in enumerate(role.get('hosts', []), 1):
+            if self.hosts is not None:
+                host = self.hosts.host_id(host)
+            if (group, host) in existing:
+                continue
+            apirole = {'name': self.role_name(group, host, first), 'type': group,
+                       'hostRef': {'hostId': host}}
+            first = False
+            config = self.role_config(group, role_id)
+            if config:
+                apirole['config'] = config_to_api_list(config)
+            roles.append(apirole)
+        return roles
+
+    def create_roles(self, roles):
+        """
+        Create all the given roles in a single request, since the CM roles endpoint accepts a
+        list of roles
+
+        :param roles: List of role definitions, as returned by `missing_roles`
+        :return: List of the created `ApiRole` instances
+        """
+        if not roles:
+            return []
+        print_json(type=self.name, msg="Creating {} roles".format(len(roles)))
+        resource_root = self.service._get_resource_root()
+        try:
+            resp = resource_root.post(self.service._path() + '/roles',
+                                      data=json.dumps({ApiList.LIST_KEY: roles}))
+        finally:
+            self.state.invalidate(self.name)
+        return ApiList.from_json_dict(resp, resource_root, ApiRole)
 
-    @retry(attempts=3, delay=60)
+    @retry('service_start')
     def start(self):
         """
         Start the service and wait for the command to finish, followed by a check that the
         service is running and healthy
         """
         print_json(type=self.name, msg="Starting service")
-        self._service = None
         if not self.started:
-            cmd = self.service.start()
-            if not cmd.wait(300).success:
-                print_json(type=self.name,
-                           msg="Command Service start failed. {}".format(cmd.resultMessage))
-                if (cmd.resultMessage is not None and
-                        'There is already a pending command on this entity' in cmd.resultMessage):
-                    raise ApiException('Retry command')
+            cmd = self.run_cmd(self.service.start, 300, "Command Service start failed")
+            if not cmd.success:
                 raise Exception("Service {} failed to start".format(self.name))
 
-        self._service = None
         assert self.started
 
     def pre_start(self):
@@ -325,23 +2079,32 @@ class Zookeeper(Service):
     Service Role Groups:
         SERVER
     """
-    def create_roles(self, role, group):
+    def missing_roles_all(self):
         """
-        This is overriden since there are some Zookeeper configs that has to be specific to
-        a single host/role
-
-        :param role: Role configuration from yaml
-        :param group: Role group name
+        This is overriden since every Zookeeper server needs its own serverId. The new servers
+        are numbered after the highest serverId of the existing ones rather than by position in
+        the yaml, which changes when the hosts are reordered or added.
         """
-        role_id = 0
-        for host in role['hosts']:
-            role_id += 1
-            role_name = '{}-{}-{}'.format(self.name, group, role_id)
-            try:
-                role = self.service.get_role(role_name)
-            except ApiException:
-                role = self.service.create_role(role_name, group, host)
-            role.update_config({'serverId': role_id})
+        missing = super(Zookeeper, self).missing_roles_all()
+        servers = [role for role in missing if role['type'] == 'SERVER']
+        if servers:
+            server_id = max([0] + self.server_ids())
+            for role in servers:
+                server_id += 1
+                role.setdefault('config', config_to_api_list({}))
+                role['config'][ApiList.LIST_KEY].append({'name': 'serverId', 'value': server_id})
+        return missing
+
+    def server_ids(self):
+        """
+        :return: serverId of each of the existing servers
+        """
+        ids = []
+        for role in self.state.roles_by_type(self.name, 'SERVER'):
+            server_id = role.get_config().get('serverId')
+            if server_id is not None:
+                ids.append(int(server_id))
+        return ids
 
     def pre_start(self):
         """
@@ -361,29 +2124,27 @@ class Hdfs(Service):
         JOURNALNODE
         FAILOVERCONTROLLER
     """
+    dependencies = ['Zookeeper']
+
     @property
     def active_namenode(self):
-        return '{}-NAMENODE-1'.format(self.name)
+        return self.role_at('NAMENODE', 1)
 
     @property
     def standby_namenode(self):
-        return '{}-NAMENODE-2'.format(self.name)
+        return self.role_at('NAMENODE', 2)
 
     @property
     def failover_primary(self):
-        return '{}-FAILOVERCONTROLLER-1'.format(self.name)
+        return self.role_at('FAILOVERCONTROLLER', 1)
 
     @property
     def failover_secondary(self):
-        return '{}-FAILOVERCONTROLLER-2'.format(self.name)
+        return self.role_at('FAILOVERCONTROLLER', 2)
 
     @property
     def ha(self):
-        try:
-            self.service.get_role('SECONDARYNAMENODE')
-            return False
-        except ApiException:
-            return True
+        return not self.state.roles_by_type(self.name, 'SECONDARYNAMENODE')
 
     def format_namenode(self):
         """Format only the primary/active Namenode"""
@@ -405,7 +2166,7 @@ class Hdfs(Service):
 
         # Start the Journal Nodes
         print_json(type=self.name, msg="Starting Journal Nodes")
-        roles = [role.name for role in self.service.get_roles_by_type('JOURNALNODE')]
+        roles = [role.name for role in self.state.roles_by_type(self.name, 'JOURNALNODE')]
         self.run_cmd(self.service.start_roles, 300, "Command Service start failed",
                      *roles)
 
@@ -447,11 +2208,14 @@ class Yarn(Service):
         NODEMANAGER
         GATEWAY
     """
-    def pre_start(self):
-        self.run_cmd(self.service.create_yarn_job_history_dir, 60, "Command Create Job History Dir failed")
+    dependencies = ['Hdfs']
 
-        self.run_cmd(self.service.create_yarn_node_manager_remote_app_log_dir, 60,
-                     "Command Create NodeManager app dir failed")
+    def pre_start(self):
+        wait_all([
+            self.submit_cmd(self.service.create_yarn_job_history_dir, 60,
+                            "Command Create Job History Dir failed"),
+            self.submit_cmd(self.service.create_yarn_node_manager_remote_app_log_dir, 60,
+                            "Command Create NodeManager app dir failed")])
 
 
 class Spark_On_Yarn(Service):
@@ -462,13 +2226,16 @@ class Spark_On_Yarn(Service):
         HISTORYSERVER
         GATEWAY
     """
-    def pre_start(self):
-        self.run_cmd(self.service._cmd, 60, "Command CreateSparkUserDir failed",
-                     'CreateSparkUserDirCommand', api_version=7)
+    dependencies = ['Yarn']
 
-        self.run_cmd(self.service._cmd, 60, "Command CreateSparkHistoryDirCommand failed",
-                     'CreateSparkHistoryDirCommand', api_version=7)
+    def pre_start(self):
+        wait_all([
+            self.submit_cmd(self.service._cmd, 60, "Command CreateSparkUserDir failed",
+                            'CreateSparkUserDirCommand', api_version=7),
+            self.submit_cmd(self.service._cmd, 60, "Command CreateSparkHistoryDirCommand failed",
+                            'CreateSparkHistoryDirCommand', api_version=7)])
 
+        # The jar is uploaded under the spark user dir
         self.run_cmd(self.service._cmd, 60, "Command SparkUploadJarServiceCommand failed",
                      'SparkUploadJarServiceCommand', api_version=7)
 
@@ -481,6 +2248,8 @@ class Hbase(Service):
         HBASETHRIFTSERVER
         GATEWAY
     """
+    dependencies = ['Zookeeper', 'Hdfs']
+
     def pre_start(self):
         self.run_cmd(self.service.create_hbase_root, 60, "Command CreateHbaseRoot failed")
 
@@ -493,6 +2262,8 @@ class Hive(Service):
         WEBHCAT
         GATEWAY
     """
+    dependencies = ['Zookeeper', 'Yarn', 'Spark_On_Yarn']
+
     def pre_start(self):
         self.run_cmd(self.service.create_hive_warehouse, 60, "Command CreateHiveWarehouse failed")
 
@@ -514,6 +2285,8 @@ class Impala(Service):
         CATALOGSERVER
         IMPALAD
     """
+    dependencies = ['Hdfs', 'Hive', 'Hbase']
+
     def pre_start(self):
         self.run_cmd(self.service.create_impala_user_dir, 60, "Command CreateImpalaUserDir failed")
 
@@ -523,6 +2296,7 @@ class Flume(Service):
     Service Role Groups:
         AGENT
     """
+    dependencies = ['Hdfs', 'Hbase']
 
 
 class Oozie(Service):
@@ -530,6 +2304,8 @@ class Oozie(Service):
     Service Role Groups:
         OOZIE_SERVER
     """
+    dependencies = ['Zookeeper', 'Yarn', 'Hive']
+
     def pre_start(self):
         self.run_cmd(self.service.create_oozie_db, 300, "Command CreateOozieSchema failed")
 
@@ -542,11 +2318,14 @@ class Sqoop(Service):
     Service Role Groups:
         SQOOP_SERVER
     """
+    dependencies = ['Yarn']
+
     def pre_start(self):
-        self.run_cmd(self.service.create_sqoop_user_dir, 300,
-                     "Command CreateSqoopUserDir failed")
-        self.run_cmd(self.service.create_sqoop_database_tables, 300,
-                     "Command CreateSqoopDBTables failed")
+        wait_all([
+            self.submit_cmd(self.service.create_sqoop_user_dir, 300,
+                            "Command CreateSqoopUserDir failed"),
+            self.submit_cmd(self.service.create_sqoop_database_tables, 300,
+                            "Command CreateSqoopDBTables failed")])
 
 
 class Solr(Service):
@@ -554,10 +2333,13 @@ class Solr(Service):
     Service Role Groups:
         HUE_SERVER
     """
+    dependencies = ['Zookeeper', 'Hdfs']
+
     def pre_start(self):
-        self.run_cmd(self.service.init_solr, 300, "Command InitSolr failed")
-        self.run_cmd(self.service.create_solr_hdfs_home_dir, 300,
-                     "Command CreateSolrHdfsHomeDir failed")
+        wait_all([
+            self.submit_cmd(self.service.init_solr, 300, "Command InitSolr failed"),
+            self.submit_cmd(self.service.create_solr_hdfs_home_dir, 300,
+                            "Command CreateSolrHdfsHomeDir failed")])
 
 
 class Hue(Service):
@@ -565,6 +2347,7 @@ class Hue(Service):
     Service Role Groups:
         HUE_SERVER
     """
+    dependencies = ['Zookeeper', 'Hive', 'Hbase', 'Impala', 'Oozie', 'Sqoop', 'Solr', 'Sentry']
 
 
 class Kafka(Service):
@@ -572,6 +2355,7 @@ class Kafka(Service):
     Service Role Groups:
         KAFKA_BROKER
     """
+    dependencies = ['Zookeeper']
 
 
 class Sentry(Service):
@@ -579,11 +2363,192 @@ class Sentry(Service):
     Service Role Groups:
         SENTRY_SERVER
     """
+    dependencies = ['Zookeeper', 'Hdfs']
+
     def pre_start(self):
         self.run_cmd(self.service.create_sentry_database_tables, 300,
                      "Command CreateSentryDBTables failed")
 
 
+class ServiceScheduler(object):
+    """
+    Dependency graph scheduler for bringing up services
+
+    A service is handed off to a worker as soon as all the services it depends on have been
+    brought up, so services which don't depend on each other are brought up concurrently. At
+    most `max_workers` services are in flight at any given time.
+    """
+    def __init__(self, services, max_workers=MAX_WORKERS):
+        self.services = services
+        self.max_workers = max(1, max_workers)
+
+        names = [svc.__class__.__name__ for svc in services]
+        self.dependencies = dict((svc.__class__.__name__,
+                                  [dep for dep in svc.dependencies if dep in names])
+                                 for svc in services)
+        self.validate()
+
+    def validate(self):
+        """
+        Make sure the services don't depend on each other in a cycle, which would otherwise
+        stall the scheduler
+        """
+        resolved = set()
+        remaining = dict(self.dependencies)
+        while remaining:
+            ready = [name for name, deps in remaining.items() if set(deps) <= resolved]
+            if not ready:
+                raise Exception("Circular service dependencies between: {}".format(
+                    ', '.join(sorted(remaining))))
+            for name in ready:
+                resolved.add(name)
+                del remaining[name]
+
+    def run(self, func):
+        """
+        Run `func` for every service, honoring the dependencies between them. The first failure
+        stops any new services from being scheduled and is raised once the in flight services
+        are done.
+
+        :param func: Callable receiving a `Service` instance
+        """
+        condition = threading.Condition()
+        pending = list(self.services)
+        running = set()
+        done = set()
+        errors = []
+
+        parent = TRACER.current
+
+        def worker(svc, name):
+            with TRACER.adopt(parent):
+                try:
+                    func(svc)
+                except BaseException:  # pylint: disable=broad-except
+                    with condition:
+                        errors.append(sys.exc_info())
+                else:
+                    with condition:
+                        done.add(name)
+                        PROGRESS.progress('services', len(done), len(self.services),
+                                          unit='services')
+                finally:
+                    with condition:
+                        running.discard(name)
+                        condition.notify()
+
+        with condition:
+            while running or (pending and not errors):
+                if not errors:
+                    for svc in list(pending):
+                        if len(running) >= self.max_workers:
+                            break
+                        name = svc.__class__.__name__
+                        if set(self.dependencies[name]) <= done:
+                            pending.remove(svc)
+                            running.add(name)
+                            thread = threading.Thread(target=worker, args=(svc, name),
+                                                      name=svc.name)
+                            thread.daemon = True
+                            thread.start()
+                # Wake up periodically, an untimed wait can't be interrupted
+                condition.wait(1)
+
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+
+
+class Journal(object):
+    """
+    On disk checkpoint journal of the completed setup steps
+
+    There's one journal per cluster name. Every completed step is recorded along with a digest
+    of the part of the cluster.yaml it depends on, so a rerun skips straight past the steps
+    that already completed while a step is redone as soon as its part of the configuration
+    changes.
+    """
+    def __init__(self, path, cluster_name, config):
+        self.path = path
+        self.cluster_name = cluster_name
+        self.cm_host = config['cm']['host']
+        self.config_digest = self.digest(config)
+        self.steps = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    @staticmethod
+    def digest(section):
+        """
+        :param section: Any part of the cluster configuration
+        :return: Stable hash of the configuration
+        """
+        return hashlib.sha1(json.dumps(section, sort_keys=True, default=str)).hexdigest()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as journal:
+                data = json.load(journal)
+        except (IOError, ValueError):
+            print_json(type="JOURNAL", msg="Ignoring unreadable journal {}".format(self.path))
+            return
+        if data.get('cluster') != self.cluster_name:
+            return
+        self.steps = data.get('steps', {})
+        if data.get('config') != self.config_digest:
+            print_json(type="JOURNAL",
+                       msg="cluster.yaml changed since the last run, rechecking changed steps")
+
+    def save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Write to a temporary file first so that an interrupted write can't corrupt the journal
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as journal:
+            json.dump({'cluster': self.cluster_name, 'config': self.config_digest,
+                       'steps': self.steps}, journal, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def _key(self, section):
+        return self.digest({'cm': self.cm_host, 'section': section})
+
+    def done(self, step, section):
+        """
+        :param step: Name of the step
+        :param section: Part of the configuration the step depends on
+        :return: True if the step completed with the same configuration
+        """
+        with self._lock:
+            return self.steps.get(step) == self._key(section)
+
+    def record(self, step, section):
+        """
+        Record a step as completed
+
+        :param step: Name of the step
+        :param section: Part of the configuration the step depends on
+        """
+        with self._lock:
+            self.steps[step] = self._key(section)
+            self.save()
+
+    def forget(self, steps):
+        """
+        Drop completed steps from the journal so that they run again
+
+        :param steps: Names of the steps
+        """
+        with self._lock:
+            for step in steps:
+                self.steps.pop(step, None)
+            self.save()
+
+
 class ClouderaManager(object):
     """
     The complete orchestration of a cluster from start to finish assuming all the hosts are
@@ -594,22 +2559,52 @@ class ClouderaManager(object):
     __class__.setup()
     """
 
-    def __init__(self, module, config, trial=False, license_txt=None):
+    def __init__(self, module, config, trial=False, license_txt=None, max_workers=MAX_WORKERS,
+                 journal_dir=None, trace_file=None, progress_file=None, limiter=None,
+                 cm_lock=None, scale_out=False, ledger_file=None, call_budget=None):
         self.config = config
         self.module = module
         self.trial = trial
         self.license_txt = license_txt
+        self.max_workers = max_workers
+        self.trace_file = trace_file
+        self.progress_file = progress_file
+        self.limiter = limiter
+        self.scale_out = scale_out
+        self.ledger_file = ledger_file
+        self.call_budget = call_budget
+        # Held while changing anything that belongs to CM rather than to the cluster
+        self.cm_lock = cm_lock or threading.Lock()
         self.cluster = None
+        self.journal_dir = journal_dir
+        self.journal = Journal(
+            journal_dir and os.path.join(journal_dir, '{}.json'.format(config['cluster']['name'])),
+            config['cluster']['name'], config)
         self._api = None
         self._manager = None
+        self._hosts = None
+        self._state = None
 
     @property
     def api(self):
         if self._api is None:
+            use_tls = self.config['cm'].get('tls', False)
+            ssl_context = ssl.create_default_context() if use_tls else None
             self._api = ApiResource(self.config['cm']['host'],
                                     username=self.config['cm']['username'],
                                     password=self.config['cm']['password'],
-                                    use_tls=self.config['cm'].get('tls', False))
+                                    server_port=self.config['cm'].get('port'),
+                                    use_tls=use_tls,
+                                    preemptive_auth=True,
+                                    ssl_context=ssl_context,
+                                    timeout=HTTP_TIMEOUT)
+            # Send all the requests over pooled keep-alive connections, the credentials go
+            # along with every request thru the preemptive auth header. The pooled client keeps
+            # the timeout and the TLS context of the cm_api client.
+            self._api._client = PooledHttpClient(self._api.base_url, self._api._client._headers,
+                                                 ssl_context=ssl_context,
+                                                 timeout=self._api._client._timeout,
+                                                 limiter=self.limiter)
         return self._api
 
     @property
@@ -618,6 +2613,79 @@ class ClouderaManager(object):
             self._manager = self.api.get_cloudera_manager()
         return self._manager
 
+    @property
+    def hosts(self):
+        if self._hosts is None:
+            self._hosts = HostIndex(self.api)
+        return self._hosts
+
+    @property
+    def state(self):
+        if self._state is None:
+            self._state = ClusterState(self.cluster)
+        return self._state
+
+    def checkpoint(self, step, section, func, *args):
+        """
+        Run a setup step unless the journal shows it already completed with the same
+        configuration
+
+        :param step: Name of the step
+        :param section: Part of the configuration the step depends on
+        :param func: Callable performing the step
+        """
+        with TRACER.span(step, cat='step') as span:
+            if self.journal.done(step, section):
+                if self.step_holds(step):
+                    print_json(type="JOURNAL", msg="Skipping completed step: {}".format(step))
+                    span.finish('skipped')
+                    PROGRESS.emit('step', step=step, status='skipped')
+                    return
+                print_json(type="JOURNAL",
+                           msg="Completed step {} no longer holds in CM, running it again".format(
+                               step))
+                self.journal.forget(self.depending_steps(step))
+            PROGRESS.emit('step', step=step, status='started')
+            func(*args)
+            PROGRESS.emit('step', step=step, status='done')
+        self.journal.record(step, section)
+
+    def step_holds(self, step):
+        """
+        Check that the outcome of a completed step is still there in CM. The journal can't tell
+        when CM was reset or the cluster deleted since the step completed.
+
+        :param step: Name of the step
+        :return: False if the step has to run again
+        """
+        try:
+            if step == 'license':
+                self.manager.get_license()
+            elif step == 'cluster':
+                self.cluster = self.api.get_cluster(self.config['cluster']['name'])
+            elif step == 'parcels':
+                return all(self.cluster.get_parcel(parcel_cfg.get('product', 'CDH'),
+                                                   parcel_cfg.get('version')).stage
+                           in PARCEL_ACTIVATED for parcel_cfg in self.config['parcels'])
+            elif step == 'mgmt':
+                self.manager.get_service()
+        except ApiException:
+            return False
+        return True
+
+    def depending_steps(self, step):
+        """
+        :param step: Name of the step
+        :return: Names of the journaled steps to run again along with the step
+        """
+        if step.startswith('service:') and step.endswith(':start'):
+            # The post start actions of a service are run again whenever it's started again
+            return [step, step[:-len('start')] + 'post_start']
+        if step != 'cluster':
+            return [step]
+        # Everything but the license and the Management services lives within the cluster
+        return [name for name in list(self.journal.steps) if name not in ('license', 'mgmt')]
+
     def enable_license(self):
         """
         Enable the requested license, either it's trial mode or a full license is entered and
@@ -658,41 +2726,130 @@ class ClouderaManager(object):
                                                    cluster_config['version'],
                                                    cluster_config['fullVersion'])
 
-        cluster_hosts = [self.api.get_host(host.hostId).hostname
-                         for host in self.cluster.list_hosts()]
-        hosts = []
-        for host in cluster_config['hosts']:
-            if host not in cluster_hosts:
-                hosts.append(host)
-        self.cluster.add_hosts(hosts)
+        cluster_hosts = set(self.hosts.hostname(host.hostId)
+                            for host in self.cluster.list_hosts())
+        hosts = [self.hosts.host_id(host) for host in cluster_config['hosts']
+                 if self.hosts.hostname(host) not in cluster_hosts]
+        if hosts:
+            self.cluster.add_hosts(hosts)
 
     def activate_parcels(self):
+        """
+        Download, distribute and activate all the parcels. The parcels are staged side by side,
+        all the downloads are started at once and each parcel moves on to its next stage as
+        soon as the previous one completes, without waiting on the other parcels.
+        """
         print_json(type="PARCELS", msg="Setting up parcels")
-        for parcel_cfg in self.config['parcels']:
-            parcel = Parcels(self.module, self.manager, self.cluster,
-                             parcel_cfg.get('version'), parcel_cfg.get('repo'),
-                             parcel_cfg.get('product', 'CDH'))
-            parcel.download()
-            parcel.distribute()
-            parcel.activate()
-
-    @retry(attempts=20, delay=5)
-    def wait_inspect_hosts(self, cmd):
+        cm_config = self.config['cm']
+        tuner = DistributionTuner(
+            self.manager, len(self.config['cluster']['hosts']), cm_config.get('nic_mbps'),
+            self.journal_dir and os.path.join(self.journal_dir, 'parcel-distribution.json'),
+            '{}:{}'.format(cm_config['host'], cm_config.get('port') or 7180), self.cm_lock)
+        pending = [Parcels(self.module, self.manager, self.cluster,
+                           parcel_cfg.get('version'), parcel_cfg.get('repo'),
+                           parcel_cfg.get('product', 'CDH'), self.cm_lock,
+                           cm_config.get('parcel_mirror'), tuner)
+                   for parcel_cfg in self.config['parcels']]
+
+        poll = Poll('parcel', deadline=PARCEL_TIMEOUT * max(1, len(pending)))
+        error = None
+        try:
+            while True:
+                stages = [parcel.stage for parcel in pending]
+                activated = []
+                for parcel in pending:
+                    try:
+                        activated.append(poll.work(parcel.advance))
+                    except (ApiException, httplib.HTTPException, socket.error) as e:
+                        # CM being briefly busy or unreachable doesn't stop the staging, the
+                        # parcel is polled again until the deadline
+                        print_json(type="PARCELS",
+                                   msg="Polling {}-{} failed, retrying: {}".format(
+                                       parcel.product, parcel.version, e))
+                        error = e
+                        activated.append(False)
+                # Poll quickly again whenever a parcel moved on to its next stage
+                if stages != [parcel.stage for parcel in pending]:
+                    poll.reset()
+                pending = [parcel for parcel, done in zip(pending, activated) if not done]
+                if not pending:
+                    break
+                if not poll.sleep():
+                    fail(self.module, "Timed out staging parcels: {}{}".format(
+                        ', '.join('{}-{}'.format(parcel.product, parcel.version)
+                                  for parcel in pending),
+                        '. Last error: {}'.format(error) if error is not None else ''))
+        finally:
+            # Later distributions on the CM, e.g. of other clusters or manual ones, go at the
+            # settings of CM again
+            tuner.restore()
+        tuner.save()
+
+    def inspect_hosts(self):
         """
-        Inspect all the hosts. Basically wait till the check completes on all hosts.
+        Start inspecting all the hosts, without waiting for the inspection to complete
 
-        :param cmd: A command instance used for tracking the status of the command
+        :return: `CommandFuture` of the inspection
         """
         print_json(type="HOSTS", msg="Inspecting hosts")
-        cmd = cmd.fetch()
-        if cmd.success is None:
-            raise ApiException("Waiting on command {} to finish".format(cmd))
-        elif not cmd.success:
-            if (cmd.resultMessage is not None and
-                    'is not currently available for execution' in cmd.resultMessage):
-                raise ApiException('Retry Command')
-            fail(self.module, 'Host inspection failed')
-        print_json(type="HOSTS", msg="Host inspection completed: {}".format(cmd.resultMessage))
+        return COMMANDS.submit(self.manager.inspect_hosts, 'HOSTS',
+                               POLL_POLICIES['inspect_hosts'].deadline, 'Host inspection failed')
+
+    def wait_inspect_hosts(self, inspection=None):
+        """
+        Wait till the inspection completes on all hosts and report the problems the inspection
+        of each host reported, see `inspection_report`. The problems are reported as warnings,
+        only an inspection that couldn't complete fails the setup.
+
+        :param inspection: `CommandFuture` of an inspection started earlier, started now if None
+        :return: List of the per host results, see `inspection_report`
+        """
+        cmd = (inspection or self.inspect_hosts()).result()
+        if not cmd.success:
+            fail(self.module, 'Host inspection failed. {}'.format(cmd.resultMessage))
+
+        report = self.inspection_report(cmd)
+        failing = [host for host in report if host['problems']]
+        TRACER.annotate(hosts=len(report), failing_hosts=len(failing))
+        PROGRESS.emit('inspection', hosts=report)
+        # Group the hosts by problem, the same problem usually shows up on many hosts
+        problems = {}
+        for host in failing:
+            for problem in host['problems']:
+                problems.setdefault(problem, []).append(host['host'])
+        for problem, hosts in sorted(problems.items(), key=lambda item: -len(item[1])):
+            print_json(type="HOSTS", msg="{} hosts: {}".format(len(hosts), problem),
+                       hosts=sorted(hosts))
+        print_json(type="HOSTS", msg="Host inspection completed on {} hosts, {} reported "
+                                     "problems".format(len(report), len(failing)))
+        if getattr(cmd, 'resultDataUrl', None):
+            print_json(type="HOSTS", msg="The results of all the inspector checks are at "
+                                         "{}".format(cmd.resultDataUrl))
+        return report
+
+    def inspection_report(self, cmd):
+        """
+        Best-effort summary of the inspection per host, made from the result messages of the
+        child commands of the hosts. The checks of the host inspector themselves are only in the
+        result data of the command, at its resultDataUrl, and the message of a host may just
+        tell that the inspector found problems rather than list them.
+
+        :param cmd: Completed host inspection `ApiCommand`, with a child command per host
+        :return: List of dictionaries with the hostname and the problems reported by the
+                 inspection of every inspected host, none for the hosts that succeeded
+        """
+        report = []
+        for child in cmd.children or []:
+            host_ref = getattr(child, 'hostRef', None)
+            if host_ref is None:
+                continue
+            problems = []
+            if not child.success:
+                # A message listing problems has a summary line followed by a line per problem
+                lines = [line.strip() for line in (child.resultMessage or '').splitlines()]
+                problems = [line for line in lines[1:] if line] or lines[:1]
+            report.append({'host': self.hosts.hostname(host_ref.hostId), 'problems': problems})
+        return sorted(report, key=lambda host: host['host'])
 
     def deploy_mgmt_services(self):
         """
@@ -707,12 +2864,13 @@ class ClouderaManager(object):
             print_json(type="MGMT", msg="Management Services don't exist. Creating.")
             mgmt = self.manager.create_mgmt_service(ApiServiceSetupInfo())
 
-        for role in config['services']['MGMT']['roles']:
+        for role in self.config['services']['MGMT']['roles']:
             if not len(mgmt.get_roles_by_type(role['group'])) > 0:
                 print_json(type="MGMT", msg="Creating role for {}".format(role['group']))
-                mgmt.create_role('{}-1'.format(role['group']), role['group'], role['hosts'][0])
+                mgmt.create_role('{}-1'.format(role['group']), role['group'],
+                                 self.hosts.host_id(role['hosts'][0]))
 
-        for role in config['services']['MGMT']['roles']:
+        for role in self.config['services']['MGMT']['roles']:
             role_group = mgmt.get_role_config_group('mgmt-{}-BASE'.format(role['group']))
             role_group.update_config(role.get('config', {}))
 
@@ -722,68 +2880,508 @@ class ClouderaManager(object):
         else:
             fail(self.module, "[MGMT] Cloudera Management services didn't start up properly")
 
+    def services(self, services):
+        """
+        :param services: List of `Service` subclass names
+        :return: List of `Service` instances for the services in the cluster configuration
+        """
+        service_classes = []
+        for service in services:
+            service_config = self.config['services'].get(service.upper())
+            if service_config:
+                service_classes.append(getattr(sys.modules[__name__], service)(
+                    self.cluster, service_config, hosts=self.hosts, state=self.state))
+        return service_classes
+
     def service_orchestrate(self, services):
         """
         Create, pre-configure provided list of services
-        Stop/Start those services
+        Start those services
         Perform and post service startup actions
 
+        Services are brought up concurrently as soon as all the services they depend on are
+        running.
+
         :param services: List of Services to perform service specific actions
         """
-        service_classes = []
+        service_classes = self.services(services)
+        print_json(type="CLUSTER", msg="Starting services: {} on Cluster".format(
+            [svc.name for svc in service_classes]))
+        ServiceScheduler(service_classes, self.max_workers).run(self.bring_up)
 
-        # Create and pre-configure provided services
-        for service in services:
-            service_config = self.config['services'].get(service.upper())
-            if service_config:
-                svc = getattr(sys.modules[__name__], service)(self.cluster, service_config)
-                if not svc.started:
-                    svc.deploy()
-                    svc.pre_start()
-                service_classes.append(svc)
+    def bring_up(self, svc):
+        """
+        Deploy, configure and start a single service
 
-        print_json(type="CLUSTER", msg="Starting services: {} on Cluster".format(services))
+        :param svc: `Service` instance
+        """
+        steps = [('deploy', svc.deploy),
+                 ('pre_start', svc.pre_start),
+                 ('client_config', svc.deploy_client_config),
+                 ('start', svc.start),
+                 ('post_start', svc.post_start)]
+        steps = [('service:{}:{}'.format(svc.name, step), func) for step, func in steps]
+
+        with TRACER.span(svc.name, cat='service') as span:
+            resumed = any(self.journal.done(step, svc.config) for step, _ in steps)
+            if resumed and svc.state.service(svc.name) is None:
+                print_json(type="JOURNAL", msg="Service {} no longer exists in CM, deploying it "
+                                               "again".format(svc.name))
+                self.journal.forget([step for step, _ in steps])
+                resumed = False
+            start = 'service:{}:start'.format(svc.name)
+            if resumed and self.journal.done(start, svc.config) and not svc.started:
+                # Like without a journal, a service which was stopped or crashed since is started
+                print_json(type="JOURNAL", msg="Service {} is no longer started, starting it "
+                                               "again".format(svc.name))
+                self.journal.forget(self.depending_steps(start))
+            # Without a journal, only go thru the steps if the service is not yet started. This
+            # helps with re-running the script after fixing errors
+            if not resumed and svc.started:
+                span.finish('skipped')
+                return
 
-        # Deploy all the client configs, since some of the services depend on other services
-        # and is essential that the client configs are in place
-        try:
-            execute_cmd(self.cluster.deploy_client_config, "CLUSTER", 30, "Failed deploying client configs")
-        except ApiException:
-            # Sometimes the deploy client configs cannot be run, but we can safely ignore them
-            pass
+            for step, func in steps:
+                self.checkpoint(step, svc.config, func)
+
+    def add_roles(self, svc):
+        """
+        Add the missing roles of an existing service and start only those
 
-        # Start each service and run the post_start actions for each service
-        for svc in service_classes:
-            # Only go thru the steps if the service is not yet started. This helps with
-            # re-running the script after fixing errors
-            if not svc.started:
-                svc.start()
-                svc.post_start()
+        :param svc: `Service` instance
+        """
+        with TRACER.span(svc.name, cat='service') as span:
+            if svc.state.service(svc.name) is None:
+                print_json(type=svc.name, msg="Service doesn't exist, skipping it in scale out "
+                                              "mode. Run the full setup to add services.")
+                span.finish('skipped')
+                return
+            span.args['roles'] = len(svc.scale_out())
 
     def setup(self):
+        PROGRESS.open(self.progress_file)
+        PROGRESS.emit('start', cluster=self.config['cluster']['name'])
+        try:
+            with TRACER.span('scale_out' if self.scale_out else 'setup',
+                             cluster=self.config['cluster']['name']) as span:
+                if self.scale_out:
+                    self._scale_out()
+                else:
+                    self._setup()
+        finally:
+            PROGRESS.emit('finish', outcome=span.args.get('outcome', 'ok'),
+                          duration=round(span.duration, 1))
+            PROGRESS.close()
+            POLL_STATS.report()
+            if self._api is not None:
+                self._api._client.report()
+                self._api._client.ledger.report(self.ledger_file)
+            TRACER.report()
+            if self.trace_file:
+                TRACER.export(self.trace_file)
+
+        # Fail a run, e.g. in CI, when a change made the setup call the CM API more often
+        if self.call_budget and self._api is not None:
+            overruns = self._api._client.ledger.over_budget(self.call_budget)
+            if overruns:
+                fail(self.module, "More CM API calls than the budget in {} allows: {}".format(
+                    self.call_budget, '; '.join(overruns)))
+
+    def _setup(self):
+        cluster_config = self.config['cluster']
+        hosts = sorted(cluster_config['hosts'])
+
         # Enable a full license or start a trial
-        self.enable_license()
+        with self.cm_lock:
+            self.checkpoint('license', {'trial': self.trial,
+                                        'license': Journal.digest(self.license_txt)},
+                            self.enable_license)
 
         # Create the cluster entity and associate hosts
-        self.create_cluster()
+        self.checkpoint('cluster', cluster_config, self.create_cluster)
+
+        # Inspect all the hosts while the parcels are staged, the inspection doesn't depend on
+        # the parcels and only has to complete before any services are deployed
+        inspection = None
+        if not self.journal.done('inspect_hosts', hosts):
+            inspection = self.inspect_hosts()
 
         # Download and activate the parcels
-        self.activate_parcels()
+        self.checkpoint('parcels', {'parcels': self.config['parcels'], 'hosts': hosts},
+                        self.activate_parcels)
+
+        self.checkpoint('inspect_hosts', hosts, self.wait_inspect_hosts, inspection)
+
+        # Create Management services, which are shared by all the clusters of CM
+        with self.cm_lock:
+            self.checkpoint('mgmt', self.config['services']['MGMT'], self.deploy_mgmt_services)
+
+        # Configure and Start all the services, following the dependencies between them
+        with TRACER.span('services'):
+            self.service_orchestrate(BASE_SERVICES + ADDITIONAL_SERVICES)
+
+    def _scale_out(self):
+        """
+        Add the hosts of the cluster.yaml that are not part of the cluster yet, along with their
+        roles. Only the new hosts are added and get the parcels, and only the new roles get
+        client configs and are started, so none of the running services is restarted or
+        reconfigured.
+        """
+        cluster_config = self.config['cluster']
+        try:
+            self.cluster = self.api.get_cluster(cluster_config['name'])
+        except ApiException:
+            fail(self.module, "Cluster {} doesn't exist, run the full setup first".format(
+                cluster_config['name']))
+
+        cluster_hosts = set(self.hosts.hostname(host.hostId)
+                            for host in self.cluster.list_hosts())
+        new_hosts = [host for host in cluster_config['hosts']
+                     if self.hosts.hostname(host) not in cluster_hosts]
+        unknown = [host for host in new_hosts if self.hosts.get(host) is None]
+        if unknown:
+            fail(self.module, "Hosts not registered with CM: {}".format(', '.join(unknown)))
+        print_json(type="CLUSTER", msg="Scaling out with {} new hosts".format(len(new_hosts)))
+
+        if new_hosts:
+            with TRACER.span('add_hosts', hosts=len(new_hosts)):
+                self.cluster.add_hosts([self.hosts.host_id(host) for host in new_hosts])
+            # The parcels are already activated on the existing hosts, this only waits for CM
+            # to distribute and activate them on the new hosts
+            self.checkpoint('parcels', {'parcels': self.config['parcels'],
+                                        'hosts': sorted(cluster_config['hosts'])},
+                            self.activate_parcels)
+        self.journal.record('cluster', cluster_config)
+
+        with TRACER.span('services'):
+            ServiceScheduler(self.services(BASE_SERVICES + ADDITIONAL_SERVICES),
+                             self.max_workers).run(self.add_roles)
+
+
+class ConfigError(Exception):
+    """
+    The cluster.yaml is not valid, with the list of all the problems found
+    """
+    def __init__(self, errors):
+        Exception.__init__(self, 'Invalid cluster configuration: {}'.format('; '.join(errors)))
+        self.errors = errors
+
+
+class HostList(collections.Sequence):
+    """
+    List of host names given by plain names and patterns with numeric ranges, such as
+    dn[001-480].dc1 or rack[1-4]-dn[01-40,45]. The patterns are kept as they are and a host name
+    is only worked out when it's accessed, so a cluster.yaml with thousands of hosts stays small.
+    """
+    RANGE = re.compile(r'\[([0-9,\-]+)\]')
+
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self.patterns = [self.parse(entry) for entry in self.entries]
+        self.sizes = [self.size(pattern) for pattern in self.patterns]
+
+    @classmethod
+    def parse(cls, entry):
+        """
+        :param entry: Host name or pattern
+        :return: List of the literal parts and of the lists of (start, end, width) ranges
+        """
+        pattern = []
+        position = 0
+        for match in cls.RANGE.finditer(entry):
+            pattern.append(entry[position:match.start()])
+            ranges = []
+            for item in match.group(1).split(','):
+                start, _, end = item.partition('-')
+                if not start.isdigit() or (end and not end.isdigit()):
+                    raise ValueError("Invalid range '{}' in {}".format(item, entry))
+                end = end or start
+                if int(end) < int(start):
+                    raise ValueError("Empty range '{}' in {}".format(item, entry))
+                width = len(start) if start.startswith('0') and len(start) > 1 else 0
+                ranges.append((int(start), int(end), width))
+            pattern.append(ranges)
+            position = match.end()
+        pattern.append(entry[position:])
+        # Host names can't have brackets, what's left of them is a range that didn't parse
+        for part in pattern[::2]:
+            invalid = re.search(r'\[[^\]]*\]?|\]', part)
+            if invalid:
+                raise ValueError("Invalid range '{}' in {}".format(invalid.group(0), entry))
+        return pattern
+
+    @staticmethod
+    def size(pattern):
+        size = 1
+        for part in pattern:
+            if isinstance(part, list):
+                size *= sum(end - start + 1 for start, end, _ in part)
+        return size
+
+    @staticmethod
+    def name(pattern, index):
+        """
+        :return: The host name at the given index of the hosts matching a pattern
+        """
+        parts = []
+        for part in reversed(pattern):
+            if not isinstance(part, list):
+                parts.append(part)
+                continue
+            index, offset = divmod(index, sum(end - start + 1 for start, end, _ in part))
+            for start, end, width in part:
+                if offset <= end - start:
+                    parts.append(str(start + offset).zfill(width))
+                    break
+                offset -= end - start + 1
+        return ''.join(reversed(parts))
+
+    @classmethod
+    def matches(cls, pattern, host):
+        """
+        :return: Whether the host name is one of the hosts of a pattern, found without listing them
+        """
+        if not pattern:
+            return not host
+        part = pattern[0]
+        if not isinstance(part, list):
+            return host.startswith(part) and cls.matches(pattern[1:], host[len(part):])
+        digits = len(host) - len(host.lstrip('0123456789'))
+        # Adjacent ranges, as in dn[1-2][0-9], can split the digits at any point
+        for length in range(1, digits + 1):
+            number = host[:length]
+            if any(start <= int(number) <= end and str(int(number)).zfill(width) == number
+                   for start, end, width in part) and cls.matches(pattern[1:], host[length:]):
+                return True
+        return False
+
+    def __len__(self):
+        return sum(self.sizes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        for pattern, size in zip(self.patterns, self.sizes):
+            if 0 <= index < size:
+                return self.name(pattern, index)
+            index -= size
+        raise IndexError('Host index out of range')
+
+    def __iter__(self):
+        for pattern, size in zip(self.patterns, self.sizes):
+            for index in range(size):
+                yield self.name(pattern, index)
+
+    def __contains__(self, host):
+        return any(self.matches(pattern, host) for pattern in self.patterns)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        # Used for the journal digests, so the patterns are hashed rather than every host
+        return json.dumps(self.entries)
+
+    __repr__ = __str__
+
+
+def validate_config(value, schema, path='', errors=None):
+    """
+    Check a part of the cluster configuration against its schema, see CONFIG_SCHEMA
 
-        # Inspect all the hosts
-        self.wait_inspect_hosts(self.manager.inspect_hosts())
+    :return: List of all the problems found
+    """
+    errors = [] if errors is None else errors
+    if isinstance(schema, dict):
+        if not isinstance(value, dict):
+            errors.append('{} should be a mapping'.format(path or 'The document'))
+            return errors
+        for key, sub_schema in schema.items():
+            if not key.startswith('?') and key != '*' and key not in value:
+                errors.append('{}.{} is missing'.format(path, key).lstrip('.'))
+        for key, item in value.items():
+            sub_schema = schema.get(key, schema.get('?{}'.format(key)))
+            if sub_schema is None and '*' in schema:
+                print_json(type="CONFIG", msg="{}.{} is not known, skipping it".format(
+                    path, key).lstrip('.'))
+            elif sub_schema is None:
+                errors.append('{}.{} is not a known setting'.format(path, key).lstrip('.'))
+            else:
+                validate_config(item, sub_schema, '{}.{}'.format(path, key).lstrip('.'), errors)
+    elif isinstance(schema, list):
+        if not isinstance(value, (list, HostList)):
+            errors.append('{} should be a list'.format(path))
+            return errors
+        for i, item in enumerate(value):
+            validate_config(item, schema[0], '{}[{}]'.format(path, i), errors)
+    elif not isinstance(value, schema) or (schema is int and isinstance(value, bool)):
+        errors.append('{} should be {}, not {!r}'.format(path, ' or '.join(
+            'str' if t is basestring else t.__name__
+            for t in (schema if isinstance(schema, tuple) else (schema,))), value))
+    return errors
+
+
+def load_config(path):
+    """
+    Load, expand and validate a cluster.yaml. The whole document is checked up front, so that
+    a typo in the last service fails the run before anything is set up rather than once that
+    service is reached.
+
+    :param path: Location of the cluster.yaml
+    :return: Cluster configuration, with the host lists as `HostList` instances
+    """
+    with open(path, 'r') as cluster_yaml:
+        config = yaml.load(cluster_yaml, Loader=YAML_LOADER)
+    # YAML reads a password made of digits as a number, which CM takes as its text
+    cm_config = config.get('cm') if isinstance(config, dict) else None
+    if isinstance(cm_config, dict) and isinstance(cm_config.get('password'), (int, long, float)):
+        cm_config['password'] = str(cm_config['password'])
+    errors = validate_config(config, CONFIG_SCHEMA)
+    if errors:
+        raise ConfigError(errors)
+
+    def expand(hosts, where):
+        try:
+            return HostList(hosts)
+        except ValueError as e:
+            errors.append('{}: {}'.format(where, e))
+            return hosts
+
+    config['cluster']['hosts'] = expand(config['cluster']['hosts'], 'cluster.hosts')
+    services = CONFIG_SCHEMA['services']
+    for name, service in sorted(config['services'].items()):
+        if name not in services and '?' + name not in services:
+            continue
+        for i, role in enumerate(service['roles']):
+            where = 'services.{}.roles[{}].hosts'.format(name, i)
+            role['hosts'] = expand(role['hosts'], where)
+            if not role['hosts']:
+                errors.append('{} is empty'.format(where))
+            # The management services can run on hosts outside of the cluster, e.g. the CM node
+            unknown = [host for host in role['hosts'] if host not in config['cluster']['hosts']]
+            if name != 'MGMT' and unknown:
+                errors.append('{} are not in cluster.hosts: {}'.format(
+                    where, ', '.join(unknown[:5]) + (', ...' if len(unknown) > 5 else '')))
+    if errors:
+        raise ConfigError(errors)
+    return config
+
+
+def cluster_path(path, name):
+    """
+    :param path: Location of an output file, or unix:<path> of a socket
+    :param name: Cluster name
+    :return: Variant of the location for a single cluster, e.g. cdh-trace-<name>.json
+    """
+    if not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{}-{}{}'.format(root, name, ext)
 
-        # Create Management services
-        self.deploy_mgmt_services()
 
-        # Configure and Start base services
-        # Note: The base services needs to be started one at a time, since there's
-        # a dependency of services in the specified order
-        for service in BASE_SERVICES:
-            self.service_orchestrate([service])
+def provision_cluster(config, options, limiter, cm_lock, results):
+    """
+    Set up a single cluster, in one of the processes started by `provision`
 
-        # Configure and Start remaining services
-        self.service_orchestrate(ADDITIONAL_SERVICES)
+    :param options: Keyword arguments for `ClouderaManager`
+    :param results: Queue receiving the outcome of the setup
+    """
+    name = config['cluster']['name']
+    # Write out whole lines, the output of all the clusters goes to the same stdout
+    sys.stdout = os.fdopen(os.dup(sys.stdout.fileno()), 'w', 1)
+    _print_fields['cluster'] = name
+
+    result = {'cluster': name, 'outcome': 'ok'}
+    started = time.time()
+    cm = None
+    try:
+        cm = ClouderaManager(None, config, limiter=limiter, cm_lock=cm_lock,
+                             trace_file=cluster_path(options.get('trace_file'), name),
+                             progress_file=cluster_path(options.get('progress_file'), name),
+                             ledger_file=cluster_path(options.get('ledger_file'), name),
+                             **dict((key, value) for key, value in options.items()
+                                    if key not in ('trace_file', 'progress_file', 'ledger_file')))
+        cm.setup()
+    except SystemExit:
+        # The reason was already printed by `fail`
+        result['outcome'] = 'failed'
+    except Exception as e:
+        result.update(outcome='failed', error=str(e))
+        print_json(msg="Error creating cluster {}".format(e))
+    finally:
+        result['duration'] = round(time.time() - started, 1)
+        if cm is not None and cm._api is not None:
+            result['requests'] = cm._api._client.stats['requests']
+        results.put(result)
+
+
+def provision(configs, max_clusters=MAX_CLUSTERS, cm_rate=CM_RATE, **options):
+    """
+    Provision several clusters side by side, each one in its own process, so that the whole
+    run takes about as long as the slowest cluster. The clusters set up against the same CM
+    share a cap on the request rate to it, and take turns changing the settings of CM itself.
+
+    :param configs: List of cluster configurations
+    :param max_clusters: Maximum number of clusters provisioned at the same time
+    :param cm_rate: Maximum number of requests per second to a single CM, 0 for no limit
+    :param options: Keyword arguments for `ClouderaManager`
+    :return: List of the outcome of every cluster
+    """
+    limiters = {}
+    locks = {}
+    for config in configs:
+        key = (config['cm']['host'], config['cm'].get('port'))
+        if key not in locks:
+            locks[key] = multiprocessing.Lock()
+            limiters[key] = RateLimiter(cm_rate) if cm_rate else None
+
+    print_json(type="CLUSTERS", msg="Provisioning clusters: {}".format(
+        [config['cluster']['name'] for config in configs]))
+    # Anything still buffered would otherwise be written out again by every process
+    sys.stdout.flush()
+
+    queue = multiprocessing.Queue()
+    pending = list(configs)
+    running = []
+    results = {}
+    started = time.time()
+    while pending or running:
+        while pending and len(running) < max(1, max_clusters):
+            config = pending.pop(0)
+            key = (config['cm']['host'], config['cm'].get('port'))
+            process = multiprocessing.Process(
+                target=provision_cluster, name=config['cluster']['name'],
+                args=(config, options, limiters[key], locks[key], queue))
+            process.start()
+            running.append(process)
+        running[0].join(1)
+        while not queue.empty():
+            result = queue.get()
+            results[result['cluster']] = result
+        for process in [process for process in running if not process.is_alive()]:
+            running.remove(process)
+            if process.name not in results:
+                process.join()
+                results[process.name] = {'cluster': process.name, 'outcome': 'failed',
+                                         'error': 'exit code {}'.format(process.exitcode)}
+    elapsed = time.time() - started
+
+    results = [results[config['cluster']['name']] for config in configs]
+    for result in results:
+        print_json(type="CLUSTERS", msg="{}: {} in {}s, {} CM requests{}".format(
+            result['cluster'], result['outcome'], result.get('duration', '-'),
+            result.get('requests', '-'),
+            '. {}'.format(result['error']) if result.get('error') else ''))
+    print_json(type="CLUSTERS", msg="Provisioned {} clusters in {:.1f}s, the cluster setups "
+                                    "took {:.1f}s in total".format(
+                                        len(results), elapsed,
+                                        sum(result.get('duration', 0) for result in results)))
+    return results
 
 
 if __name__ == '__main__':
@@ -793,7 +3391,19 @@ if __name__ == '__main__':
         argument_spec = dict(
             template=dict(type='str', default='/opt/cluster.yaml'),
             trial=dict(type='bool', default=False),
-            license_txt=dict(type='str', default='')
+            license_txt=dict(type='str', default=''),
+            max_workers=dict(type='int', default=MAX_WORKERS),
+            journal_dir=dict(type='str', default=JOURNAL_DIR),
+            trace_file=dict(type='str', default=TRACE_FILE),
+            progress_file=dict(type='str', default=PROGRESS_FILE),
+            templates=dict(type='list', default=[]),
+            max_clusters=dict(type='int', default=MAX_CLUSTERS),
+            # Requests per second to a single CM. By default only several clusters provisioned
+            # side by side are capped, at CM_RATE, and a single cluster isn't. 0 for no cap.
+            cm_rate=dict(type='float', default=None),
+            scale_out=dict(type='bool', default=False),
+            ledger_file=dict(type='str', default=LEDGER_FILE),
+            call_budget=dict(type='str', default='')
         )
 
         module = AnsibleModule(
@@ -803,6 +3413,16 @@ if __name__ == '__main__':
         yaml_template = module.params.get('template')
         trial = module.params.get('trial')
         license_txt = module.params.get('license_txt')
+        max_workers = module.params.get('max_workers')
+        journal_dir = module.params.get('journal_dir')
+        trace_file = module.params.get('trace_file')
+        progress_file = module.params.get('progress_file')
+        templates = module.params.get('templates') or [yaml_template]
+        max_clusters = module.params.get('max_clusters')
+        cm_rate = module.params.get('cm_rate')
+        scale_out = module.params.get('scale_out')
+        ledger_file = module.params.get('ledger_file')
+        call_budget = module.params.get('call_budget')
 
         if not yaml_template:
             fail(module, msg='The cluster configuration template is not available')
@@ -811,14 +3431,44 @@ if __name__ == '__main__':
         yaml_template = 'cluster.yaml'
         trial = True
         license_txt = ''
+        max_workers = MAX_WORKERS
+        journal_dir = '.cdh-journal'
+        trace_file = 'cdh-trace.json'
+        progress_file = 'cdh-progress.ndjson'
+        templates = [yaml_template]
+        max_clusters = MAX_CLUSTERS
+        cm_rate = None
+        scale_out = False
+        ledger_file = 'cdh-calls.json'
+        call_budget = ''
 
     # Load the cluster.yaml template and create a Cloudera cluster
     try:
-        with open(yaml_template, 'r') as cluster_yaml:
-            config = yaml.load(cluster_yaml)
-        cm = ClouderaManager(module, config, trial, license_txt)
-        cm.setup()
-        if module:
-            module.exit_json(changed=True)
+        configs = [load_config(yaml_template) for yaml_template in templates]
+
+        if len(configs) == 1:
+            cm = ClouderaManager(module, configs[0], trial, license_txt, max_workers, journal_dir,
+                                 trace_file, progress_file,
+                                 limiter=RateLimiter(cm_rate) if cm_rate else None,
+                                 scale_out=scale_out, ledger_file=ledger_file,
+                                 call_budget=call_budget)
+            cm.setup()
+            if module:
+                module.exit_json(changed=True)
+        else:
+            # Provision all the clusters side by side
+            results = provision(configs, max_clusters,
+                                CM_RATE if cm_rate is None else cm_rate, trial=trial,
+                                license_txt=license_txt, max_workers=max_workers,
+                                journal_dir=journal_dir, trace_file=trace_file,
+                                progress_file=progress_file, scale_out=scale_out,
+                                ledger_file=ledger_file, call_budget=call_budget)
+            failed = [result['cluster'] for result in results if result['outcome'] != 'ok']
+            if failed:
+                fail(module, "Error creating clusters {}".format(', '.join(failed)))
+            if module:
+                module.exit_json(changed=True, clusters=results)
+    except ConfigError as e:
+        fail(module, str(e))
     except IOError as e:
         fail(module, "Error creating cluster {}".format(e))
@@ -25,6 +25,7 @@ import requests
 import re
 
 from ansible.module_utils.basic import *
+from ansible.module_utils.ambari_properties import PropertyIndex
 
 from datetime import datetime
 import hashlib
@@ -55,19 +56,13 @@ def update_config(cluster, config_name, new_properties):
     original_sha = hashlib.sha256(json.dumps(properties)).hexdigest()
 
     """Sanitise new properties"""
-   for key in new_properties.iterkeys():
-
+    index = PropertyIndex(properties, config_name)
     new_conf=dict()
 
     for key in new_properties.iterkeys():
-      
-        property = key.replace('_', '.', 10).replace('-','.')
-        re_obj = re.compile(property)
-        for my_key in properties:
-            my_key = str(my_key)
-            if re.match(re_obj, my_key):
-                property = new_properties[key]
-                new_conf[my_key]=property
+        my_key = index.lookup(key)
+        if my_key is not None:
+            new_conf[str(my_key)] = new_properties[key]
 
     properties.update(new_conf)
     new_sha = hashlib.sha256(json.dumps(properties)).hexdigest()
@@ -0,0 +1,71 @@
+'''
+Licensed to the Apache Software Foundation (ASF) under one
+or more contributor license agreements.  See the NOTICE file
+distributed with this work for additional information
+regarding copyright ownership.  The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+# This file is part of Ansible
+
+# Matching of the recommended keys of the site_facts modules, e.g. yarn_scheduler_minimum_allocation_mb,
+# to the names of the Ambari properties, e.g. yarn.scheduler.minimum-allocation-mb. Shared by
+# sitefacts and updateconfigs.
+
+''' Keys whose Ambari property can't be found from the canonical name. Map: config type => key => property '''
+ALIASES = {
+    'zeppelin-env': {
+        'zeppelin_executor_memory': 'zeppelin.executor.mem',
+    },
+}
+
+
+def canonical(name):
+    # The recommended keys use underscores where the properties have dots or hyphens
+    return str(name).replace('.', '_').replace('-', '_').lower()
+
+
+class PropertyIndex(object):
+    """
+    Index of the properties of a single config type by canonical name, built once so that
+    every key is then looked up without going over all the properties
+    """
+
+    def __init__(self, properties, config=None):
+        self.properties = properties
+        self.aliases = ALIASES.get(config, {})
+        self.names = dict()
+        ambiguous = set()
+        for name in properties:
+            key = canonical(name)
+            if key in self.names:
+                ambiguous.add(key)
+            self.names[key] = name
+        # A canonical name shared by several properties matches none of them
+        for key in ambiguous:
+            del self.names[key]
+
+    def lookup(self, key):
+        """
+        :return: Name of the property of a recommended key, None if there is none
+        """
+        if key in self.properties:
+            return key
+        alias = self.aliases.get(key)
+        if alias is not None and alias in self.properties:
+            return alias
+        return self.names.get(canonical(key))
+
+    def get(self, key, default=None):
+        name = self.lookup(key)
+        return self.properties[name] if name is not None else default
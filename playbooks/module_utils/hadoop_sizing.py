@@ -0,0 +1,447 @@
+'''
+Licensed to the Apache Software Foundation (ASF) under one
+or more contributor license agreements.  See the NOTICE file
+distributed with this work for additional information
+regarding copyright ownership.  The ASF licenses this file
+to you under the Apache License, Version 2.0 (the
+"License"); you may not use this file except in compliance
+with the License.  You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+'''
+
+# This file is part of Ansible
+
+# Recommended Hadoop configs of a node, from its memory, cores and disks, and the split of the
+# node memory between the OS, the daemon heaps and the YARN containers. Shared by sitefacts and
+# tools/capacity_plan.py.
+
+import math
+
+''' Reserved for the OS and the agents next to the Hadoop daemons, Map: dnmemory => Reservation '''
+reservedOS = { 4:1, 8:1, 16:2, 24:2, 48:4, 64:4, 72:4, 96:6,
+                   128:8, 256:12, 512:16}
+GB = 1024
+
+''' Daemons co-located on a worker node, Map: daemon => heap in MB it needs at least and the
+    priority at which it gets memory. The daemons with a priority above YARN_PRIORITY get up to
+    their max heap before the YARN containers, the other ones only their min heap. Without a
+    max, the heap recommended for the node memory is the max. '''
+workerDaemons = {
+    'datanode': dict(min=1024, priority=90),
+    'nodemanager': dict(min=512, max=1024, priority=80),
+    'regionserver': dict(min=2048, priority=70),
+}
+YARN_PRIORITY = 50
+HEAP_ROUNDING = 256
+
+''' Share of the heap of a region server its young generation may take at most '''
+XMN_RATIO = 0.2
+
+
+def getMinContainerSize(dnmemory):
+  if (dnmemory <= 4):
+    return 256
+  elif (dnmemory <= 8):
+    return 512
+  elif (dnmemory <= 24):
+    return 1024
+  else:
+    return 2048
+  pass
+
+def getReservedOSMem(dnmemory):
+  # Reservation of the largest node size in the table that fits in dnmemory
+  sizes = [size for size in sorted(reservedOS) if size <= dnmemory]
+  if (sizes):
+    return reservedOS[sizes[-1]]
+  return 1
+
+def clip(lo, x, hi):
+    return lo if x <= lo else hi if x >= hi else x
+
+def ams_hbase_env_facts(mnmemory,dnmemory):
+    ams_hbase_env=dict()
+
+    if (mnmemory > 87):
+        ams_hbase_env['hbase_master_xmn_size']="512m"
+        ams_hbase_env['hbase_master_heapsize']="4096m"
+    elif (mnmemory > 24):
+        ams_hbase_env['hbase_master_xmn_size']="512m"
+        ams_hbase_env['hbase_master_heapsize']="2048m"
+    else:
+        ams_hbase_env['hbase_master_xmn_size']="384m"
+        ams_hbase_env['hbase_master_heapsize']="1024m"
+
+    if (dnmemory > 87):
+        ams_hbase_env['regionserver_xmn_size']="512m"
+        ams_hbase_env['hbase_regionserver_heapsize']="4094m"
+    elif (dnmemory > 24):
+        ams_hbase_env['regionserver_xmn_size']="512m"
+        ams_hbase_env['hbase_regionserver_heapsize']="2048m"
+    else:
+        ams_hbase_env['regionserver_xmn_size']="384m"
+        ams_hbase_env['hbase_regionserver_heapsize']="1024m"
+
+    return ams_hbase_env
+
+def ams_env_facts(mnmemory):
+    ams_env=dict()
+
+    if (mnmemory > 87):
+        ams_env['metrics_collector_heapsize']="4096m"
+    elif (mnmemory > 24):
+        ams_env['metrics_collector_heapsize']="2048m"
+    else:
+        ams_env['metrics_collector_heapsize']="1024m"
+
+    return ams_env
+
+def core_site_facts():
+    core_site=dict()
+    
+    core_site['fs_trash_interval']="4320"
+
+    return core_site
+
+def hive_site_facts(dnmemory):
+    hive_site=dict()
+
+    if (dnmemory > 87):
+        hive_site['hive_tez_container_size']="8192"
+    elif (dnmemory > 24):
+        hive_site['hive_tez_container_size']="4096"
+    else:
+        hive_site['hive_tez_container_size']="2048"
+
+    hive_site['fs_file_impl_disable_cache'] = "true"
+    hive_site['fs_hdfs_impl_disable_cache'] = "true"
+    hive_site['hive_plan_serialization_format'] = "kryo"
+    hive_site['hive_execution_engine'] = "tez"
+    hive_site['hive_exec_compress_intermediate'] = "true"
+    hive_site['hive_exec_compress_output'] = "true"
+    hive_site['hive_merge_mapfiles'] = "false"
+    hive_site['hive_default_fileformat_managed'] = "ORC"
+    hive_site['hive_compute_query_using_stats'] = "true"
+    hive_site['hive_cbo_enable'] = "true"
+    hive_site['hive_stats_fetch_column_stats'] = "true"
+    hive_site['hive_stats_fetch_partition_stats'] = "true"
+    hive_site['hive_vectorized_execution_reduce_enabled'] = "true"
+    hive_site['hive_server2_tez_initialize_default_sessions'] = "true"
+
+    return hive_site
+
+def hive_env_facts(mnmemory):
+    hive_env=dict()
+    if (mnmemory > 87):
+        hive_env['hive_heapsize']="8192"
+        hive_env['hive_metastore_heapsize']="8192"
+        hive_env['hive_client_heapsize']="2048"
+    elif (mnmemory > 24):
+        hive_env['hive_heapsize']="4096"
+        hive_env['hive_metastore_heapsize']="1024"
+        hive_env['hive_client_heapsize']="1024"
+    else:
+        hive_env['hive_heapsize']="1024"
+        hive_env['hive_metastore_heapsize']="1024"
+        hive_env['hive_client_heapsize']="1024"
+    return hive_env
+
+def hbase_env_facts(mnmemory,dnmemory):
+    hbase_env=dict()
+
+    if (mnmemory > 87):
+        hbase_env['hbase_master_heapsize']="8192m"
+    elif (mnmemory > 24):
+        hbase_env['hbase_master_heapsize']="4096m"
+    else:
+        hbase_env['hbase_master_heapsize']="1024m"
+
+
+    if (dnmemory > 110):
+        hbase_env['hbase_regionserver_heapsize']="16384m"
+        hbase_env['hbase_regionserver_xmn_max']="2048m"
+    elif (dnmemory > 58):
+        hbase_env['hbase_regionserver_heapsize']="8192m"
+        hbase_env['hbase_regionserver_xmn_max']="1538m"
+    else:
+        hbase_env['hbase_regionserver_heapsize']="4096m"
+        hbase_env['hbase_regionserver_xmn_max']="768m"
+
+    return hbase_env
+
+def hbase_site_facts():
+    hbase_site=dict()
+
+    hbase_site['hbase_master_wait_on_regionservers_timeout'] = "30000"
+    hbase_site['hbase_master_namespace_init_timeout'] = "2400000"
+    hbase_site['hbase_regionserver_executor_openregion_threads'] = "20"
+
+    return hbase_site
+def hadoop_env_facts(mnmemory,dnmemory):
+      hadoop_env=dict()
+      if (mnmemory > 87):
+          hadoop_env['namenode_heapsize']="8192m"
+          hadoop_env['namenode_opt_maxnewsize']="512m"
+          hadoop_env['namenode_opt_newsize']="512m"
+      elif (mnmemory > 24):
+          hadoop_env['namenode_heapsize']="4096m"
+          hadoop_env['namenode_opt_maxnewsize']="512m"
+          hadoop_env['namenode_opt_newsize']="512m"
+      else:
+          hadoop_env['namenode_heapsize']="2048m"
+          hadoop_env['namenode_opt_maxnewsize']="384m"
+          hadoop_env['namenode_opt_newsize']="384m"
+
+      if (dnmemory > 110):
+          hadoop_env['dtnode_heapsize']="4096m"
+      elif (dnmemory > 57):
+          hadoop_env['dtnode_heapsize']="2048m"
+      else:
+          hadoop_env['dtnode_heapsize']="1024m"
+
+      return hadoop_env
+
+def spark_defaults_facts(dnmemory):
+    spark_defaults=dict()
+
+    if (dnmemory > 110):
+        spark_defaults['spark_yarn_executor_memory']="7808m"
+        spark_defaults['spark_driver_memory']="7808m"
+        spark_defaults['spark_yarn_am_memory']="7808m"
+        spark_defaults['spark_yarn_executor_memoryOverhead']="384"
+        spark_defaults['spark_yarn_driver_memoryOverhead']="384"
+        spark_defaults['spark_yarn_am_memoryOverhead']="384"
+    elif (dnmemory > 57):
+        spark_defaults['spark_yarn_executor_memory']="7808m"
+        spark_defaults['spark_driver_memory']="3712m"
+        spark_defaults['spark_yarn_am_memory']="3712m"
+        spark_defaults['spark_yarn_executor_memoryOverhead']="384"
+        spark_defaults['spark_yarn_driver_memoryOverhead']="384"
+        spark_defaults['spark_yarn_am_memoryOverhead']="384"
+    else:
+        spark_defaults['spark_yarn_executor_memory']="7808m"
+        spark_defaults['spark_driver_memory']="3712m"
+        spark_defaults['spark_yarn_am_memory']="3712m"
+        spark_defaults['spark_yarn_executor_memoryOverhead']="384"
+        spark_defaults['spark_yarn_driver_memoryOverhead']="384"
+        spark_defaults['spark_yarn_am_memoryOverhead']="384"
+
+    return spark_defaults
+
+def mapred_site_facts(map_memory,reduce_memory,am_memory):
+
+    mapred_site=dict()
+    mapred_site['mapreduce_map_memory_mb']=clip(1028, map_memory, 4096)
+    mapred_site['mapreduce_map_java_opts']="-Xmx" + str(clip(1028, int(0.8 * map_memory), 8192))  +"m"
+    mapred_site['mapreduce_reduce_memory_mb']=clip(1028, reduce_memory, 4096)
+    mapred_site['mapreduce_reduce_java_opts']="-Xmx" + str(clip(1028, int(0.8 * reduce_memory), 8192)) + "m"
+    mapred_site['mapreduce_task_io_sort_mb']=clip(1028, int(0.4 * map_memory), 8192)
+    mapred_site['yarn_app_mapreduce_am_resource_mb']=clip(1028, am_memory, 4096)
+    mapred_site['yarn_app_mapreduce_am_command_opts']="-Xmx" + str(clip(1028, int(0.8*am_memory), 8192)) + "m"
+
+    mapred_site['mapreduce_output_fileoutputformat_compress'] = "true"
+    mapred_site['mapreduce_map_output_compress'] = "true"
+    mapred_site['mapreduce_job_reduce_slowstart_completedmaps'] = "0.7"
+
+    return mapred_site
+
+def hdfs_site_facts():
+    hdfs_site=dict()
+
+    hdfs_site['dfs_datanode_balance_bandwidthPerSec']="12500000"
+    hdfs_site['dfs_datanode_max_transfer_threads']="4096"
+    hdfs_site['dfs_replication'] = "3"
+    
+    return hdfs_site
+
+def yarn_site_facts(container_ram,containers):
+    yarn_site=dict()
+
+    yarn_site['yarn_scheduler_minimum_allocation_mb']=clip(1024, container_ram, 8192)
+    yarn_site['yarn_scheduler_maximum_allocation_mb']=clip(1024, (containers*container_ram), 8192)
+    yarn_site['yarn_nodemanager_resource_memory_mb']=max(1024, containers*container_ram)
+
+    yarn_site['yarn_timeline-service_store-class'] = "org.apache.hadoop.yarn.server.timeline.RollingLevelDBTimelineStore"
+    yarn_site['yarn_timeline-service_generic-application-history_save-non-am-container-meta-info'] = "false"
+
+    return yarn_site
+
+def yarn_env_facts(nodemanager_heap):
+    yarn_env=dict()
+
+    yarn_env['nodemanager_heapsize']=str(nodemanager_heap)
+
+    return yarn_env
+
+def tez_site_facts(dnmemory):
+    tez_site=dict()
+
+    if (dnmemory > 110):
+        tez_site['tez_am_resource_memory_mb']="8192"
+        tez_site['tez_task_resource_memory_mb']="8192"
+        memopts="4096"
+    elif (dnmemory > 57):
+        tez_site['tez_am_resource_memory_mb']="4096"
+        tez_site['tez_task_resource_memory_mb']="4096"
+        memopts="2048"
+    else:
+        tez_site['tez_am_resource_memory_mb']="2048"
+        tez_site['tez_task_resource_memory_mb']="2048"
+        memopts="1024"
+
+    tez_site['tez_am_launch_cmd-opts']="-XX:+PrintGCDetails -verbose:gc -XX:+PrintGCTimeStamps -XX:+UseNUMA -XX:+UseParallelGC -Xmx" + memopts + "m"
+
+    return tez_site
+
+def zeppelin_env_facts(mnmemory):
+    zeppelin_env=dict()
+
+    if (mnmemory > 110):
+        zeppelin_env['zeppelin_executor_memory']="4096m"
+    elif (mnmemory > 57):
+        zeppelin_env['zeppelin_executor_memory']="2048m"
+    else:
+        zeppelin_env['zeppelin_executor_memory']="1024m"
+
+    zeppelin_env['zeppelin_executor_instances'] = "2"
+    
+    return zeppelin_env
+
+def worker_daemons(dnmemory, hbaseEnabled, overrides=None):
+    # Memory bounds of the daemons on a node with dnmemory GB of memory, Map: daemon =>
+    # dict(min, max, priority). The overrides change the defaults of workerDaemons.
+    recommended = dict(
+        datanode=int(hadoop_env_facts(0, dnmemory)['dtnode_heapsize'].rstrip('m')),
+        regionserver=int(hbase_env_facts(0, dnmemory)['hbase_regionserver_heapsize'].rstrip('m')))
+    daemons = dict()
+    for name, bounds in workerDaemons.items():
+        if (name == 'regionserver' and not hbaseEnabled):
+            continue
+        daemon = dict(bounds)
+        daemon.update((overrides or {}).get(name) or {})
+        daemon.setdefault('max', recommended.get(name, daemon['min']))
+        daemon['max'] = max(daemon['min'], daemon['max'])
+        daemons[name] = daemon
+    return daemons
+
+def solve_memory_budget(dnmemory, daemons, os_reserve, yarn_min):
+    # Split the memory of a node between the OS reserve, the daemon heaps and the YARN
+    # containers without ever going over the node memory. Every daemon gets its min heap and
+    # YARN at least yarn_min MB, then the daemons with a priority above YARN_PRIORITY grow
+    # towards their max heap, highest priority first, and YARN gets all that's left.
+    total = int(dnmemory * GB)
+    reserve = int(os_reserve * GB)
+    heaps = dict((name, daemon['min']) for name, daemon in daemons.items())
+    free = total - reserve - sum(heaps.values()) - yarn_min
+    for name in sorted(daemons, key=lambda name: -daemons[name]['priority']):
+        daemon = daemons[name]
+        if (daemon['priority'] <= YARN_PRIORITY or free <= 0):
+            continue
+        grow = min(daemon['max'] - heaps[name], free) // HEAP_ROUNDING * HEAP_ROUNDING
+        heaps[name] += grow
+        free -= grow
+    yarn = max(0, total - reserve - sum(heaps.values()))
+    return dict(total_mb=total, os_reserve_mb=reserve, heaps=heaps, yarn_mb=yarn,
+                fits=(free >= 0))
+
+def size_node(dnmemory, cores, disks, hbaseEnabled, os_reserve=None, daemons=None):
+    # Containers of a node with dnmemory GB of memory, with what's left after the OS reserve
+    # and the heaps of the daemons on the node. The returned dnmemory is the memory of the
+    # containers in MB, memory the node memory in GB the tier facts take, and budget the
+    # accounting of the whole node memory.
+    memory = dnmemory
+    minContainerSize = getMinContainerSize(dnmemory)
+    if (not os_reserve):
+      os_reserve = getReservedOSMem(dnmemory)
+    budget = solve_memory_budget(dnmemory, worker_daemons(dnmemory, hbaseEnabled, daemons),
+                                 os_reserve, 3 * minContainerSize)
+    dnmemory = max(budget['yarn_mb'], minContainerSize)
+
+    containers = int (min(2 * cores,
+                           min(math.ceil(1.8 * float(disks)),
+                                dnmemory/minContainerSize)))
+    if (containers <= 2):
+      containers = 3
+
+    container_ram =  abs(dnmemory/containers)
+    if (container_ram > GB):
+      container_ram = int(math.floor(container_ram / 512)) * 512
+
+    map_memory = container_ram
+    reduce_memory = 2*container_ram if (container_ram <= 2048) else container_ram
+    am_memory = max(map_memory, reduce_memory)
+
+    heaps = budget['heaps']
+    budget = dict(total_mb=budget['total_mb'], os_reserve_mb=budget['os_reserve_mb'],
+                  yarn_containers_mb=containers * container_ram, fits=budget['fits'],
+                  **dict(('%s_heap_mb' % name, heap) for name, heap in heaps.items()))
+    budget['unused_mb'] = (budget['total_mb'] - budget['os_reserve_mb'] - sum(heaps.values()) -
+                           budget['yarn_containers_mb'])
+    return dict(memory=memory, dnmemory=dnmemory, containers=containers,
+                container_ram=container_ram, map_memory=map_memory, reduce_memory=reduce_memory,
+                am_memory=am_memory, heaps=heaps, budget=budget)
+
+def worker_heap_facts(mnmemory, sizing):
+    # hadoop-env, hbase-env and yarn-env with the heaps of the memory budget of a node. The
+    # young generation of the region server is kept in proportion to the heap it really gets.
+    hadoop_env = hadoop_env_facts(mnmemory, sizing['memory'])
+    hbase_env = hbase_env_facts(mnmemory, sizing['memory'])
+    heaps = sizing['heaps']
+    hadoop_env['dtnode_heapsize'] = '%dm' % heaps['datanode']
+    if ('regionserver' in heaps):
+      hbase_env['hbase_regionserver_heapsize'] = '%dm' % heaps['regionserver']
+      xmn_max = int(heaps['regionserver'] * XMN_RATIO) // HEAP_ROUNDING * HEAP_ROUNDING
+      hbase_env['hbase_regionserver_xmn_max'] = '%dm' % min(
+        int(hbase_env['hbase_regionserver_xmn_max'].rstrip('m')), max(HEAP_ROUNDING, xmn_max))
+    yarn_env = yarn_env_facts(heaps['nodemanager'])
+    return hadoop_env, hbase_env, yarn_env
+
+def host_profiles(hosts, cores, disks):
+    # Hosts grouped by hardware profile, Map: (memory GB, cores, disks) => hostnames. The
+    # cores and disks default to the cluster wide ones for hosts that don't report them.
+    profiles = dict()
+    for host in hosts:
+        profile = (int(round(float(host['memory']))),
+                   int(host.get('cores') or cores),
+                   int(host.get('disks') or disks))
+        profiles.setdefault(profile, []).append(host['name'])
+    return profiles
+
+def host_group_facts(mnmemory, hosts, cores, disks, hbaseEnabled, os_reserve=None, daemons=None):
+    # One set of node level recommendations per hardware profile, each one meant for its own
+    # Ambari config group, and the group of every host. The sizing runs once per profile no
+    # matter how many hosts share it.
+    host_groups = []
+    host_group_assignment = dict()
+    for profile, names in sorted(host_profiles(hosts, cores, disks).items()):
+        memory, profile_cores, profile_disks = profile
+        sizing = size_node(memory, profile_cores, profile_disks, hbaseEnabled, os_reserve, daemons)
+        hadoop_env, hbase_env, yarn_env = worker_heap_facts(mnmemory, sizing)
+        name = 'nodes-%dg-%dc-%dd' % profile
+        host_groups.append(dict(
+            name=name,
+            hosts=sorted(names),
+            memory=memory,
+            cores=profile_cores,
+            disks=profile_disks,
+            containers=sizing['containers'],
+            container_ram=sizing['container_ram'],
+            yarn_site=yarn_site_facts(sizing['container_ram'], sizing['containers']),
+            mapred_site=mapred_site_facts(sizing['map_memory'], sizing['reduce_memory'], sizing['am_memory']),
+            tez_site=tez_site_facts(memory),
+            hive_site=hive_site_facts(memory),
+            spark_defaults=spark_defaults_facts(memory),
+            hadoop_env=hadoop_env,
+            hbase_env=hbase_env,
+            yarn_env=yarn_env,
+            memory_budget=sizing['budget']))
+        for host in names:
+            host_group_assignment[host] = name
+    return host_groups, host_group_assignment
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# This file is part of Ansible
+
+# Compare candidate node shapes before buying hardware, by running the sizing rules of the
+# `sitefacts` module, from playbooks/module_utils/hadoop_sizing.py, over a grid of (memory, cores, disks) shapes in a single process.
+#
+# Usage:
+#   python tools/capacity_plan.py --memory 64:512:64 --cores 16,24,32,48 --disks 4:24:4 --nodes 20
+#   python tools/capacity_plan.py --memory 128,256 --cores 32 --disks 12 --format json
+#
+# A list is either comma separated values or start:stop:step, stop included. Every shape gets
+# its memory budget, i.e. the OS reserve, the daemon heaps and the container count and size,
+# the memory left unused and the YARN capacity of a cluster of --nodes such nodes.
+
+import argparse
+import collections
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'playbooks',
+                                'module_utils'))
+
+from hadoop_sizing import size_node, yarn_site_facts, mapred_site_facts, tez_site_facts, \
+    hive_site_facts
+
+COLUMNS = ['memory_gb', 'cores', 'disks', 'hbase', 'containers', 'container_ram_mb',
+           'os_reserve_mb', 'datanode_heap_mb', 'regionserver_heap_mb', 'nodemanager_heap_mb',
+           'nodemanager_mb', 'unused_mb', 'fits', 'map_memory_mb', 'reduce_memory_mb',
+           'am_memory_mb', 'tez_container_mb', 'hive_tez_container_mb', 'nodes',
+           'cluster_yarn_mb', 'cluster_containers']
+
+
+def parse_values(text, kind=int):
+    """
+    :param text: Comma separated values or start:stop:step ranges, e.g. 64,96 or 64:512:64
+    :return: Sorted list of the distinct values
+    """
+    values = set()
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if ':' in part:
+            bounds = [kind(bound) for bound in part.split(':')]
+            start, stop = bounds[0], bounds[1]
+            step = bounds[2] if len(bounds) > 2 else 1
+            if step <= 0:
+                raise ValueError('The step of {} should be positive'.format(part))
+            value = start
+            while value <= stop:
+                values.add(value)
+                value += step
+        else:
+            values.add(kind(part))
+    return sorted(values)
+
+
+def plan(memory, cores, disks, hbase, nodes):
+    """
+    Size a single node shape with the rules of `sitefacts`
+
+    :param memory: Memory of a node in GB
+    :return: Row with the values of COLUMNS
+    """
+    sizing = size_node(memory, cores, disks, hbase)
+    yarn_site = yarn_site_facts(sizing['container_ram'], sizing['containers'])
+    mapred_site = mapred_site_facts(sizing['map_memory'], sizing['reduce_memory'],
+                                    sizing['am_memory'])
+    budget = sizing['budget']
+    nodemanager = yarn_site['yarn_nodemanager_resource_memory_mb']
+    return [memory, cores, disks, hbase, sizing['containers'], sizing['container_ram'],
+            budget['os_reserve_mb'], budget['datanode_heap_mb'],
+            budget.get('regionserver_heap_mb', 0), budget['nodemanager_heap_mb'], nodemanager,
+            budget['unused_mb'], budget['fits'],
+            mapred_site['mapreduce_map_memory_mb'], mapred_site['mapreduce_reduce_memory_mb'],
+            mapred_site['yarn_app_mapreduce_am_resource_mb'],
+            int(tez_site_facts(memory)['tez_task_resource_memory_mb']),
+            int(hive_site_facts(memory)['hive_tez_container_size']),
+            nodes, nodes * nodemanager, nodes * sizing['containers']]
+
+
+def sweep(memories, cores, disks, hbase, nodes):
+    """
+    :return: List of the rows of all the combinations of the given values
+    """
+    return [plan(*shape + (nodes,)) for shape in itertools.product(memories, cores, disks, hbase)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Size candidate node shapes with the '
+                                                 'sitefacts rules')
+    parser.add_argument('--memory', default='64:512:64', help='Memory of a node in GB')
+    parser.add_argument('--cores', default='8,16,24,32,48,64')
+    parser.add_argument('--disks', default='4:24:4')
+    parser.add_argument('--hbase', choices=['yes', 'no', 'both'], default='yes',
+                        help='Reserve memory for an HBase region server on every node')
+    parser.add_argument('--nodes', type=int, default=1,
+                        help='Number of nodes of the modeled cluster')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv')
+    parser.add_argument('--output', help='File to write to rather than stdout')
+    args = parser.parse_args()
+
+    try:
+        memories = parse_values(args.memory)
+        cores = parse_values(args.cores)
+        disks = parse_values(args.disks)
+    except ValueError as e:
+        parser.error(str(e))
+    if not memories or not cores or not disks:
+        parser.error('Every one of --memory, --cores and --disks needs at least one value')
+    hbase = {'yes': [True], 'no': [False], 'both': [True, False]}[args.hbase]
+
+    started = time.time()
+    rows = sweep(memories, cores, disks, hbase, args.nodes)
+    elapsed = time.time() - started
+
+    stream = open(args.output, 'wb') if args.output else sys.stdout
+    try:
+        if args.format == 'json':
+            json.dump([collections.OrderedDict(zip(COLUMNS, row)) for row in rows], stream, indent=2)
+            stream.write('\n')
+        else:
+            writer = csv.writer(stream)
+            writer.writerow(COLUMNS)
+            writer.writerows(rows)
+    finally:
+        if args.output:
+            stream.close()
+    sys.stderr.write('Sized {} node shapes in {:.3f}s\n'.format(len(rows), elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/python
+# This file is part of Ansible
+
+# Follow the live progress events of a running `cdh` module, which Ansible otherwise only shows
+# once the module exits.
+#
+# Usage:
+#   python tools/cdh_watch.py /opt/cdh-progress.ndjson       # follow the progress file
+#   python tools/cdh_watch.py unix:/tmp/cdh.sock             # listen for a run streaming to a socket
+#
+# Progress that didn't move for a while is flagged as STALLED, and a warning is shown when no
+# events came in at all for --quiet seconds.
+
+import argparse
+import datetime
+import json
+import os
+import socket
+import sys
+import time
+
+
+def human_bytes(value):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(value) < 1024:
+            return '{:.1f}{}'.format(value, unit)
+        value /= 1024.0
+    return '{:.1f}TB'.format(value)
+
+
+def human_time(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return '{}s'.format(seconds)
+    if seconds < 3600:
+        return '{}m{:02d}s'.format(seconds // 60, seconds % 60)
+    return '{}h{:02d}m'.format(seconds // 3600, seconds % 3600 // 60)
+
+
+def render(event):
+    """
+    :param event: Decoded progress event
+    :return: Single line describing the event
+    """
+    when = datetime.datetime.fromtimestamp(event.get('ts', time.time())).strftime('%H:%M:%S')
+    where = event.get('service') or event.get('phase') or '-'
+    kind = event.get('event')
+
+    if kind == 'progress':
+        parts = [event.get('item', ''), event.get('stage', '')]
+        if event.get('unit') == 'bytes':
+            parts.append('{} / {}'.format(human_bytes(event.get('progress', 0)),
+                                          human_bytes(event.get('total', 0))))
+            if event.get('rate') is not None:
+                parts.append('{}/s'.format(human_bytes(event['rate'])))
+        else:
+            parts.append('{} / {} {}'.format(event.get('progress'), event.get('total'),
+                                             event.get('unit') or ''))
+        if event.get('percent') is not None:
+            parts.append('{:5.1f}%'.format(event['percent']))
+        if event.get('eta') is not None:
+            parts.append('ETA {}'.format(human_time(event['eta'])))
+        if event.get('stalled') is not None:
+            parts.append('STALLED for {}'.format(human_time(event['stalled'])))
+        detail = ' '.join(part for part in parts if part)
+    elif kind == 'step':
+        detail = 'step {} {}'.format(event.get('step'), event.get('status'))
+    elif kind == 'log':
+        detail = '[{}] {}'.format(event.get('type') or '-', event.get('msg'))
+    elif kind == 'inspection':
+        hosts = event.get('hosts') or []
+        detail = 'host inspection: {} hosts, {} reported problems'.format(
+            len(hosts), len([host for host in hosts if host.get('problems')]))
+    elif kind == 'start':
+        detail = 'setup of cluster {} started'.format(event.get('cluster'))
+    elif kind == 'finish':
+        detail = 'setup finished: {} after {}'.format(event.get('outcome'),
+                                                     human_time(event.get('duration', 0)))
+    else:
+        detail = json.dumps(event)
+    return '{} {:<14} {}'.format(when, where[:14], detail)
+
+
+class Watcher(object):
+    """
+    Render the events as they come in, warning when no events came in for `quiet` seconds
+    """
+    def __init__(self, quiet):
+        self.quiet = quiet
+        self.last = time.time()
+        self.warned = False
+
+    def line(self, line):
+        line = line.strip()
+        if not line:
+            return
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return
+        self.last = time.time()
+        self.warned = False
+        print render(event)
+        sys.stdout.flush()
+
+    def idle(self):
+        silent = time.time() - self.last
+        if self.quiet and silent >= self.quiet and not self.warned:
+            print '{} {:<14} no events for {}, the run may be stuck'.format(
+                datetime.datetime.now().strftime('%H:%M:%S'), '-', human_time(silent))
+            sys.stdout.flush()
+            self.warned = True
+
+
+def follow_file(path, watcher, from_start, interval=0.5):
+    """
+    Follow a progress file like tail -f, starting over when the file is truncated or replaced
+    """
+    stream, inode = None, None
+    while True:
+        if stream is None:
+            if not os.path.exists(path):
+                watcher.idle()
+                time.sleep(interval)
+                continue
+            stream = open(path, 'r')
+            inode = os.fstat(stream.fileno()).st_ino
+            if not from_start:
+                stream.seek(0, os.SEEK_END)
+            from_start = True
+        line = stream.readline()
+        if line.endswith('\n'):
+            watcher.line(line)
+            continue
+        # Wait for the rest of a partially written line
+        stream.seek(-len(line), os.SEEK_CUR)
+        try:
+            stat = os.stat(path)
+            if stat.st_ino != inode or stat.st_size < stream.tell():
+                stream.close()
+                stream = None
+                continue
+        except OSError:
+            pass
+        watcher.idle()
+        time.sleep(interval)
+
+
+def listen_socket(path, watcher, interval=0.5):
+    """
+    Listen on a unix socket for runs streaming their events, one run at a time
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    server.settimeout(interval)
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                watcher.idle()
+                continue
+            conn.settimeout(interval)
+            buffered = ''
+            while True:
+                try:
+                    data = conn.recv(65536)
+                except socket.timeout:
+                    watcher.idle()
+                    continue
+                if not data:
+                    break
+                buffered += data
+                while '\n' in buffered:
+                    line, buffered = buffered.split('\n', 1)
+                    watcher.line(line)
+            conn.close()
+    finally:
+        server.close()
+        os.unlink(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Follow the progress of a cdh module run')
+    parser.add_argument('target', nargs='?', default='/opt/cdh-progress.ndjson',
+                        help='Progress file, or unix:<path> to listen on a socket')
+    parser.add_argument('--from-start', action='store_true',
+                        help='Show the events already in the file as well')
+    parser.add_argument('--quiet', type=int, default=60,
+                        help='Warn when no events came in for this many seconds, 0 to disable')
+    args = parser.parse_args()
+
+    watcher = Watcher(args.quiet)
+    try:
+        if args.target.startswith('unix:'):
+            listen_socket(args.target[len('unix:'):], watcher)
+        else:
+            follow_file(args.target, watcher, args.from_start)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,942 @@
+#!/usr/bin/python
+# This file is part of Ansible
+
+# A self contained stand-in for the Cloudera Manager REST API, covering the endpoints the `cdh`
+# module uses: license, clusters, hosts, parcels, services, roles, role config groups and
+# commands. Commands and parcel stages run as timed state machines with configurable latency,
+# progress curves and injected failures, so orchestration changes can be exercised and timed
+# in seconds without a real Cloudera Manager.
+#
+# Usage:
+#   python tools/cm_simulator.py --config cluster.yaml --port 7180 --speed 0.01
+#
+# Then point `cm.host`/`cm.port` of the cluster.yaml at the simulator and run cdh.py locally.
+# The number of requests per endpoint is available from GET /simulator/stats and is printed
+# when the simulator is stopped.
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import argparse
+import datetime
+import json
+import random
+import re
+import signal
+import sys
+import threading
+import time
+import urlparse
+import uuid
+
+API_VERSION = 30
+
+REMOTE_PARCEL_REPO_URLS = 'REMOTE_PARCEL_REPO_URLS'
+DEFAULT_PARCEL_REPOS = 'https://archive.cloudera.com/cdh5/parcels/{latest_supported}/'
+
+# Numeric ranges of the host patterns of a cluster.yaml, e.g. dn[001-480]
+HOST_RANGE = re.compile(r'\[([0-9,\-]+)\]')
+
+# Message CM returns for commands that can't be run yet, e.g. right after a service is configured
+UNAVAILABLE_MSG = "Command '{}' is not currently available for execution."
+PENDING_MSG = 'There is already a pending command on this entity.'
+
+# Parcel stages, the stage a parcel is in while an action runs and the stage it ends up in
+PARCEL_TRANSITIONS = {
+    'startDownload': ('AVAILABLE_REMOTELY', 'DOWNLOADING', 'DOWNLOADED'),
+    'startDistribution': ('DOWNLOADED', 'DISTRIBUTING', 'DISTRIBUTED'),
+    'activate': ('DISTRIBUTED', 'ACTIVATING', 'ACTIVATED'),
+}
+
+# Checks the simulated host inspector can find failing on a host
+INSPECTOR_CHECKS = [
+    'Transparent Huge Pages is enabled, which can cause significant performance problems.',
+    'vm.swappiness is set to 60, the recommended value is 1.',
+    'The clock offset to the NTP server exceeds 100ms.',
+    'The hostname resolves to a loopback address.',
+]
+
+# Size of a simulated parcel in bytes
+PARCEL_SIZE = 1500 * 1024 * 1024
+
+# CM settings limiting parcel distribution and their defaults, the total rate in KB/s and the
+# number of hosts uploaded to at once
+PARCEL_RATE_LIMIT = 'PARCEL_DISTRIBUTE_RATE_LIMIT_KBS_PER_SECOND'
+PARCEL_CONCURRENT_UPLOADS = 'PARCEL_NUM_CONCURRENT_UPLOADS'
+DEFAULT_PARCEL_RATE_LIMIT = 51200
+DEFAULT_PARCEL_UPLOADS = 25
+
+# Rate in KB/s per host below which the simulated agents time out and distribution stalls
+AGENT_TIMEOUT_RATE = 512
+
+
+class ApiError(Exception):
+    """
+    Error returned to the client as a json message with the given HTTP status
+    """
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
+
+def not_found(what):
+    return ApiError(404, "{} not found.".format(what))
+
+
+def timestamp(when):
+    return datetime.datetime.utcfromtimestamp(when).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def curve(name, fraction):
+    """
+    Progress curves for the timed state machines
+
+    :param name: linear, scurve (slow start and finish) or stall (stalls at 90% for a while)
+    :param fraction: Elapsed fraction of the total time
+    :return: Completed fraction of the work
+    """
+    fraction = max(0.0, min(1.0, fraction))
+    if name == 'scurve':
+        return fraction * fraction * (3 - 2 * fraction)
+    if name == 'stall':
+        if fraction < 0.5:
+            return fraction * 1.8
+        if fraction < 0.9:
+            return 0.9
+        return 0.9 + (fraction - 0.9)
+    return fraction
+
+
+class Settings(object):
+    """
+    Simulator behaviour, all the durations are in seconds and scaled by `speed`
+    """
+    def __init__(self, args):
+        self.speed = args.speed
+        self.latency = args.latency
+        self.jitter = args.jitter
+        self.command_time = args.command_time
+        self.start_time = args.start_time
+        self.inspect_time = args.inspect_time
+        self.download_time = args.download_time
+        self.distribute_time = args.distribute_time
+        self.activate_time = args.activate_time
+        self.curve = args.curve
+        self.nic_mbps = args.nic_mbps
+        self.host_mbps = args.host_mbps
+        self.unavailable_rate = args.unavailable_rate
+        self.pending_rate = args.pending_rate
+        self.failure_rate = args.failure_rate
+        self.inspect_failure_rate = args.inspect_failure_rate
+
+    def duration(self, seconds):
+        return seconds * self.speed * random.uniform(0.8, 1.2)
+
+
+class Command(object):
+    """
+    A CM command running for a fixed time, applying its effects once it completes
+    """
+    def __init__(self, id, name, duration, success=True, message=None, effect=None, refs=None):
+        self.id = id
+        self.name = name
+        self.start = time.time()
+        self.end = self.start + duration
+        self.success = success
+        self.message = message
+        self.effect = effect
+        self.refs = refs or {}
+        self.children = []
+        self.applied = False
+
+    @property
+    def active(self):
+        return time.time() < self.end
+
+    def tick(self):
+        if not self.active and not self.applied:
+            self.applied = True
+            if self.success and self.effect is not None:
+                self.effect()
+
+    def to_json(self):
+        self.tick()
+        active = self.active
+        data = {
+            'id': self.id,
+            'name': self.name,
+            'startTime': timestamp(self.start),
+            'active': active,
+            'children': {'items': [child.to_json() for child in self.children]},
+        }
+        if not active:
+            data['endTime'] = timestamp(self.end)
+            data['success'] = self.success
+            data['resultMessage'] = self.message or (
+                '{} completed.'.format(self.name) if self.success
+                else '{} failed.'.format(self.name))
+        data.update(self.refs)
+        return data
+
+
+class Parcel(object):
+    """
+    A parcel moving thru its stages as timed state machines
+    """
+    def __init__(self, cluster, product, version):
+        self.cluster = cluster
+        self.product = product
+        self.version = version
+        self.stage = 'AVAILABLE_REMOTELY'
+        self.transition = None
+        self.flow = None
+
+    def begin(self, action, duration, rate=None, total=None):
+        """
+        Start an action, running for `duration` or, when `rate` is given, until `total` bytes
+        went thru at the rate in bytes per second returned by `rate` at any point in time
+        """
+        initial, during, final = PARCEL_TRANSITIONS[action]
+        if self.stage != initial:
+            raise ApiError(400, "Parcel {}-{} is in stage {}, cannot {}.".format(
+                self.product, self.version, self.stage, action))
+        self.stage = during
+        if rate is not None:
+            self.flow = {'last': time.time(), 'done': 0.0, 'total': total, 'rate': rate,
+                         'final': final}
+        else:
+            self.transition = (time.time(), max(duration, 0.001), final)
+
+    def tick(self):
+        if self.flow is not None:
+            now = time.time()
+            self.flow['done'] += self.flow['rate']() * (now - self.flow['last'])
+            self.flow['last'] = now
+            if self.flow['done'] >= self.flow['total']:
+                self.stage = self.flow['final']
+                self.flow = None
+        if self.transition is not None:
+            started, duration, final = self.transition
+            if time.time() >= started + duration:
+                self.stage = final
+                self.transition = None
+
+    def to_json(self, settings, hosts):
+        self.tick()
+        progress, total = 0, 0
+        count, total_count = 0, 0
+        if self.flow is not None:
+            progress, total = int(self.flow['done']), self.flow['total']
+            total_count = max(1, hosts)
+            count = int(total_count * progress / total)
+        if self.transition is not None:
+            started, duration, _ = self.transition
+            done = curve(settings.curve, (time.time() - started) / duration)
+            total = PARCEL_SIZE if self.stage == 'DOWNLOADING' else PARCEL_SIZE * max(1, hosts)
+            progress = int(total * done)
+            total_count = max(1, hosts)
+            count = int(total_count * done)
+        return {
+            'product': self.product,
+            'version': self.version,
+            'stage': self.stage,
+            'state': {'progress': progress, 'totalProgress': total, 'count': count,
+                      'totalCount': total_count, 'warnings': [], 'errors': []},
+            'clusterRef': {'clusterName': self.cluster},
+        }
+
+
+class Simulator(object):
+    """
+    In memory state of the simulated Cloudera Manager
+    """
+    def __init__(self, settings, hostnames, parcels=None):
+        self.settings = settings
+        self.lock = threading.RLock()
+        self.license = None
+        self.cm_config = {}
+        self.hosts = {}
+        for i, hostname in enumerate(hostnames):
+            host_id = str(uuid.uuid5(uuid.NAMESPACE_DNS, hostname))
+            self.hosts[host_id] = {'hostId': host_id, 'hostname': hostname,
+                                   'ipAddress': '10.0.{}.{}'.format(i // 250, i % 250 + 1)}
+        self.known_parcels = set(parcels or [])
+        self.clusters = {}
+        self.commands = {}
+        self.next_command = 1
+        self.mgmt = None
+        self.stats = {}
+
+    # Helpers
+
+    def count(self, method, route):
+        with self.lock:
+            key = '{} {}'.format(method, route)
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def host_ref(self, host):
+        """
+        Resolve a host reference by hostId or hostname, CM accepts both
+        """
+        if host in self.hosts:
+            return host
+        for host_id, data in self.hosts.items():
+            if host in (data['hostname'], data['ipAddress']):
+                return host_id
+        raise ApiError(400, "Host '{}' not found.".format(host))
+
+    def cluster(self, name):
+        if name not in self.clusters:
+            raise not_found("Cluster '{}'".format(name))
+        return self.clusters[name]
+
+    def service(self, cluster, name):
+        if cluster is None:
+            if self.mgmt is None:
+                raise not_found("Service 'mgmt'")
+            return self.mgmt
+        services = self.cluster(cluster)['services']
+        if name not in services:
+            raise not_found("Service '{}'".format(name))
+        return services[name]
+
+    def command(self, name, duration, refs=None, effect=None, success=True, message=None):
+        with self.lock:
+            cmd = Command(self.next_command, name, duration, success, message, effect, refs)
+            self.commands[cmd.id] = cmd
+            self.next_command += 1
+            return cmd
+
+    def tick(self):
+        for cmd in self.commands.values():
+            cmd.tick()
+
+    # Serializers
+
+    def service_json(self, svc):
+        data = {'name': svc['name'], 'type': svc['type'], 'displayName': svc['name'],
+                'serviceState': svc['state'], 'healthSummary': 'GOOD',
+                'configStale': False, 'maintenanceMode': False}
+        if svc['cluster']:
+            data['clusterRef'] = {'clusterName': svc['cluster']}
+        return data
+
+    def role_json(self, svc, role):
+        ref = {'serviceName': svc['name']}
+        if svc['cluster']:
+            ref['clusterName'] = svc['cluster']
+        return {'name': role['name'], 'type': role['type'], 'hostRef': {'hostId': role['host']},
+                'roleState': role['state'], 'serviceRef': ref, 'healthSummary': 'GOOD',
+                'configStale': False, 'maintenanceMode': False,
+                'roleConfigGroupRef': {'roleConfigGroupName': self.base_group(svc, role['type'])}}
+
+    def base_group(self, svc, role_type):
+        return '{}-{}-BASE'.format(svc['name'] if svc['cluster'] else 'mgmt', role_type)
+
+    def config_json(self, config, view, defaults=None):
+        defaults = defaults or {}
+        items = []
+        for name in sorted(set(config) | set(defaults if view == 'full' else [])):
+            item = {'name': name}
+            if name in config:
+                item['value'] = config[name]
+            if view == 'full':
+                item['default'] = defaults.get(name)
+                item['required'] = False
+                item['sensitive'] = False
+            items.append(item)
+        return {'items': items}
+
+    def new_service(self, cluster, name, service_type):
+        return {'name': name, 'type': service_type, 'cluster': cluster, 'state': 'STOPPED',
+                'config': {}, 'groups': {}, 'roles': {}}
+
+    # Effects of completed commands
+
+    def start_service(self, svc):
+        def effect():
+            with self.lock:
+                svc['state'] = 'STARTED'
+                for role in svc['roles'].values():
+                    if role['type'] != 'GATEWAY':
+                        role['state'] = 'STARTED'
+        return effect
+
+    def start_roles(self, svc, names):
+        def effect():
+            with self.lock:
+                for name in names:
+                    svc['roles'][name]['state'] = 'STARTED'
+        return effect
+
+    def service_command(self, svc, name):
+        """
+        Issue a service or role command, injecting the configured failures
+        """
+        settings = self.settings
+        refs = {'serviceRef': {'serviceName': svc['name']}}
+        if svc['cluster']:
+            refs['serviceRef']['clusterName'] = svc['cluster']
+            refs['clusterRef'] = {'clusterName': svc['cluster']}
+
+        if name == 'start':
+            if random.random() < settings.pending_rate:
+                return self.command(name, 0, refs, success=False, message=PENDING_MSG)
+            return self.command(name, settings.duration(settings.start_time), refs,
+                                effect=self.start_service(svc))
+        if random.random() < settings.unavailable_rate:
+            return self.command(name, 0, refs, success=False,
+                                message=UNAVAILABLE_MSG.format(name))
+        if random.random() < settings.failure_rate:
+            return self.command(name, settings.duration(settings.command_time), refs,
+                                success=False)
+        return self.command(name, settings.duration(settings.command_time), refs)
+
+
+class Router(object):
+    """
+    Map request paths to the handler methods of an `Api`
+    """
+    def __init__(self):
+        self.routes = []
+
+    def add(self, method, pattern, handler):
+        regex = re.compile('^' + re.sub(r'{(\w+)}', r'(?P<\1>[^/]+)', pattern) + '$')
+        self.routes.append((method, pattern, regex, handler))
+
+    def match(self, method, path):
+        for route_method, pattern, regex, handler in self.routes:
+            if route_method != method:
+                continue
+            match = regex.match(path)
+            if match:
+                return pattern, handler, match.groupdict()
+        return None, None, None
+
+
+class Api(object):
+    """
+    Handlers of the simulated endpoints. Each handler receives the request body (parsed
+    json), the query parameters and the path parameters and returns the response body.
+    """
+    def __init__(self, sim):
+        self.sim = sim
+        self.router = Router()
+        for method, pattern, handler in [
+                ('GET', '/cm/license', self.get_license),
+                ('POST', '/cm/license', self.update_license),
+                ('POST', '/cm/trial/begin', self.begin_trial),
+                ('GET', '/cm/config', self.get_cm_config),
+                ('PUT', '/cm/config', self.update_cm_config),
+                ('POST', '/cm/commands/inspectHosts', self.inspect_hosts),
+                ('GET', '/cm/service', self.get_mgmt),
+                ('PUT', '/cm/service', self.create_mgmt),
+                ('GET', '/commands/{id}', self.get_command),
+                ('GET', '/hosts', self.get_hosts),
+                ('GET', '/hosts/{host}', self.get_host),
+                ('GET', '/clusters', self.get_clusters),
+                ('POST', '/clusters', self.create_clusters),
+                ('GET', '/clusters/{cluster}', self.get_cluster),
+                ('GET', '/clusters/{cluster}/hosts', self.get_cluster_hosts),
+                ('POST', '/clusters/{cluster}/hosts', self.add_cluster_hosts),
+                ('POST', '/clusters/{cluster}/commands/{command}', self.cluster_command),
+                ('GET', '/clusters/{cluster}/parcels', self.get_parcels),
+                ('GET', '/clusters/{cluster}/parcels/products/{product}/versions/{version}',
+                 self.get_parcel),
+                ('POST', '/clusters/{cluster}/parcels/products/{product}/versions/{version}'
+                         '/commands/{command}', self.parcel_command),
+                ('GET', '/clusters/{cluster}/services', self.get_services),
+                ('POST', '/clusters/{cluster}/services', self.create_services),
+                ('GET', '/clusters/{cluster}/services/{service}', self.get_service),
+                ('GET', '/clusters/{cluster}/services/{service}/config', self.get_service_config),
+                ('PUT', '/clusters/{cluster}/services/{service}/config',
+                 self.update_service_config)]:
+            self.router.add(method, pattern, handler)
+
+        # Service level endpoints are shared between cluster services and the mgmt service
+        for prefix in ('/clusters/{cluster}/services/{service}', '/cm/service'):
+            for method, pattern, handler in [
+                    ('GET', '/roles', self.get_roles),
+                    ('POST', '/roles', self.create_roles),
+                    ('GET', '/roles/{role}', self.get_role),
+                    ('GET', '/roles/{role}/config', self.get_role_config),
+                    ('PUT', '/roles/{role}/config', self.update_role_config),
+                    ('GET', '/roleConfigGroups', self.get_groups),
+                    ('GET', '/roleConfigGroups/{group}', self.get_group),
+                    ('GET', '/roleConfigGroups/{group}/config', self.get_group_config),
+                    ('PUT', '/roleConfigGroups/{group}/config', self.update_group_config),
+                    ('POST', '/commands/{command}', self.run_service_command),
+                    ('POST', '/roleCommands/{command}', self.run_role_command)]:
+                self.router.add(method, prefix + pattern, handler)
+
+    def handle(self, method, path, query, body):
+        """
+        :return: Tuple of the route pattern and the response body
+        """
+        pattern, handler, params = self.router.match(method, path)
+        if handler is None:
+            self.sim.count(method, 'unknown')
+            raise not_found("Endpoint {} {}".format(method, path))
+        self.sim.count(method, pattern)
+        with self.sim.lock:
+            self.sim.tick()
+            return handler(body, query, **params)
+
+    # License
+
+    def get_license(self, body, query):
+        if self.sim.license is None:
+            raise not_found('License')
+        return self.sim.license
+
+    def update_license(self, body, query):
+        self.sim.license = {'owner': 'Simulated', 'uuid': str(uuid.uuid4())}
+        return self.sim.license
+
+    def begin_trial(self, body, query):
+        self.sim.license = {'owner': 'Trial License', 'uuid': str(uuid.uuid4())}
+
+    # Cloudera Manager config and commands
+
+    def get_cm_config(self, body, query):
+        return self.sim.config_json(self.sim.cm_config, query.get('view'),
+                                    {REMOTE_PARCEL_REPO_URLS: DEFAULT_PARCEL_REPOS})
+
+    def update_cm_config(self, body, query):
+        for item in body.get('items', []):
+            self.sim.cm_config[item['name']] = item.get('value')
+        return self.sim.config_json(self.sim.cm_config, None)
+
+    def inspect_hosts(self, body, query):
+        """
+        Inspect all the hosts, with a child command per host like CM. A host fails some of the
+        inspector checks with the configured probability.
+        """
+        settings = self.sim.settings
+        duration = settings.duration(settings.inspect_time)
+        cmd = self.sim.command('InspectHosts', duration,
+                               message='Host inspection completed on {} hosts.'.format(
+                                   len(self.sim.hosts)))
+        for host in sorted(self.sim.hosts.values(), key=lambda host: host['hostname']):
+            checks = []
+            if random.random() < settings.inspect_failure_rate:
+                checks = random.sample(INSPECTOR_CHECKS, random.randint(1, 2))
+            message = '\n'.join(['Inspector found {} issues.'.format(len(checks))] + checks) \
+                if checks else 'Inspector ran successfully.'
+            cmd.children.append(Command(0, 'HostInspector', duration, not checks, message,
+                                        refs={'hostRef': {'hostId': host['hostId']}}))
+        return cmd.to_json()
+
+    def get_command(self, body, query, id):
+        cmd = self.sim.commands.get(int(id))
+        if cmd is None:
+            raise not_found("Command '{}'".format(id))
+        return cmd.to_json()
+
+    # Hosts
+
+    def get_hosts(self, body, query):
+        return {'items': sorted(self.sim.hosts.values(), key=lambda host: host['hostname'])}
+
+    def get_host(self, body, query, host):
+        return self.sim.hosts[self.sim.host_ref(host)]
+
+    # Clusters
+
+    def cluster_json(self, cluster):
+        return {'name': cluster['name'], 'displayName': cluster['name'],
+                'version': cluster['version'], 'fullVersion': cluster['fullVersion'],
+                'maintenanceMode': False}
+
+    def get_clusters(self, body, query):
+        return {'items': [self.cluster_json(cluster) for cluster in self.sim.clusters.values()]}
+
+    def create_clusters(self, body, query):
+        created = []
+        for item in body.get('items', []):
+            if item['name'] in self.sim.clusters:
+                raise ApiError(400, "Cluster '{}' already exists.".format(item['name']))
+            self.sim.clusters[item['name']] = {
+                'name': item['name'], 'version': item.get('version'),
+                'fullVersion': item.get('fullVersion'), 'hosts': [], 'parcels': {},
+                'services': {}}
+            created.append(self.cluster_json(self.sim.clusters[item['name']]))
+        return {'items': created}
+
+    def get_cluster(self, body, query, cluster):
+        return self.cluster_json(self.sim.cluster(cluster))
+
+    def get_cluster_hosts(self, body, query, cluster):
+        return {'items': [{'hostId': host} for host in self.sim.cluster(cluster)['hosts']]}
+
+    def add_cluster_hosts(self, body, query, cluster):
+        data = self.sim.cluster(cluster)
+        added = []
+        for item in body.get('items', []):
+            host_id = self.sim.host_ref(item['hostId'])
+            if host_id in data['hosts']:
+                raise ApiError(400, "Host '{}' is already in the cluster.".format(host_id))
+            data['hosts'].append(host_id)
+            added.append({'hostId': host_id})
+        return {'items': added}
+
+    def cluster_command(self, body, query, cluster, command):
+        self.sim.cluster(cluster)
+        settings = self.sim.settings
+        return self.sim.command(command, settings.duration(settings.command_time),
+                                {'clusterRef': {'clusterName': cluster}}).to_json()
+
+    # Parcels
+
+    def parcel(self, cluster, product, version):
+        data = self.sim.cluster(cluster)
+        key = '{}-{}'.format(product, version)
+        if key not in data['parcels']:
+            repos = self.sim.cm_config.get(REMOTE_PARCEL_REPO_URLS) or ''
+            if self.sim.known_parcels and key not in self.sim.known_parcels and ',' not in repos:
+                raise not_found("Parcel '{}'".format(key))
+            data['parcels'][key] = Parcel(cluster, product, version)
+        return data['parcels'][key]
+
+    def get_parcels(self, body, query, cluster):
+        data = self.sim.cluster(cluster)
+        return {'items': [parcel.to_json(self.sim.settings, len(data['hosts']))
+                          for parcel in data['parcels'].values()]}
+
+    def get_parcel(self, body, query, cluster, product, version):
+        return self.parcel(cluster, product, version).to_json(
+            self.sim.settings, len(self.sim.cluster(cluster)['hosts']))
+
+    def parcel_command(self, body, query, cluster, product, version, command):
+        parcel = self.parcel(cluster, product, version)
+        settings = self.sim.settings
+        durations = {'startDownload': settings.download_time,
+                     'startDistribution': settings.distribute_time,
+                     'activate': settings.activate_time}
+        if command not in durations:
+            raise not_found("Parcel command '{}'".format(command))
+        data = self.sim.cluster(cluster)
+        hosts = len(data['hosts'])
+        if command == 'startDistribution' and settings.nic_mbps:
+            def rate():
+                # The parcels distributing at the same time share the bandwidth
+                flows = sum(1 for other in data['parcels'].values() if other.flow is not None)
+                return self.distribution_rate(hosts) * 1024 / max(1, flows)
+            # Shrink the parcel rather than speed up the transfer, so the rates look real
+            parcel.begin(command, None, rate, PARCEL_SIZE * max(1, hosts) * settings.speed)
+        else:
+            parcel.begin(command, settings.duration(durations[command]))
+        return self.sim.command(command, 0, {'clusterRef': {'clusterName': cluster}}).to_json()
+
+    def distribution_rate(self, hosts):
+        """
+        :return: Rate in KB/s parcels distribute at with the current CM settings. Uploading to
+            more hosts than the NIC can feed slows everything down as agents retry, and hosts
+            getting less than AGENT_TIMEOUT_RATE time out altogether.
+        """
+        settings = self.sim.settings
+        config = self.sim.cm_config
+        limit = float(config.get(PARCEL_RATE_LIMIT) or DEFAULT_PARCEL_RATE_LIMIT)
+        uploads = max(1, min(hosts, int(config.get(PARCEL_CONCURRENT_UPLOADS) or
+                                        DEFAULT_PARCEL_UPLOADS)))
+        nic = settings.nic_mbps * 1000 / 8.0
+        demand = min(limit, uploads * settings.host_mbps * 1000 / 8.0)
+        rate = min(demand, nic)
+        if demand > nic:
+            rate *= nic / demand
+        if rate / uploads < AGENT_TIMEOUT_RATE:
+            return 0.0
+        return rate
+
+    # Services
+
+    def get_services(self, body, query, cluster):
+        return {'items': [self.sim.service_json(svc)
+                          for svc in self.sim.cluster(cluster)['services'].values()]}
+
+    def create_services(self, body, query, cluster):
+        services = self.sim.cluster(cluster)['services']
+        created = []
+        for item in body.get('items', []):
+            if item['name'] in services:
+                raise ApiError(400, "Service '{}' already exists.".format(item['name']))
+            services[item['name']] = self.sim.new_service(cluster, item['name'], item['type'])
+            created.append(self.sim.service_json(services[item['name']]))
+        return {'items': created}
+
+    def get_service(self, body, query, cluster, service):
+        return self.sim.service_json(self.sim.service(cluster, service))
+
+    def get_service_config(self, body, query, cluster, service):
+        svc = self.sim.service(cluster, service)
+        return self.sim.config_json(svc['config'], query.get('view'))
+
+    def update_service_config(self, body, query, cluster, service):
+        svc = self.sim.service(cluster, service)
+        for item in body.get('items', []):
+            svc['config'][item['name']] = item.get('value')
+        return self.sim.config_json(svc['config'], None)
+
+    def get_mgmt(self, body, query):
+        return self.sim.service_json(self.sim.service(None, None))
+
+    def create_mgmt(self, body, query):
+        if self.sim.mgmt is not None:
+            raise ApiError(400, 'Management service already exists.')
+        self.sim.mgmt = self.sim.new_service(None, body.get('name') or 'mgmt', 'MGMT')
+        return self.sim.service_json(self.sim.mgmt)
+
+    # Roles
+
+    def get_roles(self, body, query, cluster=None, service=None):
+        svc = self.sim.service(cluster, service)
+        return {'items': [self.sim.role_json(svc, role) for role in svc['roles'].values()]}
+
+    def create_roles(self, body, query, cluster=None, service=None):
+        svc = self.sim.service(cluster, service)
+        new_roles = []
+        for item in body.get('items', []):
+            name = item.get('name') or '{}-{}-{}'.format(svc['name'], item['type'],
+                                                          len(svc['roles']) + 1)
+            if name in svc['roles']:
+                raise ApiError(400, "Role '{}' already exists.".format(name))
+            config = dict((entry['name'], entry.get('value'))
+                          for entry in item.get('config', {}).get('items', []))
+            new_roles.append({'name': name, 'type': item['type'],
+                              'host': self.sim.host_ref(item['hostRef']['hostId']),
+                              'state': 'NA' if item['type'] == 'GATEWAY' else 'STOPPED',
+                              'config': config})
+        # The request is applied as a whole, just like CM
+        for role in new_roles:
+            svc['roles'][role['name']] = role
+        return {'items': [self.sim.role_json(svc, role) for role in new_roles]}
+
+    def role(self, cluster, service, role):
+        svc = self.sim.service(cluster, service)
+        if role not in svc['roles']:
+            raise not_found("Role '{}'".format(role))
+        return svc, svc['roles'][role]
+
+    def get_role(self, body, query, role, cluster=None, service=None):
+        svc, data = self.role(cluster, service, role)
+        return self.sim.role_json(svc, data)
+
+    def get_role_config(self, body, query, role, cluster=None, service=None):
+        _, data = self.role(cluster, service, role)
+        return self.sim.config_json(data['config'], query.get('view'))
+
+    def update_role_config(self, body, query, role, cluster=None, service=None):
+        _, data = self.role(cluster, service, role)
+        for item in body.get('items', []):
+            data['config'][item['name']] = item.get('value')
+        return self.sim.config_json(data['config'], None)
+
+    # Role config groups, the base groups exist for every role type
+
+    def group(self, cluster, service, group):
+        svc = self.sim.service(cluster, service)
+        prefix = '{}-'.format(svc['name'] if svc['cluster'] else 'mgmt')
+        if not (group.startswith(prefix) and group.endswith('-BASE')):
+            raise not_found("Role config group '{}'".format(group))
+        role_type = group[len(prefix):-len('-BASE')]
+        return svc, svc['groups'].setdefault(group, {'roleType': role_type, 'config': {}})
+
+    def group_json(self, svc, name, group):
+        ref = {'serviceName': svc['name']}
+        if svc['cluster']:
+            ref['clusterName'] = svc['cluster']
+        return {'name': name, 'displayName': name, 'roleType': group['roleType'], 'base': True,
+                'serviceRef': ref, 'config': self.sim.config_json(group['config'], None)}
+
+    def get_groups(self, body, query, cluster=None, service=None):
+        svc = self.sim.service(cluster, service)
+        return {'items': [self.group_json(svc, name, group)
+                          for name, group in svc['groups'].items()]}
+
+    def get_group(self, body, query, group, cluster=None, service=None):
+        svc, data = self.group(cluster, service, group)
+        return self.group_json(svc, group, data)
+
+    def get_group_config(self, body, query, group, cluster=None, service=None):
+        _, data = self.group(cluster, service, group)
+        return self.sim.config_json(data['config'], query.get('view'))
+
+    def update_group_config(self, body, query, group, cluster=None, service=None):
+        _, data = self.group(cluster, service, group)
+        for item in body.get('items', []):
+            data['config'][item['name']] = item.get('value')
+        return self.sim.config_json(data['config'], None)
+
+    # Commands
+
+    def run_service_command(self, body, query, command, cluster=None, service=None):
+        svc = self.sim.service(cluster, service)
+        return self.sim.service_command(svc, command).to_json()
+
+    def run_role_command(self, body, query, command, cluster=None, service=None):
+        svc = self.sim.service(cluster, service)
+        names = (body or {}).get('items', [])
+        missing = [name for name in names if name not in svc['roles']]
+        if missing:
+            return {'items': [], 'errors': ["Role '{}' not found.".format(name)
+                                            for name in missing]}
+        if command == 'start':
+            cmd = self.sim.command('Start', self.sim.settings.duration(
+                self.sim.settings.start_time), effect=self.sim.start_roles(svc, names))
+        else:
+            cmd = self.sim.service_command(svc, command)
+        return {'items': [cmd.to_json()], 'errors': []}
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    HTTP front end of the simulator
+    """
+    protocol_version = 'HTTP/1.1'
+    api = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body):
+        payload = '' if body is None else json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def dispatch(self, method):
+        settings = self.api.sim.settings
+        if settings.latency:
+            time.sleep(max(0, random.gauss(settings.latency, settings.jitter)))
+
+        url = urlparse.urlparse(self.path)
+        query = dict((key, values[-1]) for key, values in urlparse.parse_qs(url.query).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else ''
+
+        if url.path == '/simulator/stats':
+            return self.respond(200, self.api.sim.stats)
+
+        match = re.match(r'^/api/v\d+(/.*)$', url.path)
+        if not match:
+            return self.respond(404, {'message': 'Unknown path {}'.format(url.path)})
+        try:
+            body = json.loads(raw) if raw and raw.lstrip()[:1] in '{[' else {}
+            if isinstance(body, list):
+                body = {'items': body}
+            self.respond(200, self.api.handle(method, match.group(1).rstrip('/'), query, body))
+        except ApiError as e:
+            self.respond(e.status, {'message': e.message})
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def expand_hosts(entry):
+    """
+    :param entry: Host name or pattern with numeric ranges, e.g. rack[1-4]-dn[01-40,45]
+    :return: Host names matching the pattern, in the same order as the cdh module has them
+    """
+    match = HOST_RANGE.search(entry)
+    if match is None:
+        return [entry]
+    names = []
+    for item in match.group(1).split(','):
+        start, _, end = item.partition('-')
+        width = len(start) if start.startswith('0') and len(start) > 1 else 0
+        for number in range(int(start), int(end or start) + 1):
+            names.extend(expand_hosts(
+                entry[:match.start()] + str(number).zfill(width) + entry[match.end():]))
+    return names
+
+
+def load_config(path):
+    """
+    :return: Tuple of the hostnames and the parcels of a cluster.yaml
+    """
+    import yaml
+    with open(path, 'r') as cluster_yaml:
+        config = yaml.safe_load(cluster_yaml)
+    hosts = [name for host in config.get('cluster', {}).get('hosts', [])
+             for name in expand_hosts(host)]
+    parcels = ['{}-{}'.format(parcel.get('product', 'CDH'), parcel.get('version'))
+               for parcel in config.get('parcels', [])]
+    return hosts, parcels
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated Cloudera Manager API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7180)
+    parser.add_argument('--config', help='cluster.yaml to take the hosts and parcels from')
+    parser.add_argument('--hosts', type=int, default=5,
+                        help='Number of hosts to register when no --config is given')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Factor applied to all the durations, e.g. 0.01 to run 100x faster')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Mean latency in seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Standard deviation of the request latency')
+    parser.add_argument('--command-time', type=float, default=30)
+    parser.add_argument('--start-time', type=float, default=60)
+    parser.add_argument('--inspect-time', type=float, default=120)
+    parser.add_argument('--download-time', type=float, default=300)
+    parser.add_argument('--distribute-time', type=float, default=300)
+    parser.add_argument('--activate-time', type=float, default=30)
+    parser.add_argument('--nic-mbps', type=float, default=0,
+                        help='Bandwidth of the CM NIC in Mbit/s. When set, parcels distribute at '
+                             'the rate the CM settings and the bandwidths allow rather than in '
+                             '--distribute-time')
+    parser.add_argument('--host-mbps', type=float, default=400,
+                        help='Rate in Mbit/s a single host takes a parcel at, with --nic-mbps')
+    parser.add_argument('--curve', choices=['linear', 'scurve', 'stall'], default='linear',
+                        help='Progress curve of the parcel stages')
+    parser.add_argument('--unavailable-rate', type=float, default=0.0,
+                        help="Probability of a command being 'not currently available'")
+    parser.add_argument('--pending-rate', type=float, default=0.0,
+                        help='Probability of a service start hitting a pending command')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Probability of a command failing outright')
+    parser.add_argument('--inspect-failure-rate', type=float, default=0.0,
+                        help='Probability of a host failing some of the host inspector checks')
+    args = parser.parse_args()
+
+    if args.config:
+        hostnames, parcels = load_config(args.config)
+    else:
+        hostnames = ['node{:04d}.example.com'.format(i) for i in range(1, args.hosts + 1)]
+        parcels = []
+
+    Handler.api = Api(Simulator(Settings(args), hostnames, parcels))
+    server = ThreadedHTTPServer((args.host, args.port), Handler)
+    # Print the request counts on a plain kill as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print json.dumps({'type': 'SIMULATOR', 'msg': 'Listening on {}:{} (API v{}) with {} hosts'
+                      .format(args.host, args.port, API_VERSION, len(hostnames))})
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for key, value in sorted(Handler.api.sim.stats.items()):
+            print json.dumps({'type': 'SIMULATOR', 'msg': '{:6d} {}'.format(value, key)})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,490 @@
+#!/usr/bin/python
+# This file is part of Ansible
+
+# Local mirror of Cloudera parcel repos, meant to run on the Cloudera Manager node so that
+# rebuilding a cluster doesn't download the multi-GB parcels over the WAN again.
+#
+# Any upstream repo is mirrored under a path made of its scheme, host and path, e.g.
+#   https://archive.cloudera.com/cdh5/parcels/5.7.1/
+# is served as
+#   http://<cm node>:8900/https/archive.cloudera.com/cdh5/parcels/5.7.1/
+#
+# The `cdh` module rewrites REMOTE_PARCEL_REPO_URLS that way when `cm.parcel_mirror` is set in
+# the cluster.yaml. A parcel missing from the cache is downloaded from upstream with resumable
+# ranged requests and streamed to the clients as it comes in. It's only kept in the cache once it
+# matches its .sha checksum, a client is never sent the last byte of a parcel that doesn't. Range
+# requests are answered with the requested part of the parcel. The least recently used parcels
+# are evicted to keep the cache under its quota.
+#
+# Usage:
+#   python tools/parcel_mirror.py --cache-dir /opt/parcel-mirror --quota 50 --port 8900
+#
+# The parcel-mirror role runs it as a systemd service on the CM node when `parcel_mirror` is set
+# in group_vars/cloudera.
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import urllib2
+
+CHUNK_SIZE = 1024 * 1024
+
+# Number of attempts at resuming an interrupted download, and the time in seconds between them
+DOWNLOAD_ATTEMPTS = 10
+DOWNLOAD_RETRY_INTERVAL = 5
+
+# Time in seconds a manifest is served from the cache before it's fetched from upstream again
+MANIFEST_TTL = 300
+
+
+class MirrorError(Exception):
+    """
+    Error returned to the client with the given HTTP status
+    """
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def log(msg, **kwargs):
+    kwargs.update(type='MIRROR', msg=msg)
+    print json.dumps(kwargs)
+
+
+def byte_range(header, size):
+    """
+    :param header: Value of the Range header of a request, e.g. bytes=0-1023
+    :param size: Size of the file
+    :return: Tuple of the first and last byte requested, None to send the whole file
+    """
+    match = re.match(r'^bytes=(\d*)-(\d*)$', (header or '').strip())
+    # Multiple ranges are not supported, the whole file is sent instead
+    if match is None or size is None or match.group(1) == match.group(2) == '':
+        return None
+    if match.group(1) == '':
+        start, end = max(0, size - int(match.group(2))), size - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    if start > end or start >= size:
+        raise MirrorError(416, 'Range {} is not satisfiable'.format(header))
+    return start, end
+
+
+class Download(object):
+    """
+    Download of a parcel filling its .part file in the background, so that any number of clients
+    can be sent what was received so far while the rest is still coming in
+    """
+    def __init__(self, local, url):
+        self.local = local
+        self.url = url
+        self.part = local + '.part'
+        self.size = None
+        self.received = 0
+        self.done = False
+        self.error = None
+        self._cond = threading.Condition()
+
+    def progress(self, received, size=None):
+        with self._cond:
+            self.received = received
+            if size is not None:
+                self.size = size
+            self._cond.notify_all()
+
+    def finish(self):
+        """
+        Move the verified parcel into the cache
+        """
+        with self._cond:
+            os.rename(self.part, self.local)
+            self.done = True
+            self._cond.notify_all()
+
+    def fail(self, error):
+        with self._cond:
+            self.error = error
+            self._cond.notify_all()
+
+    def check(self):
+        if self.error is not None:
+            if isinstance(self.error, MirrorError):
+                raise self.error
+            raise MirrorError(502, 'Failed downloading {}: {}'.format(self.url, self.error))
+
+    def open(self):
+        """
+        :return: File object of the parcel, wherever it is at the moment
+        """
+        with self._cond:
+            return open(self.local if self.done else self.part, 'rb')
+
+    def wait_size(self):
+        """
+        :return: Size of the parcel as soon as upstream told it, None if it doesn't
+        """
+        with self._cond:
+            while self.size is None and self.received == 0 and not self.done:
+                self.check()
+                self._cond.wait(1)
+            self.check()
+            return self.size
+
+    def wait(self, offset):
+        """
+        :param offset: Number of bytes a client was sent so far
+        :return: Number of bytes the client can be sent, once it's more than offset or the
+                 parcel is complete. The last byte is held back until the parcel is verified.
+        """
+        with self._cond:
+            while True:
+                self.check()
+                available = self.received
+                if self.done:
+                    return available
+                if self.size is not None:
+                    available = min(available, self.size - 1)
+                if available > offset:
+                    return available
+                self._cond.wait(1)
+
+
+class ParcelCache(object):
+    """
+    Parcels and repo manifests on local disk, filled from upstream on a miss
+    """
+    def __init__(self, cache_dir, quota, timeout=60):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.quota = quota
+        self.timeout = timeout
+        self.stats = {'hits': 0, 'misses': 0, 'downloaded': 0, 'evicted': 0}
+        self._downloads = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def lock(self, path):
+        """
+        :return: Lock serializing the downloads of a single file
+        """
+        with self._lock:
+            return self._locks.setdefault(path, threading.Lock())
+
+    def local_path(self, path):
+        """
+        :param path: Request path, e.g. /https/archive.cloudera.com/cdh5/parcels/5.7.1/x.parcel
+        :return: Tuple of the location in the cache and the upstream url
+        """
+        parts = [part for part in path.split('?')[0].split('/') if part]
+        if len(parts) < 3 or parts[0] not in ('http', 'https') or '..' in parts:
+            raise MirrorError(404, 'Not a mirrored path: {}'.format(path))
+        return (os.path.join(self.cache_dir, *parts),
+                '{}://{}'.format(parts[0], '/'.join(parts[1:])))
+
+    def fetch(self, path):
+        """
+        :param path: Request path
+        :return: Tuple of the location of the file in the cache, fetched from upstream if needed,
+                 and the `Download` still filling it, None once the file is complete
+        """
+        local, url = self.local_path(path)
+        with self.lock(local):
+            if local.endswith('manifest.json'):
+                return self.manifest(local, url), None
+            # Clients asking for a parcel being downloaded share the download
+            download = self._downloads.get(local)
+            if download is not None:
+                return local, download
+            if os.path.exists(local):
+                self.stats['hits'] += 1
+                # The modification time keeps track of when a file was last used
+                os.utime(local, None)
+                return local, None
+            self.stats['misses'] += 1
+            if not local.endswith('.parcel'):
+                self.download(local, url)
+                return local, None
+            download = Download(local, url)
+            self._downloads[local] = download
+            thread = threading.Thread(target=self.download_parcel, args=(download,))
+            thread.daemon = True
+            thread.start()
+            return local, download
+
+    def manifest(self, local, url):
+        """
+        Fetch the manifest of an upstream repo, falling back on the cached copy when upstream
+        is not reachable
+        """
+        if os.path.exists(local) and os.path.getmtime(local) > time.time() - MANIFEST_TTL:
+            return local
+        try:
+            self.download(local, url)
+        except (urllib2.URLError, IOError) as e:
+            if not os.path.exists(local):
+                raise MirrorError(502, 'Failed fetching {}: {}'.format(url, e))
+            log('Serving the cached manifest, upstream is not reachable', url=url,
+                error=str(e))
+        return local
+
+    def download(self, local, url):
+        """
+        Download a small file in one go
+        """
+        directory = os.path.dirname(local)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        response = urllib2.urlopen(url, timeout=self.timeout)
+        with open(local + '.part', 'wb') as part:
+            shutil.copyfileobj(response, part, CHUNK_SIZE)
+        os.rename(local + '.part', local)
+
+    def checksum(self, url):
+        """
+        :return: Expected sha1 of a parcel, from the .sha file next to it upstream
+        """
+        try:
+            content = urllib2.urlopen(url + '.sha', timeout=self.timeout).read()
+        except urllib2.URLError as e:
+            raise MirrorError(502, 'Failed fetching the checksum of {}: {}'.format(url, e))
+        return content.split()[0].strip().lower() if content.strip() else None
+
+    def download_parcel(self, download):
+        """
+        Download a parcel, resuming from where an interrupted download stopped, and verify it
+        against its checksum before moving it into the cache. The checksum is computed as the
+        parcel comes in, so that the parcel is not read again once downloaded.
+
+        :param download: `Download` of the parcel
+        """
+        local, url, part = download.local, download.url, download.part
+        try:
+            expected = self.checksum(url)
+            directory = os.path.dirname(local)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            # Carry on from the part left by an earlier download. The part exists from here on,
+            # for the clients to open.
+            open(part, 'ab').close()
+            sha1 = hashlib.sha1()
+            with open(part, 'rb') as stream:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), ''):
+                    sha1.update(chunk)
+            received = os.path.getsize(part)
+            download.progress(received)
+
+            log('Downloading', url=url)
+            started = time.time()
+            for attempt in range(DOWNLOAD_ATTEMPTS):
+                request = urllib2.Request(url)
+                if received:
+                    request.add_header('Range', 'bytes={}-'.format(received))
+                try:
+                    response = urllib2.urlopen(request, timeout=self.timeout)
+                    length = response.info().getheader('Content-Length')
+                    length = int(length) if length is not None else None
+                    # A server ignoring the range sends the whole file again
+                    if received and response.getcode() != 206:
+                        sha1 = hashlib.sha1()
+                        received = 0
+                    download.progress(received, None if length is None else received + length)
+                    with open(part, 'ab' if received else 'wb') as stream:
+                        start = received
+                        while True:
+                            chunk = response.read(CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            stream.write(chunk)
+                            # Clients read the part while it's written
+                            stream.flush()
+                            sha1.update(chunk)
+                            received += len(chunk)
+                            download.progress(received)
+                    # A dropped connection looks like the end of the response
+                    if length is None or received - start >= length:
+                        break
+                    error = IOError('Received {} of {} bytes'.format(received - start, length))
+                except urllib2.HTTPError as e:
+                    if e.code == 416:
+                        # The part is already complete
+                        download.progress(received, received)
+                        break
+                    if e.code < 500:
+                        raise MirrorError(e.code, 'Failed downloading {}: {}'.format(url, e))
+                    error = e
+                except (urllib2.URLError, IOError) as e:
+                    error = e
+                log('Download interrupted, resuming', url=url, attempt=attempt + 1,
+                    error=str(error))
+                time.sleep(DOWNLOAD_RETRY_INTERVAL)
+            else:
+                raise MirrorError(502, 'Failed downloading {}'.format(url))
+
+            if expected and sha1.hexdigest() != expected:
+                os.remove(part)
+                raise MirrorError(502, 'Checksum mismatch for {}, expected {} but got {}'.format(
+                    url, expected, sha1.hexdigest()))
+
+            with open(local + '.sha', 'w') as sha:
+                sha.write(sha1.hexdigest() + '\n')
+            with self.lock(local):
+                download.finish()
+                del self._downloads[local]
+        except Exception as e:
+            log('Download failed', url=url, error=str(e))
+            with self.lock(local):
+                download.fail(e)
+                self._downloads.pop(local, None)
+            return
+        size = os.path.getsize(local)
+        self.stats['downloaded'] += size
+        log('Downloaded', url=url, size=size, seconds=round(time.time() - started, 1))
+        self.evict(keep=local)
+
+    def parcels(self):
+        """
+        :return: List of (last used, size, path) of the cached parcels
+        """
+        found = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.parcel'):
+                    path = os.path.join(root, name)
+                    found.append((os.path.getmtime(path), os.path.getsize(path), path))
+        return sorted(found)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used parcels until the cache is within its quota
+        """
+        if not self.quota:
+            return
+        parcels = self.parcels()
+        total = sum(size for _, size, _ in parcels)
+        for _, size, path in parcels:
+            if total <= self.quota:
+                break
+            if path == keep:
+                continue
+            with self.lock(path):
+                for stale in (path, path + '.sha'):
+                    if os.path.exists(stale):
+                        os.remove(stale)
+            total -= size
+            self.stats['evicted'] += 1
+            log('Evicted', path=path, size=size)
+        if total > self.quota:
+            log('The cache is over its quota', size=total, quota=self.quota)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    HTTP front end of the mirror
+    """
+    protocol_version = 'HTTP/1.1'
+    cache = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond_json(self, status, body):
+        payload = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/mirror/status':
+            return self.respond_json(200, dict(
+                self.cache.stats, quota=self.cache.quota,
+                parcels=[{'path': os.path.relpath(path, self.cache.cache_dir), 'size': size,
+                          'used': used} for used, size, path in self.cache.parcels()]))
+        try:
+            local, download = self.cache.fetch(self.path)
+            size = os.path.getsize(local) if download is None else download.wait_size()
+            requested = byte_range(self.headers.getheader('Range'), size)
+        except MirrorError as e:
+            return self.respond_json(e.status, {'message': str(e)})
+
+        start, end = requested or (0, None if size is None else size - 1)
+        self.send_response(206 if requested else 200)
+        self.send_header('Content-Type', 'application/json' if local.endswith('.json') else
+                         'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+        if requested:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        if end is not None:
+            self.send_header('Content-Length', str(end - start + 1))
+        else:
+            # The end of a parcel of unknown size is told by closing the connection
+            self.close_connection = True
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+
+        stream = open(local, 'rb') if download is None else download.open()
+        try:
+            stream.seek(start)
+            offset = start
+            while end is None or offset <= end:
+                available = download.wait(offset) if download is not None else end + 1
+                if end is not None:
+                    available = min(available, end + 1)
+                if available <= offset:
+                    break
+                chunk = stream.read(min(CHUNK_SIZE, available - offset))
+                if not chunk:
+                    if download is None or download.done:
+                        break
+                    continue
+                self.wfile.write(chunk)
+                offset += len(chunk)
+        except MirrorError as e:
+            # The headers are sent already, the response cut short tells the client it failed
+            log('Response cut short', path=self.path, error=str(e))
+            self.close_connection = True
+        finally:
+            stream.close()
+
+    do_HEAD = do_GET
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mirror of Cloudera parcel repos')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--cache-dir', default='/opt/parcel-mirror')
+    parser.add_argument('--quota', type=float, default=50,
+                        help='Maximum size of the cached parcels in GB, 0 for no limit')
+    parser.add_argument('--timeout', type=int, default=60,
+                        help='Timeout in seconds of the requests to upstream repos')
+    args = parser.parse_args()
+
+    Handler.cache = ParcelCache(args.cache_dir, int(args.quota * 1024 ** 3), args.timeout)
+    server = ThreadedHTTPServer((args.host, args.port), Handler)
+    log('Listening on {}:{}, caching in {}'.format(args.host, args.port, args.cache_dir))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()